@@ -25,29 +25,60 @@ Ejemplos de uso:
   python microbiome_cli.py beta-diversity table.qza --metrics braycurtis,jaccard
   python microbiome_cli.py predict-metabolic-pathways table.qza rep-seqs.qza
 """
+import functools
+import logging
 import os
 import subprocess
 
 import click
-from modules.downloader import download_sra_from_csv, check_dependencies
-from modules.qiime2_utils import create_fasta_manifest, import_to_qiime2, check_qiime2_installation
-from modules.quality_control import QualityControl
-from modules.denoiser import Denoiser
-from modules.taxa import import_database_to_qiime2, taxa_assigner
-from modules.phylogeny import make_phylogeny
-from modules.alpha_diversity import calculate_alpha_diversity
-from modules.beta_diversity import calculate_beta_diversity, calculate_phylogenetic_beta_diversity, plot_pcoa
-from modules.picrust2 import run_picrust2, filter_low_abundance_pathways, normalize_pathway_abundance
+
+# Los módulos de análisis (QIIME2, pandas, matplotlib...) se importan dentro de
+# cada comando: así `--version`, `--help` y los comandos ligeros no pagan el
+# coste de importar todo el stack de QIIME2 en cada invocación.
+
+log = logging.getLogger('microbiome')
+
+NATIVE_THREAD_VARS = ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS", "NUMEXPR_NUM_THREADS")
+
+
+@functools.lru_cache(maxsize=32)
+def parse_metrics(metrics):
+    """Convierte 'a, b,c' en ('a', 'b', 'c'); una cadena vacía o None da una tupla vacía"""
+    if not metrics:
+        return ()
+    return tuple(m.strip() for m in metrics.split(',') if m.strip())
+
+
+def limit_native_threads(n):
+    """Limita los hilos de BLAS/OpenMP a ``n`` salvo que el usuario ya los fije
+
+    Debe llamarse antes de importar NumPy o QIIME2: las bibliotecas nativas
+    leen estas variables al cargarse.
+    """
+    for var in NATIVE_THREAD_VARS:
+        os.environ.setdefault(var, str(n))
+
 
 @click.group(invoke_without_command=True)
 @click.pass_context
 @click.option('--version', '-v', is_flag=True, help='Mostrar versión')
-def cli(ctx, version):
+@click.option('--verbose', is_flag=True, help='Mostrar los parámetros de cada comando')
+@click.option('--no-cache', is_flag=True,
+              help='No leer ni escribir la caché en disco (~/.microbiome_cache o MICROBIOME_CACHE_DIR)')
+def cli(ctx, version, verbose, no_cache):
     """Herramienta de análisis de microbioma 16S
 
     Un pipeline completo para el análisis de datos de amplicón 16S
     desde la descarga de secuencias hasta la obtención de ASVs.
     """
+    logging.basicConfig(level=logging.INFO if verbose else logging.WARNING, format='%(message)s')
+
+    if no_cache:
+        from modules.artifact_cache import CACHE_DISABLE_ENV
+
+        # Variable de entorno: también la heredan los subprocesos (run-batch)
+        os.environ[CACHE_DISABLE_ENV] = '1'
+
     if version:
         click.echo("Microbiome Pipeline 16S v1.0.0")
         return
@@ -60,6 +91,7 @@ def cli(ctx, version):
         click.echo("  import-sample-seqs     Importar secuencias a QIIME2")
         click.echo("  quality-control        Control de calidad completo")
         click.echo("  run-deblur             Denoising con Deblur")
+        click.echo("  run-batch              Ejecutar Deblur sobre varios archivos en paralelo")
         click.echo("  import-reference-database  Importar base de datos de referencia a Qiime2")
         click.echo("  assign-taxonomy        Asignar OTUs/ASVs a taxones")
         click.echo("  build-phylogeny         Generar árbol filogenético")
@@ -74,7 +106,26 @@ def cli(ctx, version):
 @click.option('--output-dir', default='data/raw', help='Directorio de salida para los FASTQ')
 @click.option('--accession-col', default='run_accession',
               help='Nombre de la columna con los accessions (por defecto: run_accession)')
-def download(csv_file, output_dir, accession_col):
+@click.option('--prefetch-jobs', default=2,
+              help='Descargas prefetch simultáneas (por defecto: 2)')
+@click.option('--dump-jobs', default=0,
+              help='Conversiones fasterq-dump simultáneas, 0 = según núcleos disponibles (por defecto: 0)')
+@click.option('--threads', default=4,
+              help='Hilos por proceso fasterq-dump y pigz, máximo 6 (por defecto: 4)')
+@click.option('--tmp-dir', type=click.Path(),
+              help='Directorio temporal de fasterq-dump (por defecto: carpeta de cada accession)')
+@click.option('--source', type=click.Choice(['auto', 'ena', 'sra']), default='auto',
+              help='Origen de los datos: ENA con respaldo en SRA, solo ENA o solo SRA (por defecto: auto)')
+@click.option('--no-ena', is_flag=True,
+              help='No intentar ENA; usar solo SRA Toolkit (p. ej. datos controlados de dbGaP)')
+@click.option('--chunk-size', default=16,
+              help='Accessions por invocación de prefetch (por defecto: 16)')
+@click.option('--resume/--no-resume', default=True,
+              help='Omitir los accessions ya completados según OUTPUT_DIR/.state.db (por defecto: activado)')
+@click.option('--dry-run', is_flag=True,
+              help='Mostrar los accessions que se descargarían sin descargar nada')
+def download(csv_file, output_dir, accession_col, prefetch_jobs, dump_jobs, threads, tmp_dir, source,
+             no_ena, chunk_size, resume, dry_run):
     """Descargar archivos SRA desde un archivo CSV
 
     CSV_FILE: Ruta al archivo CSV que contiene los accessions SRA
@@ -83,15 +134,26 @@ def download(csv_file, output_dir, accession_col):
       microbiome_cli.py download samples.csv
       microbiome_cli.py download samples.csv --output-dir my_data
       microbiome_cli.py download samples.csv --accession-col sample_id
+      microbiome_cli.py download samples.csv --prefetch-jobs 4 --dump-jobs 2
+      microbiome_cli.py download samples.csv --no-ena
+      microbiome_cli.py download samples.csv --dry-run
     """
-    if not check_dependencies():
+    from modules.downloader import download_sra_from_csv, check_dependencies
+
+    if no_ena:
+        source = 'sra'
+
+    if source != 'ena' and not dry_run and not check_dependencies():
         return
 
-    click.echo(f"📥 Descargando secuencias desde: {csv_file}")
-    click.echo(f"📁 Directorio de salida: {output_dir}")
-    click.echo(f"🔤 Columna de accessions: {accession_col}")
+    log.info("cmd=%s in=%s out=%s params=%s", 'download', csv_file, output_dir,
+             dict(accession_col=accession_col, source=source, prefetch_jobs=prefetch_jobs,
+                  dump_jobs=dump_jobs, threads=threads, chunk_size=chunk_size, resume=resume))
 
-    download_sra_from_csv(csv_file, output_dir)
+    download_sra_from_csv(csv_file, output_dir, prefetch_jobs=prefetch_jobs,
+                          dump_jobs=dump_jobs, threads=threads, tmp_dir=tmp_dir, source=source,
+                          accession_col=accession_col, chunk_size=chunk_size, resume=resume,
+                          dry_run=dry_run)
 
 
 @cli.command()
@@ -99,7 +161,9 @@ def download(csv_file, output_dir, accession_col):
               help='Directorio con archivos FASTQ (por defecto: data/raw)')
 @click.option('--output-file', default='fasta_manifest.csv',
               help='Archivo de manifiesto de salida (por defecto: fasta_manifest.csv)')
-def create_manifest(input_dir, output_file):
+@click.option('--validate-pairs', is_flag=True,
+              help='Verificar que forward y reverse tengan el mismo número de reads')
+def create_manifest(input_dir, output_file, validate_pairs):
     """Crear archivo de manifiesto para importación en QIIME2
 
     Busca automáticamente archivos FASTQ en el directorio de entrada
@@ -109,11 +173,14 @@ def create_manifest(input_dir, output_file):
       microbiome_cli.py create-manifest
       microbiome_cli.py create-manifest --input-dir my_data
       microbiome_cli.py create-manifest --output-file my_manifest.csv
+      microbiome_cli.py create-manifest --validate-pairs
     """
+    from modules.qiime2_utils import create_fasta_manifest
+
     click.echo(f"🔍 Buscando FASTQ en: {input_dir}")
     click.echo(f"📄 Creando manifiesto: {output_file}")
 
-    create_fasta_manifest(input_dir, output_file)
+    create_fasta_manifest(input_dir, output_file, validate_pairs=validate_pairs)
 
 
 @cli.command()
@@ -132,6 +199,8 @@ def import_sample_seqs(manifest_file, output_dir):
       microbiome_cli.py import-qiime2 manifest.csv
       microbiome_cli.py import-qiime2 manifest.csv --output-dir qiime_data
     """
+    from modules.qiime2_utils import import_to_qiime2, check_qiime2_installation
+
     if not check_qiime2_installation():
         return
 
@@ -154,7 +223,7 @@ def quality_control(demux_file, output_dir, min_quality):
 
     Genera:
       - Reporte de calidad QIIME2 (.qzv)
-      - Gráficos de perfil de calidad (.png)
+      - Gráficos de perfil de calidad (.svg)
       - Secuencias filtradas (.qza)
 
     Ejemplos:
@@ -162,11 +231,13 @@ def quality_control(demux_file, output_dir, min_quality):
       microbiome_cli.py quality-control demux.qza --min-quality 25
       microbiome_cli.py quality-control demux.qza --output-dir my_qc
     """
-    click.echo(f"🎯 Analizando: {demux_file}")
-    click.echo(f"📁 Directorio de salida: {output_dir}")
-    click.echo(f"📊 Calidad mínima: {min_quality}")
+    from modules.quality_control import QualityControl
+    from modules.artifact_cache import load_artifact
 
-    qc = QualityControl(demux_file)
+    log.info("cmd=%s in=%s out=%s params=%s", 'quality-control', demux_file, output_dir,
+             dict(min_quality=min_quality))
+
+    qc = QualityControl(load_artifact(demux_file))
     results = qc.run_quality_control(output_dir, min_quality)
 
     if results and results['filtered_seqs']:
@@ -185,9 +256,16 @@ def quality_control(demux_file, output_dir, min_quality):
               help='Mínimo de lecturas por muestra (por defecto: 10)')
 @click.option('--min-size', default=2,
               help='Mínimo de tamaño para filtrado (por defecto: 2)')
-@click.option('--jobs-to-start', default=8,
-              help='Número de CPUs para procesar (por defecto: 8)')
-def run_deblur(demux_file, output_dir, left_trim_len, trim_length, min_reads, min_size, jobs_to_start):
+@click.option('--jobs-to-start', default=0,
+              help='Número de CPUs para procesar, 0 = CPUs disponibles menos una (por defecto: 0)')
+@click.option('--shards', default=1,
+              help='Grupos de muestras procesados en paralelo, cada uno con --jobs-to-start CPUs (por defecto: 1)')
+@click.option('--save-stats/--no-save-stats', default=True,
+              help='Calcular y guardar stats.qza (por defecto: sí)')
+@click.option('--save-rep-seqs/--no-save-rep-seqs', default=True,
+              help='Guardar rep-seqs.qza (por defecto: sí)')
+def run_deblur(demux_file, output_dir, left_trim_len, trim_length, min_reads, min_size, jobs_to_start, shards,
+               save_stats, save_rep_seqs):
     """Ejecutar Deblur para denoising y obtención de ASVs
 
     DEMUX_FILE: Ruta al artefacto QIIME2 con secuencias demultiplexadas (.qza)
@@ -199,18 +277,22 @@ def run_deblur(demux_file, output_dir, left_trim_len, trim_length, min_reads, mi
       microbiome_cli.py run-deblur demux.qza
       microbiome_cli.py run-deblur demux.qza --trim-length 200
       microbiome_cli.py run-deblur demux.qza --jobs-to-start 4
+      microbiome_cli.py run-deblur demux.qza --jobs-to-start 4 --shards 4
+      microbiome_cli.py run-deblur demux.qza --no-save-stats --no-save-rep-seqs
     """
-    click.echo(f"🧹 Ejecutando Deblur en: {demux_file}")
-    click.echo(f"📁 Directorio de salida: {output_dir}")
-    click.echo(f"✂️  Trim inicial: {left_trim_len}")
-    click.echo(f"✂️  Trim final: {trim_length}")
-    click.echo(f"📊 Mínimo de lecturas: {min_reads}")
-    click.echo(f"🔢 Mínimo de tamaño: {min_size}")
-    click.echo(f"⚡ CPUs: {jobs_to_start}")
+    from modules.denoiser import Denoiser
+
+    log.info("cmd=%s in=%s out=%s params=%s", 'run-deblur', demux_file, output_dir,
+             dict(left_trim_len=left_trim_len, trim_length=trim_length, min_reads=min_reads,
+                  min_size=min_size, jobs_to_start=jobs_to_start, shards=shards))
 
+    # El artefacto se carga al ejecutar Deblur, no al construir el objeto
     denoiser = Denoiser(demux_file)
     result = denoiser.run_deblur(
         output_dir=output_dir,
+        shards=shards,
+        save_stats=save_stats,
+        save_rep_seqs=save_rep_seqs,
         left_trim_len=left_trim_len,
         trim_length=trim_length,
         min_reads=min_reads,
@@ -218,8 +300,110 @@ def run_deblur(demux_file, output_dir, left_trim_len, trim_length, min_reads, mi
         jobs_to_start=jobs_to_start
     )
 
-    if result:
-        click.echo("🎉 Proceso de denoising con Deblur completado exitosamente!")
+    if not result:
+        # Código de salida distinto de cero para que run-batch detecte el fallo
+        raise SystemExit(1)
+    click.echo("🎉 Proceso de denoising con Deblur completado exitosamente!")
+
+@cli.command()
+@click.argument('demux_files', nargs=-1, required=True, type=click.Path(exists=True))
+@click.option('--output-dir', default='results/deblur',
+              help='Directorio base; cada archivo se procesa en una subcarpeta (por defecto: results/deblur)')
+@click.option('--jobs', default=2,
+              help='Archivos procesados simultáneamente (por defecto: 2)')
+@click.option('--left-trim-len', default=0,
+              help='Longitud de trim de inicio (por defecto: 0)')
+@click.option('--trim-length', default=250,
+              help='Longitud de trim final (por defecto: 250)')
+@click.option('--min-reads', default=10,
+              help='Mínimo de lecturas por muestra (por defecto: 10)')
+@click.option('--min-size', default=2,
+              help='Mínimo de tamaño para filtrado (por defecto: 2)')
+@click.option('--jobs-to-start', default=0,
+              help='CPUs de Deblur por archivo, 0 = CPUs disponibles repartidas entre --jobs (por defecto: 0)')
+@click.option('--shards', default=1,
+              help='Grupos de muestras por archivo, cada uno con --jobs-to-start CPUs (por defecto: 1)')
+@click.option('--save-stats/--no-save-stats', default=True,
+              help='Calcular y guardar stats.qza (por defecto: sí)')
+@click.option('--save-rep-seqs/--no-save-rep-seqs', default=True,
+              help='Guardar rep-seqs.qza (por defecto: sí)')
+def run_batch(demux_files, output_dir, jobs, left_trim_len, trim_length, min_reads, min_size, jobs_to_start,
+              shards, save_stats, save_rep_seqs):
+    """Ejecutar run-deblur sobre varios artefactos demultiplexados en paralelo
+
+    DEMUX_FILES: Rutas a artefactos QIIME2 con secuencias demultiplexadas (.qza)
+
+    Cada archivo se procesa en un subproceso independiente; como mucho
+    ``--jobs`` a la vez, de modo que el empaquetado/desempaquetado de .qza
+    de unos se solapa con el cómputo de otros. Los resultados de cada
+    archivo van a ``OUTPUT_DIR/<nombre sin .qza>``; los nombres repetidos
+    se rechazan antes de empezar.
+
+    A diferencia de run-deblur (0 = CPUs disponibles menos una), aquí
+    ``--jobs-to-start 0`` reparte las CPUs entre los archivos simultáneos
+    para no sobresuscribir la máquina. El resto de opciones se pasan tal
+    cual a cada run-deblur; si algún archivo falla, se muestra su salida y
+    el comando termina con código distinto de cero.
+
+    Ejemplos:
+      microbiome_cli.py run-batch run1.qza run2.qza run3.qza
+      microbiome_cli.py run-batch data/qiime2/*.qza --jobs 4 --jobs-to-start 2
+    """
+    import asyncio
+    import sys
+    from pathlib import Path
+    from modules.utils import available_cpus
+
+    # Subcarpeta por archivo: el nombre completo sin la extensión .qza
+    # (run1.trimmed.qza -> run1.trimmed)
+    targets = []
+    for demux_file in demux_files:
+        name = Path(demux_file).name
+        targets.append(os.path.join(output_dir, name[:-len('.qza')] if name.endswith('.qza') else name))
+    collisions = sorted({t for t in targets if targets.count(t) > 1})
+    if collisions:
+        click.echo("❌ Varios archivos se escribirían en la misma carpeta de salida:")
+        for target in collisions:
+            click.echo(f"   • {target}")
+        return
+
+    if not jobs_to_start:
+        jobs_to_start = max(1, available_cpus() // max(1, jobs))
+
+    log.info("cmd=%s in=%s out=%s params=%s", 'run-batch', demux_files, output_dir,
+             dict(jobs=jobs, left_trim_len=left_trim_len, trim_length=trim_length, min_reads=min_reads,
+                  min_size=min_size, jobs_to_start=jobs_to_start, shards=shards))
+
+    options = ['--left-trim-len', str(left_trim_len), '--trim-length', str(trim_length),
+               '--min-reads', str(min_reads), '--min-size', str(min_size),
+               '--jobs-to-start', str(jobs_to_start), '--shards', str(shards),
+               '--save-stats' if save_stats else '--no-save-stats',
+               '--save-rep-seqs' if save_rep_seqs else '--no-save-rep-seqs']
+
+    async def run_one(semaphore, demux_file, target):
+        cmd = [sys.executable, os.path.abspath(__file__), 'run-deblur', demux_file,
+               '--output-dir', target, *options]
+        async with semaphore:
+            click.echo(f"🚀 Iniciando {demux_file}")
+            # stdout y stderr juntos: los errores de Deblur se imprimen por stdout
+            proc = await asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.PIPE,
+                                                        stderr=asyncio.subprocess.STDOUT)
+            output, _ = await proc.communicate()
+        if proc.returncode:
+            click.echo(f"❌ {demux_file} falló (código {proc.returncode}):")
+            click.echo(output.decode(errors='replace').rstrip())
+        else:
+            click.echo(f"✅ {demux_file} completado")
+        return proc.returncode == 0
+
+    async def run_all():
+        semaphore = asyncio.Semaphore(max(1, jobs))
+        return await asyncio.gather(*(run_one(semaphore, f, t) for f, t in zip(demux_files, targets)))
+
+    results = asyncio.run(run_all())
+    click.echo(f"🎉 {sum(results)}/{len(results)} archivos procesados")
+    if not all(results):
+        raise SystemExit(1)
 
 @cli.command()
 @click.argument('filename_seq', type=click.Path(exists=True))
@@ -236,6 +420,8 @@ def import_reference_database(filename_seq, filename_taxa, output_dir):
       microbiome_cli.py import-reference-database ref_seqs.fna ref_taxa.txt
       microbiome_cli.py import-reference-database ref_seqs.fna ref_taxa.txt --output-dir my_ref_db
     """
+    from modules.taxa import import_database_to_qiime2
+
     click.echo(f"📚 Importando base de datos de referencia...")
     click.echo(f"🧬 Secuencias: {filename_seq}")
     click.echo(f"📊 Taxonomías: {filename_taxa}")
@@ -256,10 +442,23 @@ def import_reference_database(filename_seq, filename_taxa, output_dir):
 @click.argument('taxa_ref', type=click.Path(exists=True))
 @click.argument('metadata_filename', type=click.Path(exists=True))
 @click.option('--cpus', default=1, help='Número de CPUs a usar (por defecto: 1)')
+@click.option('--shards', default=1,
+              help='Particiones de secuencias clasificadas en paralelo, repartiendo --cpus (por defecto: 1)')
+@click.option('--input-cache', type=click.Path(),
+              help='Caché (JSON) de clasificaciones previas a reutilizar '
+                   '(por defecto: classification_cache.json en --output-dir)')
+@click.option('--output-cache', type=click.Path(),
+              help='Ruta donde guardar la caché (JSON) de clasificaciones '
+                   '(por defecto: classification_cache.json en --output-dir)')
+@click.option('--backend', type=click.Choice(['vsearch', 'faiss-gpu']), default='vsearch',
+              help='Clasificador: vsearch o vecinos k-mer con FAISS en GPU (por defecto: vsearch)')
+@click.option('--csv/--no-csv', 'write_csv', default=True,
+              help='Guardar también cada nivel en CSV además de Parquet (por defecto: sí)')
 @click.option('--output-dir', default='results/taxonomy',
               help='Directorio de salida (por defecto: results/taxonomy)')
-def assign_taxonomy(table, rep_seqs, seqs_ref, taxa_ref, metadata_filename, cpus, output_dir):
-    """Asignación taxonómica y generación de archivos CSV por nivel taxonómico
+def assign_taxonomy(table, rep_seqs, seqs_ref, taxa_ref, metadata_filename, cpus, shards, input_cache, output_cache,
+                    backend, write_csv, output_dir):
+    """Asignación taxonómica y generación de archivos Parquet/CSV por nivel taxonómico
 
     TABLE: Ruta al artefacto QIIME2 de la tabla de características (.qza)
     REP_SEQS: Ruta al artefacto QIIME2 de secuencias representativas (.qza)
@@ -270,22 +469,29 @@ def assign_taxonomy(table, rep_seqs, seqs_ref, taxa_ref, metadata_filename, cpus
     Ejemplos:
       microbiome_cli.py assign-taxonomy table.qza rep-seqs.qza ref-seqs.qza ref-taxa.qza metadata.tsv
       microbiome_cli.py assign-taxonomy table.qza rep-seqs.qza ref-seqs.qza ref-taxa.qza metadata.tsv --cpus 4 --output-dir my_taxa
+      microbiome_cli.py assign-taxonomy table.qza rep-seqs.qza ref-seqs.qza ref-taxa.qza metadata.tsv --cpus 16 --shards 4
+      microbiome_cli.py assign-taxonomy table.qza rep-seqs.qza ref-seqs.qza ref-taxa.qza metadata.tsv --input-cache taxa.json --output-cache taxa.json
+      microbiome_cli.py assign-taxonomy table.qza rep-seqs.qza ref-seqs.qza ref-taxa.qza metadata.tsv --backend faiss-gpu
+      microbiome_cli.py assign-taxonomy table.qza rep-seqs.qza ref-seqs.qza ref-taxa.qza metadata.tsv --no-csv
     """
-    click.echo(f"🔍 Asignando taxonomía...")
-    click.echo(f"📊 Tabla de características: {table}")
-    click.echo(f"🧬 Secuencias representativas: {rep_seqs}")
-    click.echo(f"📚 Secuencias de referencia: {seqs_ref}")
-    click.echo(f"📚 Taxonomía de referencia: {taxa_ref}")
-    click.echo(f"📋 Metadatos: {metadata_filename}")
-    click.echo(f"⚡ CPUs: {cpus}")
-    click.echo(f"📁 Directorio de salida: {output_dir}")
+    limit_native_threads(cpus)
+    from modules.taxa import taxa_assigner, PYARROW_AVAILABLE
+
+    log.info("cmd=%s in=%s out=%s params=%s", 'assign-taxonomy', (table, rep_seqs), output_dir,
+             dict(seqs_ref=seqs_ref, taxa_ref=taxa_ref, metadata=metadata_filename, cpus=cpus,
+                  shards=shards, backend=backend, write_csv=write_csv))
 
     try:
-        result = taxa_assigner(table, rep_seqs, seqs_ref, taxa_ref, metadata_filename, cpus, output_dir)
+        # Se pasan rutas: taxa_assigner carga cada artefacto solo cuando lo necesita
+        result = taxa_assigner(table, rep_seqs, seqs_ref, taxa_ref,
+                               metadata_filename, cpus, output_dir, shards=shards,
+                               input_cache=input_cache, output_cache=output_cache, backend=backend,
+                               write_csv=write_csv)
         click.echo(f"✅ {result}")
-        click.echo(f"📈 Archivos CSV generados:")
-        click.echo(f"   - phylum.csv, class.csv, order.csv")
-        click.echo(f"   - family.csv, genus.csv, species.csv")
+        extensions = ['parquet'] * PYARROW_AVAILABLE + ['csv'] * (write_csv or not PYARROW_AVAILABLE)
+        click.echo(f"📈 Archivos generados por nivel ({', '.join(extensions)}):")
+        click.echo(f"   - phylum, class, order")
+        click.echo(f"   - family, genus, species")
         click.echo(f"   - taxa_barplot.qzv (visualización QIIME2)")
     except Exception as e:
         click.echo(f"❌ Error en asignación taxonómica: {str(e)}")
@@ -294,7 +500,16 @@ def assign_taxonomy(table, rep_seqs, seqs_ref, taxa_ref, metadata_filename, cpus
 @click.argument('rep_seqs', type=click.Path(exists=True))
 @click.option('--output-dir', default='results/phylogeny',
               help='Directorio de salida (por defecto: results/phylogeny)')
-def build_phylogeny(rep_seqs, output_dir):
+@click.option('--threads', default=0,
+              help='Hilos para MAFFT y FastTree, 0 = todas las CPUs disponibles (por defecto: 0)')
+@click.option('--parttree', is_flag=True,
+              help='Usar PartTree en MAFFT (recomendado para conjuntos muy grandes)')
+@click.option('--tree-tool', type=click.Choice(['auto', 'veryfasttree', 'fasttree']), default='fasttree',
+              help='Herramienta de inferencia del árbol; auto usa VeryFastTree si está instalado. Ambas usan '
+                   'el mismo modelo (JC+CAT) (por defecto: fasttree)')
+@click.option('--fastest', is_flag=True,
+              help='Modo -fastest de VeryFastTree (más rápido en alineamientos muy grandes, algo menos preciso)')
+def build_phylogeny(rep_seqs, output_dir, threads, parttree, tree_tool, fastest):
     """Generar árbol filogenético a partir de secuencias representativas
 
     REP_SEQS: Ruta al artefacto QIIME2 de secuencias representativas (.qza)
@@ -305,19 +520,26 @@ def build_phylogeny(rep_seqs, output_dir):
 
     El proceso incluye:
       - Alineamiento múltiple con MAFFT
-      - Construcción de árbol con FastTree
+      - Construcción de árbol con VeryFastTree o FastTree
       - Enraizamiento del árbol
 
     Ejemplos:
       microbiome_cli.py make-phylogeny rep-seqs.qza
       microbiome_cli.py make-phylogeny rep-seqs.qza --output-dir my_phylogeny
+      microbiome_cli.py make-phylogeny rep-seqs.qza --threads 8 --parttree
+      microbiome_cli.py make-phylogeny rep-seqs.qza --tree-tool auto
+      microbiome_cli.py make-phylogeny rep-seqs.qza --tree-tool veryfasttree --fastest
     """
-    click.echo(f"🌳 Generando árbol filogenético...")
-    click.echo(f"🧬 Secuencias representativas: {rep_seqs}")
-    click.echo(f"📁 Directorio de salida: {output_dir}")
+    if threads:
+        limit_native_threads(threads)
+    from modules.phylogeny import make_phylogeny
+
+    log.info("cmd=%s in=%s out=%s params=%s", 'build-phylogeny', rep_seqs, output_dir,
+             dict(threads=threads, parttree=parttree, tree_tool=tree_tool, fastest=fastest))
 
     try:
-        unrooted_path, rooted_path = make_phylogeny(rep_seqs, output_dir)
+        unrooted_path, rooted_path = make_phylogeny(rep_seqs, output_dir, threads=threads or 'auto',
+                                                    parttree=parttree, tree_tool=tree_tool, fastest=fastest)
         click.echo(f"✅ Árbol filogenético generado exitosamente:")
         click.echo(f"   - Árbol sin raíz: {unrooted_path}")
         click.echo(f"   - Árbol con raíz: {rooted_path}")
@@ -331,9 +553,17 @@ def build_phylogeny(rep_seqs, output_dir):
               help='Métricas de diversidad alfa separadas por comas (por defecto: observed_features,shannon,faith_pd)')
 @click.option('--rooted-tree', type=click.Path(exists=True),
               help='Ruta al árbol filogenético enraizado (.qza) (necesario para faith_pd)')
+@click.option('--rarefaction-depth', type=int,
+              help='Profundidad de rarefacción; descarta las muestras con menos lecturas. Las métricas '
+                   'NumPy/scipy se promedian sobre --n-iterations rarefacciones; las de QIIME2 y UniFrac '
+                   'usan una única rarefacción (opcional)')
+@click.option('--n-iterations', default=10,
+              help='Número de rarefacciones a promediar con --rarefaction-depth (por defecto: 10)')
+@click.option('--sparse', is_flag=True,
+              help='Calcular las métricas sobre la tabla dispersa sin densificarla (ignorado con rarefacción)')
 @click.option('--output-dir', default='results/alpha_diversity',
               help='Directorio de salida (por defecto: results/alpha_diversity)')
-def alpha_diversity(table, metrics, rooted_tree, output_dir):
+def alpha_diversity(table, metrics, rooted_tree, rarefaction_depth, n_iterations, sparse, output_dir):
     """Calcular métricas de diversidad alfa
 
     TABLE: Ruta al artefacto QIIME2 de la tabla de características (.qza)
@@ -351,7 +581,12 @@ def alpha_diversity(table, metrics, rooted_tree, output_dir):
       microbiome_cli.py alpha-diversity table.qza --metrics observed_features,shannon
       microbiome_cli.py alpha-diversity table.qza --metrics faith_pd --rooted-tree rooted_tree.qza
       microbiome_cli.py alpha-diversity table.qza --metrics observed_features,shannon,simpson --output-dir my_alpha
+      microbiome_cli.py alpha-diversity table.qza --rarefaction-depth 10000 --n-iterations 20
+      microbiome_cli.py alpha-diversity table.qza --sparse
     """
+    from modules.alpha_diversity import calculate_alpha_diversity
+    from modules.artifact_cache import load_artifact
+
     click.echo(f"📊 Calculando diversidad alfa...")
     click.echo(f"📈 Tabla de características: {table}")
     click.echo(f"📏 Métricas: {metrics}")
@@ -360,7 +595,7 @@ def alpha_diversity(table, metrics, rooted_tree, output_dir):
     click.echo(f"📁 Directorio de salida: {output_dir}")
 
     # Convertir la cadena de métricas en una lista
-    metrics_list = [m.strip() for m in metrics.split(',')]
+    metrics_list = parse_metrics(metrics)
 
     # Verificar que si se incluye faith_pd, se proporcione un árbol enraizado
     if 'faith_pd' in metrics_list and not rooted_tree:
@@ -368,7 +603,10 @@ def alpha_diversity(table, metrics, rooted_tree, output_dir):
         return
 
     try:
-        output_files = calculate_alpha_diversity(table, metrics_list, output_dir, rooted_tree)
+        output_files = calculate_alpha_diversity(table, metrics_list, output_dir,
+                                                 load_artifact(rooted_tree) if rooted_tree else None,
+                                                 rarefaction_depth=rarefaction_depth, n_iterations=n_iterations,
+                                                 sparse=sparse)
         click.echo(f"✅ Diversidad alfa calculada exitosamente:")
         for file_path in output_files:
             click.echo(f"   - {file_path}")
@@ -389,9 +627,18 @@ def alpha_diversity(table, metrics, rooted_tree, output_dir):
               help='Ruta al archivo de metadatos (TSV) (necesario para PCoA)')
 @click.option('--hue',
               help='Columna en los metadatos para colorear los puntos en el PCoA')
+@click.option('--rarefaction-depth', type=int,
+              help='Profundidad de rarefacción; descarta las muestras con menos lecturas. Las métricas '
+                   'NumPy/scipy se promedian sobre --n-iterations rarefacciones; las de QIIME2 y UniFrac '
+                   'usan una única rarefacción (opcional)')
+@click.option('--n-iterations', default=10,
+              help='Número de rarefacciones a promediar con --rarefaction-depth (por defecto: 10)')
+@click.option('--use-qiime2', is_flag=True,
+              help='Calcular UniFrac con la acción de QIIME2 (conserva la provenance; más lento)')
 @click.option('--output-dir', default='results/beta_diversity',
               help='Directorio de salida (por defecto: results/beta_diversity)')
-def beta_diversity(table, metrics, phylo_metrics, rooted_tree, metadata, hue, output_dir):
+def beta_diversity(table, metrics, phylo_metrics, rooted_tree, metadata, hue, rarefaction_depth, n_iterations,
+                   use_qiime2, output_dir):
     """Calcular métricas de diversidad beta y generar gráficos PCoA
 
     TABLE: Ruta al artefacto QIIME2 de la tabla de características (.qza)
@@ -404,14 +651,20 @@ def beta_diversity(table, metrics, phylo_metrics, rooted_tree, metadata, hue, ou
       microbiome_cli.py beta-diversity table.qza --metrics braycurtis,jaccard
       microbiome_cli.py beta-diversity table.qza --metrics braycurtis --phylo-metrics unweighted_unifrac --rooted-tree rooted_tree.qza
       microbiome_cli.py beta-diversity table.qza --metrics braycurtis --metadata metadata.tsv --hue Treatment --output-dir my_beta
+      microbiome_cli.py beta-diversity table.qza --metrics braycurtis,jaccard --rarefaction-depth 10000
     """
+    from modules.beta_diversity import (
+        calculate_beta_diversity, calculate_phylogenetic_beta_diversity, plot_pcoa_batch
+    )
+    from modules.artifact_cache import load_artifact
+
     click.echo(f"📊 Calculando diversidad beta...")
     click.echo(f"📈 Tabla de características: {table}")
     click.echo(f"📏 Métricas no filogenéticas: {metrics}")
 
     # Convertir las cadenas de métricas en listas
-    metrics_list = [m.strip() for m in metrics.split(',')] if metrics else []
-    phylo_metrics_list = [m.strip() for m in phylo_metrics.split(',')] if phylo_metrics else []
+    metrics_list = parse_metrics(metrics)
+    phylo_metrics_list = parse_metrics(phylo_metrics)
 
     if phylo_metrics_list:
         click.echo(f"🌳 Métricas filogenéticas: {phylo_metrics}")
@@ -419,7 +672,7 @@ def beta_diversity(table, metrics, phylo_metrics, rooted_tree, metadata, hue, ou
             click.echo(f"🌳 Árbol enraizado: {rooted_tree}")
         else:
             click.echo("⚠️  Métricas filogenéticas especificadas pero no se proporcionó --rooted-tree. Se omitirán.")
-            phylo_metrics_list = []  # Limpiar la lista si no hay árbol
+            phylo_metrics_list = ()  # Limpiar la lista si no hay árbol
 
     if metadata:
         click.echo(f"📋 Metadatos: {metadata}")
@@ -430,9 +683,12 @@ def beta_diversity(table, metrics, phylo_metrics, rooted_tree, metadata, hue, ou
     all_distance_matrices = []
 
     try:
-        # Calcular diversidad beta no filogenética
+        # Calcular diversidad beta no filogenética (la matriz se mapea desde la
+        # caché de tablas; el artefacto solo se carga si hace falta QIIME2)
         if metrics_list:
-            csv_files, distance_matrices = calculate_beta_diversity(table, metrics_list, output_dir)
+            csv_files, distance_matrices = calculate_beta_diversity(table, metrics_list, output_dir,
+                                                                    rarefaction_depth=rarefaction_depth,
+                                                                    n_iterations=n_iterations)
             all_distance_matrices.extend(distance_matrices)
             for file_path in csv_files:
                 click.echo(f"✅ Matriz de distancia guardada: {file_path}")
@@ -440,7 +696,8 @@ def beta_diversity(table, metrics, phylo_metrics, rooted_tree, metadata, hue, ou
         # Calcular diversidad beta filogenética (solo si se proporciona árbol)
         if phylo_metrics_list and rooted_tree:
             csv_files, distance_matrices = calculate_phylogenetic_beta_diversity(
-                table, phylo_metrics_list, rooted_tree, output_dir
+                table, phylo_metrics_list, load_artifact(rooted_tree), output_dir,
+                use_qiime2=use_qiime2, rarefaction_depth=rarefaction_depth
             )
             all_distance_matrices.extend(distance_matrices)
             for file_path in csv_files:
@@ -449,15 +706,10 @@ def beta_diversity(table, metrics, phylo_metrics, rooted_tree, metadata, hue, ou
         # Generar gráficos PCoA si se proporcionan metadatos
         if metadata and hue and all_distance_matrices:
             click.echo(f"📈 Generando gráficos PCoA...")
-            for i, distance_matrix in enumerate(all_distance_matrices):
-                # Determinar el nombre de la métrica
-                if i < len(metrics_list):
-                    metric_name = metrics_list[i]
-                else:
-                    metric_name = phylo_metrics_list[i - len(metrics_list)]
-
-                pcoa_file = f"{output_dir}/pcoa_{metric_name}.png"
-                plot_pcoa(distance_matrix, metadata, hue, pcoa_file, metric_name)
+            metric_names = list(metrics_list) + list(phylo_metrics_list)
+            pcoa_files = plot_pcoa_batch(dict(zip(metric_names, all_distance_matrices)), metadata, hue,
+                                         output_dir)
+            for pcoa_file in pcoa_files:
                 click.echo(f"✅ Gráfico PCoA guardado: {pcoa_file}")
 
         click.echo("🎉 Análisis de diversidad beta completado exitosamente!")
@@ -471,12 +723,15 @@ def beta_diversity(table, metrics, phylo_metrics, rooted_tree, metadata, hue, ou
 @cli.command()
 @click.argument('table', type=click.Path(exists=True))
 @click.argument('rep_seqs', type=click.Path(exists=True))
-@click.option('--threads', default=1, help='Número de hilos a usar (por defecto: 1)')
+@click.option('--threads', default=0,
+              help='Número de procesos para PICRUSt2, 0 = todas las CPUs disponibles (por defecto: 0)')
 @click.option('--min-abundance', default=0.001,
-              help='Abundancia mínima para filtrar rutas metabólicas (por defecto: 0.001)')
+              help='Abundancia relativa media mínima para mantener una ruta metabólica (por defecto: 0.001)')
+@click.option('--keep-intermediate', is_flag=True,
+              help='Guardar también la tabla de rutas filtrada (.qza)')
 @click.option('--output-dir', default='results/picrust2',
               help='Directorio de salida (por defecto: results/picrust2)')
-def predict_metabolic_pathways(table, rep_seqs, threads, min_abundance, output_dir):
+def predict_metabolic_pathways(table, rep_seqs, threads, min_abundance, keep_intermediate, output_dir):
     """Inferir rutas metabólicas usando PICRUSt2
 
     TABLE: Ruta al artefacto QIIME2 de la tabla de características (.qza)
@@ -490,6 +745,13 @@ def predict_metabolic_pathways(table, rep_seqs, threads, min_abundance, output_d
       microbiome_cli.py predict-metabolic-pathways table.qza rep-seqs.qza --threads 4
       microbiome_cli.py predict-metabolic-pathways table.qza rep-seqs.qza --min-abundance 0.01 --output-dir my_picrust2
     """
+    from modules.picrust2 import (
+        check_picrust2_installation, run_picrust2, filter_and_normalize, PYARROW_AVAILABLE
+    )
+    from modules.utils import available_cpus
+
+    threads = threads or available_cpus()
+
     click.echo(f"🔬 Inferiendo rutas metabólicas con PICRUSt2...")
     click.echo(f"📊 Tabla de características: {table}")
     click.echo(f"🧬 Secuencias representativas: {rep_seqs}")
@@ -499,35 +761,34 @@ def predict_metabolic_pathways(table, rep_seqs, threads, min_abundance, output_d
 
     try:
         # Verificar instalación de PICRUSt2 primero
-        from modules.picrust2 import check_picrust2_installation
         if not check_picrust2_installation():
             click.echo("❌ PICRUSt2 no está instalado o no está en el PATH.")
             click.echo("💡 Instálalo con: conda install -c bioconda picrust2")
             return
 
         # Ejecutar PICRUSt2
+        # Con rutas, los datos se leen de la caché de .qza descomprimidos sin cargar artefactos
         results = run_picrust2(table, rep_seqs, output_dir, threads)
 
-        # Filtrar rutas de baja abundancia
-        filtered_pathways = filter_low_abundance_pathways(
-            results['pathway_abundance_qza'],
-            min_abundance
-        )
-
-        # Guardar tabla filtrada
-        filtered_pathways.save(os.path.join(output_dir, 'pathway_abundance_filtered.qza'))
-
-        # Normalizar abundancias
-        normalized_df = normalize_pathway_abundance(filtered_pathways)
+        # Filtrar rutas de baja abundancia y normalizar en una sola pasada
+        filtered_qza = os.path.join(output_dir, 'pathway_abundance_filtered.qza') if keep_intermediate else None
+        normalized_df = filter_and_normalize(results['pathway_abundance_table'], min_abundance, filtered_qza)
         normalized_csv = os.path.join(output_dir, 'pathway_abundance_normalized.csv')
-        normalized_df.to_csv(normalized_csv)
+        normalized_df.to_csv(normalized_csv, chunksize=50_000, lineterminator='\n')
+        normalized_parquet = None
+        if PYARROW_AVAILABLE:
+            normalized_parquet = os.path.join(output_dir, 'pathway_abundance_normalized.parquet')
+            normalized_df.to_parquet(normalized_parquet, engine='pyarrow', compression='zstd')
 
         click.echo(f"✅ Inferencia de rutas metabólicas completada:")
         click.echo(f"   - Abundancia de rutas (BIOM): {results['pathway_abundance_biom']}")
         click.echo(f"   - Abundancia de rutas (TSV): {results['pathway_abundance_tsv']}")
         click.echo(f"   - Abundancia de rutas (QZA): {results['pathway_abundance_qza']}")
-        click.echo(f"   - Rutas filtradas (QZA): {output_dir}/pathway_abundance_filtered.qza")
+        if filtered_qza:
+            click.echo(f"   - Rutas filtradas (QZA): {filtered_qza}")
         click.echo(f"   - Rutas normalizadas (CSV): {normalized_csv}")
+        if normalized_parquet:
+            click.echo(f"   - Rutas normalizadas (Parquet): {normalized_parquet}")
         click.echo(f"📈 Se identificaron {len(normalized_df)} rutas metabólicas")
 
     except Exception as e:
@@ -1,48 +1,185 @@
 # modules/alpha_diversity.py
-import tempfile
-import pathlib
+import numpy as np
 import pandas as pd
 import os
-from qiime2 import Artifact
+import functools
+from scipy.special import entr
 from qiime2.plugins.diversity.pipelines import alpha, alpha_phylogenetic
+from modules.rarefaction import rarefied_mean, rarefied_table, samples_at_depth
+from modules.artifact_cache import load_artifact, table_counts
+from modules.utils import is_path
 
 
-def calculate_alpha_diversity(table, metrics, output_folder, rooted_tree=None):
+def _observed_features(counts):
+    return (counts > 0).sum(axis=1)
+
+
+def _shannon(counts):
+    # Base 2, como el índice de Shannon de QIIME2/scikit-bio
+    totals = counts.sum(axis=1, keepdims=True)
+    p = np.divide(counts, totals, out=np.zeros_like(counts, dtype=float), where=totals > 0)
+    logp = np.log2(p, out=np.zeros_like(p), where=p > 0)
+    return -(p * logp).sum(axis=1)
+
+
+def _simpson(counts):
+    totals = counts.sum(axis=1, keepdims=True)
+    p = np.divide(counts, totals, out=np.zeros_like(counts, dtype=float), where=totals > 0)
+    return 1 - (p * p).sum(axis=1)
+
+
+def _pielou(counts):
+    observed = _observed_features(counts)
+    # Con una sola feature la uniformidad no está definida
+    return np.divide(_shannon(counts), np.log2(observed, out=np.zeros(observed.shape), where=observed > 0),
+                     out=np.full(observed.shape, np.nan), where=observed > 1)
+
+
+def _chao1(counts):
+    # Estimador con corrección de sesgo (valor por defecto en scikit-bio)
+    singles = (counts == 1).sum(axis=1)
+    doubles = (counts == 2).sum(axis=1)
+    return _observed_features(counts) + singles * (singles - 1) / (2 * (doubles + 1))
+
+
+# Métricas calculadas con NumPy sobre la matriz muestras x features; el resto
+# (p. ej. faith_pd) se delega en QIIME2
+NUMPY_METRICS = {
+    'observed_features': _observed_features,
+    'shannon': _shannon,
+    'simpson': _simpson,
+    'pielou': _pielou,
+    'pielou_e': _pielou,
+    'chao1': _chao1,
+}
+
+
+def _numpy_metrics(counts, metrics):
+    """Calcula varias métricas NumPy sobre una misma matriz"""
+    return {metric: NUMPY_METRICS[metric](counts) for metric in metrics}
+
+
+def _sparse_metrics(counts, metrics):
+    """Calcula las métricas de ``NUMPY_METRICS`` sobre una matriz CSR sin densificarla
+
+    Solo se recorren los conteos no nulos (``counts.data``); cada valor se
+    asigna a su muestra a partir de ``indptr`` y se acumula con ``bincount``.
+    """
+    n_samples = counts.shape[0]
+    rows = np.repeat(np.arange(n_samples), np.diff(counts.indptr))
+    data = counts.data.astype(float)
+
+    observed = np.diff(counts.indptr)
+    totals = np.bincount(rows, weights=data, minlength=n_samples)
+    p = data / totals[rows]
+    shannon = np.bincount(rows, weights=entr(p), minlength=n_samples) / np.log(2)
+
+    values = {}
+    for metric in metrics:
+        if metric == 'observed_features':
+            values[metric] = observed
+        elif metric == 'shannon':
+            values[metric] = shannon
+        elif metric == 'simpson':
+            values[metric] = 1 - np.bincount(rows, weights=p * p, minlength=n_samples)
+        elif metric in ('pielou', 'pielou_e'):
+            values[metric] = np.divide(shannon, np.log2(observed, out=np.zeros(n_samples), where=observed > 0),
+                                       out=np.full(n_samples, np.nan), where=observed > 1)
+        elif metric == 'chao1':
+            singles = np.bincount(rows, weights=data == 1, minlength=n_samples)
+            doubles = np.bincount(rows, weights=data == 2, minlength=n_samples)
+            values[metric] = observed + singles * (singles - 1) / (2 * (doubles + 1))
+    return values
+
+
+def _qiime2_alpha(table, metric, rooted_tree=None):
+    """Calcula una métrica alfa con QIIME2 y la devuelve como DataFrame"""
+    if metric == 'faith_pd':
+        alpha_calculator = alpha_phylogenetic(table=table, phylogeny=rooted_tree, metric='faith_pd')
+    else:
+        alpha_calculator = alpha(table=table, metric=metric)
+
+    # Vista en memoria como Series: sin exportar ni releer un TSV
+    series = alpha_calculator.alpha_diversity.view(pd.Series)
+    return series.rename(metric).rename_axis('').reset_index()
+
+
+def calculate_alpha_diversity(table, metrics, output_folder, rooted_tree=None, rarefaction_depth=None,
+                              n_iterations=10, sparse=False):
     """Calcula la diversidad alfa para una lista de métricas.
 
+    Las métricas no filogenéticas habituales se calculan en una sola pasada
+    con NumPy sobre la tabla densificada una vez; faith_pd y las métricas no
+    incluidas en ``NUMPY_METRICS`` se calculan con QIIME2.
+
+    Con ``rarefaction_depth`` las métricas NumPy se promedian sobre
+    ``n_iterations`` rarefacciones en paralelo, descartando las muestras con
+    menos lecturas que la profundidad. Las métricas delegadas en QIIME2 se
+    calculan sobre una única rarefacción a la misma profundidad, con las
+    mismas muestras.
+
+    Con ``sparse=True`` (y sin rarefacción) las métricas NumPy se calculan
+    sobre la matriz CSR de la tabla, sin densificarla.
+
     Args:
-        table: Ruta al artefacto QIIME2 de la tabla de características o el artefacto mismo.
+        table: Ruta al artefacto QIIME2 de la tabla de características o el artefacto mismo
+            (con una ruta, las métricas NumPy usan la matriz mapeada en caché).
         metrics: Lista de métricas de diversidad alfa a calcular.
         output_folder: Directorio donde se guardarán los archivos CSV resultantes.
         rooted_tree: Ruta al artefacto QIIME2 del árbol filogenético enraizado (necesario para faith_pd).
+        rarefaction_depth: Profundidad de rarefacción (None = sin rarefacción).
+        n_iterations: Número de rarefacciones a promediar.
+        sparse: Calcular las métricas NumPy sobre la matriz dispersa.
 
     Returns:
         list: Rutas a los archivos CSV generados
     """
     os.makedirs(output_folder, exist_ok=True)
 
-    # Cargar artefactos si se pasan como strings
-    if isinstance(table, str):
-        table = Artifact.load(table)
-    if rooted_tree and isinstance(rooted_tree, str):
-        rooted_tree = Artifact.load(rooted_tree)
+    # Cargar artefactos si se pasan como rutas; la tabla solo se carga si
+    # alguna métrica se delega en QIIME2
+    if rooted_tree and is_path(rooted_tree):
+        rooted_tree = load_artifact(rooted_tree)
 
-    diversity = []
-    for metric in metrics:
-        if metric == 'faith_pd':
-            if not rooted_tree:
-                raise ValueError("La métrica 'faith_pd' requiere un árbol filogenético enraizado.")
-            alpha_calculator = alpha_phylogenetic(table=table, phylogeny=rooted_tree, metric='faith_pd')
+    numpy_metrics = tuple(metric for metric in metrics if metric in NUMPY_METRICS)
+    numpy_values = {}
+    if numpy_metrics and sparse and not rarefaction_depth:
+        sample_ids, _, counts = table_counts(table, sparse=True)
+        numpy_values = _sparse_metrics(counts, numpy_metrics)
+    elif numpy_metrics:
+        # Con una ruta, la matriz se mapea desde la caché compartida entre comandos
+        sample_ids, _, counts = table_counts(table)
+
+        if rarefaction_depth:
+            keep = samples_at_depth(counts, rarefaction_depth)
+            if not keep.all():
+                print(f"⚠️  {int((~keep).sum())} muestras con menos de {rarefaction_depth} lecturas se descartan")
+            sample_ids, counts = sample_ids[keep], counts[keep]
+            numpy_values = rarefied_mean(counts, rarefaction_depth, n_iterations,
+                                         functools.partial(_numpy_metrics, metrics=numpy_metrics))
         else:
-            alpha_calculator = alpha(table=table, metric=metric)
+            numpy_values = _numpy_metrics(counts, numpy_metrics)
+
+    # Las métricas delegadas en QIIME2 se calculan una a una: las acciones de
+    # QIIME2 no son seguras entre hilos de un mismo proceso
+    qiime2_metrics = [metric for metric in metrics if metric not in NUMPY_METRICS]
+    qiime2_values = {}
+    if qiime2_metrics:
+        if 'faith_pd' in qiime2_metrics and not rooted_tree:
+            raise ValueError("La métrica 'faith_pd' requiere un árbol filogenético enraizado.")
+        if rarefaction_depth:
+            print(f"ℹ️  {', '.join(qiime2_metrics)}: una única rarefacción a {rarefaction_depth} lecturas")
+            table = rarefied_table(table, rarefaction_depth)
+        elif is_path(table):
+            table = load_artifact(table)
+
+        qiime2_values = {metric: _qiime2_alpha(table, metric, rooted_tree) for metric in qiime2_metrics}
 
-        with tempfile.TemporaryDirectory() as tmpdir:
-            alpha_calculator.alpha_diversity.export_data(tmpdir)
-            alpha_dir_fp = pathlib.Path(tmpdir)
-            csv_file = sorted(alpha_dir_fp.glob('*.tsv'))
-            for csv in csv_file:
-                df_lista = pd.read_table(csv, index_col=False)
-                diversity.append(df_lista)
+    diversity = [
+        pd.DataFrame({'': sample_ids, metric: numpy_values[metric]}) if metric in NUMPY_METRICS
+        else qiime2_values[metric]
+        for metric in metrics
+    ]
 
     # Guardar cada métrica en un archivo CSV
     output_files = []
@@ -52,4 +189,4 @@ def calculate_alpha_diversity(table, metrics, output_folder, rooted_tree=None):
         data.to_csv(diversity_path, index=False)
         output_files.append(diversity_path)
 
-    return output_files
\ No newline at end of file
+    return output_files
@@ -0,0 +1,359 @@
+"""
+Cachés de artefactos QIIME2: extracciones de .qza direccionadas por contenido,
+tablas de frecuencias mapeadas en memoria y artefactos ya cargados en memoria
+
+La caché vive en ``~/.microbiome_cache`` (o en ``MICROBIOME_CACHE_DIR``), se
+desactiva con ``MICROBIOME_NO_CACHE=1`` (``--no-cache`` en la CLI) y no
+supera ``MICROBIOME_CACHE_MAX_GB`` gigabytes: al añadir una entrada se
+eliminan las menos usadas recientemente.
+"""
+import atexit
+import functools
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import zipfile
+from pathlib import Path
+
+from modules.utils import is_path
+
+try:
+    import orjson
+
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+DEFAULT_CACHE_DIR = "~/.microbiome_cache"
+DEFAULT_CACHE_MAX_GB = 20
+CACHE_DIR_ENV = 'MICROBIOME_CACHE_DIR'
+CACHE_DISABLE_ENV = 'MICROBIOME_NO_CACHE'
+CACHE_MAX_GB_ENV = 'MICROBIOME_CACHE_MAX_GB'
+READ_BLOCK_SIZE = 1 << 20
+
+
+def cache_enabled():
+    """False si la caché en disco está desactivada (``MICROBIOME_NO_CACHE``)"""
+    return os.environ.get(CACHE_DISABLE_ENV, '').lower() in ('', '0', 'false', 'no')
+
+
+def _cache_root(cache_dir=None):
+    return Path(cache_dir or os.environ.get(CACHE_DIR_ENV) or DEFAULT_CACHE_DIR).expanduser()
+
+
+def cache_subdir(name, cache_dir=None):
+    """Subdirectorio ``name`` de la caché (creado si hace falta) o None si está desactivada
+
+    Args:
+        name: Subdirectorio ('qza', 'tables', 'deblur'...)
+        cache_dir: Raíz de la caché; por defecto ``MICROBIOME_CACHE_DIR`` o
+            ``DEFAULT_CACHE_DIR``
+    """
+    if not cache_enabled():
+        return None
+    path = _cache_root(cache_dir) / name
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def touch_entry(path):
+    """Marca una entrada de la caché como usada ahora (orden de expulsión LRU)"""
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+
+def _entry_size(path):
+    if not path.is_dir():
+        return path.stat().st_size
+    return sum((Path(root) / name).stat().st_size for root, _, files in os.walk(path) for name in files)
+
+
+def evict_cache(cache_dir=None, max_bytes=None, keep=()):
+    """Elimina las entradas menos usadas hasta que la caché ocupe como mucho ``max_bytes``
+
+    Cada archivo o directorio dentro de un subdirectorio de la caché es una
+    entrada; las entradas de ``keep`` (recién creadas o en uso) no se tocan.
+
+    Args:
+        cache_dir: Raíz de la caché (por defecto la configurada)
+        max_bytes: Tamaño máximo; por defecto ``MICROBIOME_CACHE_MAX_GB``
+        keep: Rutas de entradas que no deben eliminarse
+    """
+    if not cache_enabled():
+        return
+    root = _cache_root(cache_dir)
+    if max_bytes is None:
+        max_bytes = float(os.environ.get(CACHE_MAX_GB_ENV, DEFAULT_CACHE_MAX_GB)) * 1e9
+    keep = {Path(path) for path in keep}
+
+    entries = []
+    for subdir in root.iterdir() if root.exists() else ():
+        if not subdir.is_dir():
+            continue
+        for entry in subdir.iterdir():
+            if entry.name.startswith('.partial-'):
+                continue
+            try:
+                entries.append((entry.stat().st_mtime, _entry_size(entry), entry))
+            except OSError:
+                continue
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, entry in sorted(entries):
+        if total <= max_bytes:
+            break
+        if entry in keep:
+            continue
+        if entry.is_dir():
+            shutil.rmtree(entry, ignore_errors=True)
+        else:
+            entry.unlink(missing_ok=True)
+        total -= size
+
+
+def file_digest(path):
+    """Calcula el SHA-256 de un archivo
+
+    Usa ``hashlib.file_digest`` (Python 3.11+) cuando está disponible; si no,
+    lee el archivo por bloques.
+    """
+    with open(path, 'rb') as f:
+        if hasattr(hashlib, 'file_digest'):
+            return hashlib.file_digest(f, 'sha256').hexdigest()
+
+        digest = hashlib.sha256()
+        for block in iter(lambda: f.read(READ_BLOCK_SIZE), b''):
+            digest.update(block)
+        return digest.hexdigest()
+
+
+def cached_file_digest(path, cache_dir=None):
+    """SHA-256 de un archivo, recordado por ruta, tamaño y fecha de modificación
+
+    Solo se lee el archivo completo la primera vez (o si ha cambiado); con la
+    caché desactivada se calcula siempre.
+    """
+    digests_dir = cache_subdir('digests', cache_dir)
+    if digests_dir is None:
+        return file_digest(path)
+
+    index = digests_dir / _path_cache_key(path)
+    if index.exists():
+        return index.read_text()
+
+    digest = file_digest(path)
+    _write_atomic(index, digest.encode())
+    return digest
+
+
+def _write_atomic(path, data):
+    """Escribe ``data`` (bytes) en ``path`` mediante un temporal y un renombrado atómico"""
+    fd, tmp_path = tempfile.mkstemp(dir=Path(path).parent, prefix='.partial-')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def link_or_copy(source, target):
+    """Enlaza ``source`` en ``target`` (enlace duro) o lo copia si están en otro sistema de archivos"""
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copy2(source, target)
+
+
+def unzip_qza_cached(qza_path, output_dir=None, cache_dir=None):
+    """Descomprime un .qza reutilizando extracciones previas del mismo contenido
+
+    La primera vez el artefacto se extrae en ``<caché>/qza/<sha256>/``; las
+    siguientes, si el archivo no ha cambiado (ruta, tamaño y fecha), ni
+    siquiera se recalcula el hash. Si se indica ``output_dir`` el contenido
+    se materializa allí con enlaces duros (o copias si la caché está en otro
+    sistema de archivos).
+
+    Con la caché desactivada el artefacto se extrae directamente en
+    ``output_dir`` o, si no se indica, en un directorio temporal que se
+    elimina al terminar el proceso.
+
+    Args:
+        qza_path: Ruta al artefacto .qza
+        output_dir: Directorio donde materializar el contenido (opcional)
+        cache_dir: Directorio raíz de la caché
+
+    Returns:
+        Path: Directorio con el contenido descomprimido (tratar como solo
+        lectura si es el de la caché)
+    """
+    cache_root = cache_subdir('qza', cache_dir)
+    if cache_root is None:
+        if output_dir is None:
+            output_dir = tempfile.mkdtemp(prefix='microbiome-qza-')
+            atexit.register(shutil.rmtree, output_dir, ignore_errors=True)
+        with zipfile.ZipFile(qza_path) as zf:
+            zf.extractall(output_dir)
+        return Path(output_dir)
+
+    cached = cache_root / cached_file_digest(qza_path, cache_dir)
+
+    if cached.exists():
+        touch_entry(cached)
+    else:
+        # Extraer en un directorio temporal y renombrar de forma atómica para
+        # que una ejecución interrumpida no deje una entrada incompleta
+        tmpdir = tempfile.mkdtemp(dir=cache_root, prefix='.partial-')
+        try:
+            with zipfile.ZipFile(qza_path) as zf:
+                zf.extractall(tmpdir)
+            os.replace(tmpdir, cached)
+        except OSError:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+            # Otra ejecución pudo completar la misma entrada en paralelo
+            if not cached.exists():
+                raise
+        evict_cache(cache_dir, keep=[cached])
+
+    if output_dir is None:
+        return cached
+
+    output_path = Path(output_dir)
+    for root, _, files in os.walk(cached):
+        target_root = output_path / Path(root).relative_to(cached)
+        target_root.mkdir(parents=True, exist_ok=True)
+        for name in files:
+            link_or_copy(Path(root) / name, target_root / name)
+
+    return output_path
+
+
+@functools.lru_cache(maxsize=8)
+def _load_artifact(path, mtime):
+    from qiime2 import Artifact
+
+    return Artifact.load(path)
+
+
+def load_artifact(path):
+    """Carga un artefacto QIIME2 reutilizando cargas previas del mismo archivo
+
+    La caché se indexa por ruta absoluta y fecha de modificación, de modo que
+    un artefacto reescrito en disco se vuelve a cargar.
+    """
+    path = os.path.abspath(path)
+    return _load_artifact(path, os.path.getmtime(path))
+
+
+def load_artifact_q2cache(path, cache_dir=None):
+    """Carga un artefacto a través de un ``qiime2.Cache`` persistente en disco
+
+    El directorio se toma de ``cache_dir`` o de la variable de entorno
+    ``Q2_CACHE``; si no hay ninguno (o la versión de QIIME2 no tiene
+    ``Cache``) se usa :func:`load_artifact`. La primera carga guarda el
+    artefacto en la caché y las siguientes, incluso desde otros procesos o
+    comandos, lo referencian allí sin volver a descomprimir el .qza.
+    """
+    cache_dir = cache_dir or os.environ.get('Q2_CACHE')
+    if not cache_dir:
+        return load_artifact(path)
+
+    try:
+        from qiime2 import Cache
+    except ImportError:
+        return load_artifact(path)
+
+    cache = Cache(cache_dir)
+    # Las claves de qiime2.Cache deben ser identificadores válidos
+    key = f"artifact_{_path_cache_key(path)}"
+    if cache.has_key(key):
+        return cache.load(key)
+    return cache.save(load_artifact(path), key)
+
+
+def _write_json(path, data):
+    """Escribe de forma atómica un JSON pequeño con orjson (bytes directos) o, si no está, con json"""
+    if ORJSON_AVAILABLE:
+        _write_atomic(path, orjson.dumps(data))
+    else:
+        _write_atomic(path, json.dumps(data).encode())
+
+
+def _read_json(path):
+    if ORJSON_AVAILABLE:
+        return orjson.loads(Path(path).read_bytes())
+    return json.loads(Path(path).read_text())
+
+
+def _path_cache_key(path):
+    """Clave de caché de un archivo: ruta absoluta, tamaño y fecha de modificación"""
+    stat = os.stat(path)
+    key = f"{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}"
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def table_counts(table, cache_dir=None, sparse=False):
+    """Matriz muestras x features de una tabla de frecuencias
+
+    Si ``table`` es la ruta a un .qza, la primera vez la tabla BIOM se
+    densifica y se guarda como ``.npy`` en ``<caché>/tables/`` (con los IDs
+    en un JSON adjunto); las siguientes llamadas, desde este u otro comando,
+    solo mapean el archivo en memoria sin descomprimir ni parsear el HDF5.
+    Estas copias densas cuentan para el límite de tamaño de la caché; con la
+    caché desactivada la tabla se densifica en memoria en cada llamada.
+
+    Con ``sparse=True`` se devuelve la matriz CSR de la tabla BIOM sin
+    densificarla (útil para tablas 16S grandes y muy dispersas).
+
+    Args:
+        table: Ruta al .qza FeatureTable[Frequency] o el artefacto mismo
+        cache_dir: Directorio raíz de la caché
+        sparse: Devolver una matriz ``scipy.sparse.csr_matrix``
+
+    Returns:
+        tuple: (IDs de muestra, IDs de feature, matriz muestras x features)
+    """
+    import biom
+    import numpy as np
+
+    if sparse or not cache_enabled() or not is_path(table):
+        if is_path(table):
+            biom_file = next(unzip_qza_cached(table, cache_dir=cache_dir).glob('*/data/feature-table.biom'))
+            biom_table = biom.load_table(str(biom_file))
+        else:
+            biom_table = table.view(biom.Table)
+        matrix = biom_table.matrix_data.T.tocsr()
+        return (biom_table.ids(axis='sample'), biom_table.ids(axis='observation'),
+                matrix if sparse else matrix.toarray())
+
+    tables_dir = cache_subdir('tables', cache_dir)
+    # Prefijo por ruta: al reescribirse la tabla, su versión anterior se borra
+    path_prefix = hashlib.sha256(os.path.abspath(table).encode()).hexdigest()[:16]
+    key = f"{path_prefix}-{_path_cache_key(table)}"
+    npy_path, ids_path = tables_dir / f"{key}.npy", tables_dir / f"{key}.json"
+
+    if not (npy_path.exists() and ids_path.exists()):
+        for stale in tables_dir.glob(f"{path_prefix}-*"):
+            stale.unlink(missing_ok=True)
+        biom_file = next(unzip_qza_cached(table, cache_dir=cache_dir).glob('*/data/feature-table.biom'))
+        biom_table = biom.load_table(str(biom_file))
+        ids = {
+            'samples': biom_table.ids(axis='sample').tolist(),
+            'features': biom_table.ids(axis='observation').tolist(),
+        }
+        # Escrituras atómicas, el JSON antes que el .npy: un .npy publicado
+        # siempre tiene sus IDs completos al lado
+        _write_json(ids_path, ids)
+        fd, tmp_path = tempfile.mkstemp(dir=tables_dir, prefix='.partial-', suffix='.npy')
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, biom_table.matrix_data.T.toarray())
+        os.replace(tmp_path, npy_path)
+        evict_cache(cache_dir, keep=[npy_path, ids_path])
+    else:
+        touch_entry(npy_path)
+        touch_entry(ids_path)
+
+    ids = _read_json(ids_path)
+    counts = np.load(npy_path, mmap_mode='r')
+    return np.array(ids['samples'], dtype=object), np.array(ids['features'], dtype=object), counts
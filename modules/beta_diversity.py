@@ -1,127 +1,305 @@
 # modules/beta_diversity.py
-import tempfile
-import pathlib
-import pandas as pd
+import matplotlib
+
+# Backend no interactivo: los gráficos PCoA solo se guardan a archivo
+matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 import os
-from qiime2 import Artifact
+import functools
+from scipy.spatial.distance import pdist, squareform
+from skbio import DistanceMatrix
+from skbio.stats.ordination import pcoa as skbio_pcoa
+from qiime2 import Artifact, Metadata
 from qiime2.plugins.diversity.pipelines import beta, beta_phylogenetic
 from qiime2.plugins.diversity.methods import pcoa
+from modules.rarefaction import rarefied_mean, rarefied_table, samples_at_depth
+from modules.artifact_cache import load_artifact, table_counts
+from modules.utils import is_path
 import dokdo
 
+try:
+    from joblib import Parallel, delayed
+
+    JOBLIB_AVAILABLE = True
+except ImportError:
+    JOBLIB_AVAILABLE = False
+
+try:
+    import unifrac
+
+    UNIFRAC_AVAILABLE = True
+except ImportError:
+    UNIFRAC_AVAILABLE = False
+
+
+# Métricas no filogenéticas calculadas directamente con scipy (bucle en C);
+# el resto se delega en QIIME2
+SCIPY_METRICS = {
+    'braycurtis': 'braycurtis',
+    'jaccard': 'jaccard',
+    'euclidean': 'euclidean',
+    'manhattan': 'cityblock',
+    'canberra': 'canberra',
+    'chebyshev': 'chebyshev',
+    'cosine': 'cosine',
+    'correlation': 'correlation',
+}
+# Métricas que QIIME2 evalúa sobre presencia/ausencia
+BINARY_METRICS = {'jaccard'}
+
+# Métricas filogenéticas de beta_phylogenetic y su función en la biblioteca
+# unifrac (Striped UniFrac), que QIIME2 usa por debajo
+UNIFRAC_METRICS = {
+    'unweighted_unifrac': 'unweighted',
+    'weighted_unifrac': 'weighted_unnormalized',
+    'weighted_normalized_unifrac': 'weighted_normalized',
+    'generalized_unifrac': 'generalized',
+}
+
+
+def _scipy_distances(counts, metrics):
+    """Calcula las distancias condensadas de varias métricas scipy sobre una matriz"""
+    return {
+        metric: pdist(counts > 0 if metric in BINARY_METRICS else counts, metric=SCIPY_METRICS[metric])
+        for metric in metrics
+    }
 
-def calculate_beta_diversity(table, metrics, output_dir):
+
+def calculate_beta_diversity(table, metrics, output_dir, rarefaction_depth=None, n_iterations=10):
     """Calcula matrices de distancia beta no filogenéticas.
 
+    La tabla se densifica una sola vez (muestras x features) y las métricas
+    soportadas por scipy se calculan con ``pdist``; las demás se delegan en
+    la acción ``beta`` de QIIME2, en paralelo entre métricas.
+
+    Con ``rarefaction_depth`` las distancias scipy se promedian sobre
+    ``n_iterations`` rarefacciones en paralelo, descartando las muestras con
+    menos lecturas que la profundidad. Las métricas delegadas en QIIME2 se
+    calculan sobre una única rarefacción a la misma profundidad, con las
+    mismas muestras.
+
     Args:
-        table: Ruta al artefacto QIIME2 de la tabla de características o el artefacto mismo.
+        table: Ruta al artefacto QIIME2 de la tabla de características o el artefacto mismo
+            (con una ruta, las métricas scipy usan la matriz mapeada en caché).
         metrics: Lista de métricas de distancia beta.
         output_dir: Directorio donde guardar los resultados.
+        rarefaction_depth: Profundidad de rarefacción (None = sin rarefacción).
+        n_iterations: Número de rarefacciones a promediar.
 
     Returns:
         list: Rutas a las matrices de distancia guardadas
     """
     os.makedirs(output_dir, exist_ok=True)
 
-    if isinstance(table, str):
-        table = Artifact.load(table)
+    scipy_metrics = tuple(metric for metric in metrics if metric in SCIPY_METRICS)
+    distances = {}
+    if scipy_metrics:
+        # Con una ruta, la matriz se mapea desde la caché compartida entre comandos
+        sample_ids, _, counts = table_counts(table)
+
+        if rarefaction_depth:
+            keep = samples_at_depth(counts, rarefaction_depth)
+            if not keep.all():
+                print(f"⚠️  {int((~keep).sum())} muestras con menos de {rarefaction_depth} lecturas se descartan")
+            sample_ids, counts = sample_ids[keep], counts[keep]
+            distances = rarefied_mean(counts, rarefaction_depth, n_iterations,
+                                      functools.partial(_scipy_distances, metrics=scipy_metrics))
+        else:
+            distances = _scipy_distances(counts, scipy_metrics)
+
+    # Las métricas delegadas en QIIME2 se calculan una a una, cada una con
+    # todas las CPUs (n_jobs='auto'): las acciones de QIIME2 no son seguras
+    # entre hilos de un mismo proceso
+    qiime2_metrics = [metric for metric in metrics if metric not in SCIPY_METRICS]
+    qiime2_results = {}
+    if qiime2_metrics:
+        if rarefaction_depth:
+            print(f"ℹ️  {', '.join(qiime2_metrics)}: una única rarefacción a {rarefaction_depth} lecturas")
+            table = rarefied_table(table, rarefaction_depth)
+        elif is_path(table):
+            table = load_artifact(table)
+        results = [beta(table=table, metric=metric, n_jobs='auto') for metric in qiime2_metrics]
+        qiime2_results = {metric: result.distance_matrix for metric, result in zip(qiime2_metrics, results)}
 
     distance_matrices = []
     output_files = []
 
     for metric in metrics:
-        beta_calculator = beta(table=table, metric=metric, n_jobs='auto')
-        distance_matrix = beta_calculator.distance_matrix
+        if metric in SCIPY_METRICS:
+            dm = DistanceMatrix(squareform(distances[metric]), ids=sample_ids)
+            distance_matrix = Artifact.import_data('DistanceMatrix', dm)
+        else:
+            distance_matrix = qiime2_results[metric]
+            dm = distance_matrix.view(DistanceMatrix)
 
         # Guardar matriz de distancia
         matrix_path = f"{output_dir}/{metric}_distance_matrix.qza"
         distance_matrix.save(matrix_path)
         distance_matrices.append(distance_matrix)
 
-        # Exportar a CSV
-        with tempfile.TemporaryDirectory() as tmpdir:
-            distance_matrix.export_data(tmpdir)
-            beta_dir_fp = pathlib.Path(tmpdir)
-            csv_file = list(beta_dir_fp.glob('*.tsv'))[0]
-            df = pd.read_table(csv_file, index_col=0)
-            csv_path = f"{output_dir}/{metric}_distance_matrix.csv"
-            df.to_csv(csv_path)
-            output_files.append(csv_path)
+        # Exportar a CSV directamente desde la matriz, sin pasar por el TSV exportado
+        csv_path = f"{output_dir}/{metric}_distance_matrix.csv"
+        dm.to_data_frame().to_csv(csv_path)
+        output_files.append(csv_path)
 
     return output_files, distance_matrices
 
 
-def calculate_phylogenetic_beta_diversity(table, metrics, rooted_tree, output_dir):
+def calculate_phylogenetic_beta_diversity(table, metrics, rooted_tree, output_dir, use_qiime2=False,
+                                          rarefaction_depth=None):
     """Calcula matrices de distancia beta filogenéticas.
 
+    Las métricas UniFrac se calculan llamando directamente a la biblioteca
+    ``unifrac`` sobre el BIOM y el Newick de los artefactos, sin pasar por la
+    acción de QIIME2. Con ``use_qiime2=True`` (o si ``unifrac`` no está
+    disponible) se usa ``beta_phylogenetic``, que registra la provenance.
+
+    Con ``rarefaction_depth`` todas las métricas se calculan sobre una única
+    rarefacción de la tabla, descartando las muestras con menos lecturas
+    (las mismas que en :func:`calculate_beta_diversity`).
+
     Args:
         table: Ruta al artefacto QIIME2 de la tabla de características o el artefacto mismo.
         metrics: Lista de métricas de distancia beta filogenéticas.
         rooted_tree: Ruta al artefacto QIIME2 del árbol filogenético enraizado.
         output_dir: Directorio donde guardar los resultados.
+        use_qiime2: Forzar la acción de QIIME2 para conservar la provenance.
+        rarefaction_depth: Profundidad de rarefacción (None = sin rarefacción).
 
     Returns:
         list: Rutas a las matrices de distancia guardadas
     """
     os.makedirs(output_dir, exist_ok=True)
 
-    if isinstance(table, str):
-        table = Artifact.load(table)
-    if isinstance(rooted_tree, str):
-        rooted_tree = Artifact.load(rooted_tree)
+    if rarefaction_depth:
+        print(f"ℹ️  {', '.join(metrics)}: una única rarefacción a {rarefaction_depth} lecturas")
+        table = rarefied_table(table, rarefaction_depth)
+    elif is_path(table):
+        table = load_artifact(table)
+    if is_path(rooted_tree):
+        rooted_tree = load_artifact(rooted_tree)
+
+    direct = UNIFRAC_AVAILABLE and not use_qiime2
+    if direct:
+        # Ver los artefactos en su propio formato da sus directorios de datos sin copiar
+        table_fp = os.path.join(str(table.view(table.format)), 'feature-table.biom')
+        tree_fp = os.path.join(str(rooted_tree.view(rooted_tree.format)), 'tree.nwk')
 
     distance_matrices = []
     output_files = []
 
     for metric in metrics:
-        beta_calculator = beta_phylogenetic(
-            table=table,
-            metric=metric,
-            threads='auto',
-            phylogeny=rooted_tree
-        )
-        distance_matrix = beta_calculator.distance_matrix
+        if direct and metric in UNIFRAC_METRICS:
+            dm = getattr(unifrac, UNIFRAC_METRICS[metric])(table_fp, tree_fp)
+            distance_matrix = Artifact.import_data('DistanceMatrix', dm)
+        else:
+            beta_calculator = beta_phylogenetic(
+                table=table,
+                metric=metric,
+                threads='auto',
+                phylogeny=rooted_tree
+            )
+            distance_matrix = beta_calculator.distance_matrix
+            dm = distance_matrix.view(DistanceMatrix)
 
         # Guardar matriz de distancia
         matrix_path = f"{output_dir}/{metric}_distance_matrix.qza"
         distance_matrix.save(matrix_path)
         distance_matrices.append(distance_matrix)
 
-        # Exportar a CSV
-        with tempfile.TemporaryDirectory() as tmpdir:
-            distance_matrix.export_data(tmpdir)
-            beta_dir_fp = pathlib.Path(tmpdir)
-            csv_file = list(beta_dir_fp.glob('*.tsv'))[0]
-            df = pd.read_table(csv_file, index_col=0)
-            csv_path = f"{output_dir}/{metric}_distance_matrix.csv"
-            df.to_csv(csv_path)
-            output_files.append(csv_path)
+        # Exportar a CSV directamente desde la matriz
+        csv_path = f"{output_dir}/{metric}_distance_matrix.csv"
+        dm.to_data_frame().to_csv(csv_path)
+        output_files.append(csv_path)
 
     return output_files, distance_matrices
 
 
-def plot_pcoa(distance_matrix, metadata, hue, output_file, metric_name):
+def plot_pcoa(distance_matrix, metadata, hue, output_file, metric_name, ax=None):
     """Genera gráfico PCoA a partir de una matriz de distancia.
 
     Args:
         distance_matrix: Artefacto QIIME2 de matriz de distancia.
-        metadata: Ruta al archivo de metadatos.
+        metadata: Ruta al archivo de metadatos u objeto ``qiime2.Metadata`` ya cargado.
         hue: Columna en los metadatos para colorear los puntos.
         output_file: Ruta del archivo de salida para el gráfico.
         metric_name: Nombre de la métrica de distancia.
+        ax: Ejes a reutilizar entre gráficos (se limpian antes de dibujar);
+            si es None se crea y se cierra una figura propia.
     """
-    if isinstance(distance_matrix, str):
-        distance_matrix = Artifact.load(distance_matrix)
+    if is_path(distance_matrix):
+        distance_matrix = load_artifact(distance_matrix)
+    if is_path(metadata):
+        metadata = Metadata.load(metadata)
 
     # Realizar PCoA usando el método de QIIME2
     pcoa_result = pcoa(distance_matrix)
 
     # Crear gráfico usando dokdo
-    fig, ax = plt.subplots(figsize=(8, 8))
+    own_figure = ax is None
+    if own_figure:
+        fig, ax = plt.subplots(figsize=(8, 8))
+    else:
+        ax.clear()
+        fig = ax.figure
     dokdo.beta_2d_plot(pcoa_result.pcoa, metadata=metadata, hue=hue, ax=ax)
     ax.set_title(f'PCoA - {metric_name}')
-    plt.tight_layout()
-    plt.savefig(output_file, dpi=300, bbox_inches='tight')
-    plt.close()
+    fig.tight_layout()
+    fig.savefig(output_file, dpi=300, bbox_inches='tight')
+    if own_figure:
+        plt.close(fig)
+
+    return output_file
+
+
+def _ordinate(distance_matrix):
+    """PCoA de scikit-bio sobre una matriz en memoria (artefacto o DistanceMatrix)"""
+    if not isinstance(distance_matrix, DistanceMatrix):
+        distance_matrix = distance_matrix.view(DistanceMatrix)
+    return skbio_pcoa(distance_matrix)
+
+
+def plot_pcoa_batch(distance_matrices, metadata, hue, output_dir):
+    """Genera los gráficos PCoA de varias matrices de distancia.
+
+    Las ordenaciones se calculan en paralelo con ``skbio.stats.ordination.pcoa``
+    directamente sobre las matrices en memoria, sin despachar la acción
+    ``pcoa`` de QIIME2 por cada una; los metadatos se cargan una vez y todos
+    los gráficos reutilizan la misma figura.
+
+    Args:
+        distance_matrices: Diccionario {métrica: artefacto DistanceMatrix o skbio.DistanceMatrix}.
+        metadata: Ruta al archivo de metadatos u objeto ``qiime2.Metadata`` ya cargado.
+        hue: Columna en los metadatos para colorear los puntos.
+        output_dir: Directorio donde guardar los gráficos ``pcoa_<métrica>.png``.
+
+    Returns:
+        list: Rutas a los gráficos generados
+    """
+    if is_path(metadata):
+        metadata = Metadata.load(metadata)
+
+    names = list(distance_matrices)
+    # Los artefactos se convierten en el hilo principal; los hilos solo
+    # ejecutan la PCoA de scikit-bio
+    matrices = [dm if isinstance(dm, DistanceMatrix) else dm.view(DistanceMatrix)
+                for dm in (distance_matrices[name] for name in names)]
+    if JOBLIB_AVAILABLE and len(names) > 1:
+        # La descomposición en valores propios de NumPy libera el GIL
+        ordinations = Parallel(n_jobs=-1, prefer='threads')(delayed(_ordinate)(dm) for dm in matrices)
+    else:
+        ordinations = [_ordinate(dm) for dm in matrices]
+
+    output_files = []
+    fig, ax = plt.subplots(figsize=(8, 8))
+    for name, ordination in zip(names, ordinations):
+        ax.clear()
+        dokdo.beta_2d_plot(Artifact.import_data('PCoAResults', ordination), metadata=metadata, hue=hue, ax=ax)
+        ax.set_title(f'PCoA - {name}')
+        fig.tight_layout()
+        output_file = f"{output_dir}/pcoa_{name}.png"
+        fig.savefig(output_file, dpi=300, bbox_inches='tight')
+        output_files.append(output_file)
+    plt.close(fig)
 
-    return output_file
\ No newline at end of file
+    return output_files
@@ -1,8 +1,59 @@
 """
 Módulo para denoising con Deblur
 """
+import dataclasses
+import functools
+import hashlib
+import logging
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from qiime2 import Artifact
+
+import pandas as pd
+from qiime2 import Artifact, Metadata
+from qiime2.plugins.deblur.methods import denoise_16S
+from qiime2.plugins.demux.methods import filter_samples
+from qiime2.plugins.feature_table.methods import merge, merge_seqs
+from modules.artifact_cache import (cache_subdir, cached_file_digest, evict_cache, link_or_copy,
+                                    load_artifact_q2cache, touch_entry)
+from modules.utils import available_cpus, is_path
+
+log = logging.getLogger('microbiome')
+
+
+@dataclasses.dataclass(frozen=True)
+class DeblurParams:
+    """Parámetros de ``denoise_16S`` (jobs_to_start=0 = CPUs disponibles menos una)"""
+    left_trim_len: int = 0
+    trim_length: int = 250
+    min_reads: int = 50
+    min_size: int = 2
+    jobs_to_start: int = 0
+
+
+DEFAULT_DEBLUR_PARAMS = DeblurParams()
+
+# Salidas de Deblur: clave del resultado -> (archivo, etiqueta)
+DEBLUR_OUTPUTS = {
+    'table': ("table.qza", "Tabla de features"),
+    'rep_seqs': ("rep-seqs.qza", "Secuencias representativas"),
+    'stats': ("stats.qza", "Estadísticas"),
+}
+
+
+def _deblur_cache_key(demux_path, params, shards, sample_stats):
+    """Clave de caché: SHA-256 del demux y de los parámetros que afectan al resultado
+
+    ``jobs_to_start`` solo cambia el paralelismo y no forma parte de la clave.
+    El hash del demux se recuerda por ruta, tamaño y fecha, de modo que solo
+    se lee el archivo completo la primera vez.
+    """
+    settings = dataclasses.asdict(params)
+    settings.pop('jobs_to_start')
+    settings.update(shards=shards, sample_stats=sample_stats)
+    params_digest = hashlib.sha256(repr(sorted(settings.items())).encode()).hexdigest()
+    return f"{cached_file_digest(demux_path)}-{params_digest}"
 
 
 class Denoiser:
@@ -13,77 +64,199 @@ class Denoiser:
         Args:
             demux_artifact: Path al archivo .qza o objeto Artifact de QIIME2
         """
-        if isinstance(demux_artifact, (str, Path)):
-            self.demux_seqs = Artifact.load(str(demux_artifact))
-        else:
-            self.demux_seqs = demux_artifact
+        self._demux_artifact = demux_artifact
+
+    @functools.cached_property
+    def demux_seqs(self):
+        """Artefacto demultiplexado; si se dio una ruta se carga al usarlo por primera vez"""
+        if is_path(self._demux_artifact):
+            # Con Q2_CACHE definido, el artefacto se comparte entre invocaciones
+            # mediante un qiime2.Cache; si no, caché en memoria por ruta y mtime
+            return load_artifact_q2cache(self._demux_artifact)
+        return self._demux_artifact
 
-    def run_deblur(self, output_dir="results/deblur", **deblur_params):
+    def run_deblur(self, output_dir="results/deblur", shards=1, save_stats=True, save_rep_seqs=True,
+                   params=DEFAULT_DEBLUR_PARAMS, **deblur_params):
         """
         Ejecuta Deblur para denoising y obtención de ASVs
 
         Args:
             output_dir: Directorio de salida
-            deblur_params: Parámetros para Deblur
+            shards: Número de grupos de muestras procesados en paralelo, cada
+                uno en su propio proceso de Deblur con ``jobs_to_start`` CPUs
+            save_stats: Calcular y guardar las estadísticas por muestra (stats.qza)
+            save_rep_seqs: Guardar las secuencias representativas (rep-seqs.qza)
+            params: Parámetros base de Deblur (:class:`DeblurParams`)
+            deblur_params: Parámetros de Deblur que sustituyen a los de ``params``
         """
-        from qiime2.plugins.deblur.methods import denoise_16S
-
         output_path = Path(output_dir)
         output_path.mkdir(parents=True, exist_ok=True)
 
-        # Parámetros por defecto para Deblur
-        default_params = {
-            'left_trim_len':0,
-            'trim_length': 250,
-            'min_reads': 50,
-            'min_size': 2,
-            'jobs_to_start': 8,
-        }
+        params = dataclasses.replace(params, **deblur_params)
+        if not params.jobs_to_start:
+            # Todas las CPUs disponibles menos una para el sistema
+            params = dataclasses.replace(params, jobs_to_start=max(1, available_cpus() - 1))
+
+        wanted = ['table'] + ['rep_seqs'] * save_rep_seqs + ['stats'] * save_stats
 
-        # Actualizar con parámetros proporcionados
-        default_params.update(deblur_params)
+        # Con un demux en disco, las ejecuciones con el mismo contenido y
+        # parámetros se reutilizan desde la caché mediante enlaces duros
+        # (desactivable con --no-cache / MICROBIOME_NO_CACHE)
+        cache_entry = None
+        cache_dir = cache_subdir('deblur')
+        if cache_dir is not None and is_path(self._demux_artifact):
+            cache_entry = cache_dir / _deblur_cache_key(self._demux_artifact, params, shards, save_stats)
+            if all((cache_entry / DEBLUR_OUTPUTS[key][0]).exists() for key in wanted):
+                print("♻️  Resultados de Deblur reutilizados de la caché:")
+                touch_entry(cache_entry)
+                return self._materialize(cache_entry, output_path, wanted)
 
         print("🧹 Ejecutando Deblur para denoising...")
-        print("📋 Parámetros utilizados:")
-        for key, value in default_params.items():
-            print(f"   • {key}: {value}")
+        # Los parámetros solo se muestran con --verbose, en una única línea
+        log.info("📋 Parámetros utilizados: %s", params)
 
         try:
-            # Ejecutar Deblur
-            deblur_result = denoise_16S(
-                demultiplexed_seqs=self.demux_seqs,
-                left_trim_len =default_params['left_trim_len'],
-                trim_length=default_params['trim_length'],
-                min_reads=default_params['min_reads'],
-                min_size=default_params['min_size'],
-                jobs_to_start=default_params['jobs_to_start'],
-                sample_stats=True,
-            )
-
-            # Guardar resultados
-            table = deblur_result.table
-            rep_seqs = deblur_result.representative_sequences
-            stats = deblur_result.stats
-
-            table_path = output_path / "table.qza"
-            rep_seqs_path = output_path / "rep-seqs.qza"
-            stats_path = output_path / "stats.qza"
-
-            table.save(str(table_path))
-            rep_seqs.save(str(rep_seqs_path))
-            stats.save(str(stats_path))
+            if shards > 1:
+                table, rep_seqs, stats = self._run_deblur_sharded(output_path, shards, params, save_stats)
+            else:
+                # Ejecutar Deblur
+                deblur_result = denoise_16S(
+                    demultiplexed_seqs=self.demux_seqs,
+                    sample_stats=save_stats,
+                    **dataclasses.asdict(params),
+                )
+
+                # Guardar resultados
+                table = deblur_result.table
+                rep_seqs = deblur_result.representative_sequences
+                stats = deblur_result.stats
+
+            artifacts = {'table': table, 'rep_seqs': rep_seqs, 'stats': stats}
 
             print("✅ Denoising con Deblur completado:")
-            print(f"   • Tabla de features: {table_path}")
-            print(f"   • Secuencias representativas: {rep_seqs_path}")
-            print(f"   • Estadísticas: {stats_path}")
+            result = {}
+            for key in wanted:
+                filename, label = DEBLUR_OUTPUTS[key]
+                path = output_path / filename
+                # Un archivo previo puede ser un enlace a la caché: no sobrescribirlo en sitio
+                if path.exists():
+                    path.unlink()
+                artifacts[key].save(str(path))
+                print(f"   • {label}: {path}")
+                result[key] = path
 
-            return {
-                'table': table_path,
-                'rep_seqs': rep_seqs_path,
-                'stats': stats_path
-            }
+            if cache_entry is not None:
+                self._store(result, cache_entry)
+
+            return result
 
         except Exception as e:
             print(f"❌ Error en Deblur: {e}")
-            return None
\ No newline at end of file
+            return None
+
+    @staticmethod
+    def _materialize(cache_entry, output_path, wanted):
+        """Enlaza en ``output_path`` las salidas guardadas en una entrada de la caché"""
+        result = {}
+        for key in wanted:
+            filename, label = DEBLUR_OUTPUTS[key]
+            path = output_path / filename
+            if path.exists():
+                path.unlink()
+            link_or_copy(cache_entry / filename, path)
+            print(f"   • {label}: {path}")
+            result[key] = path
+        return result
+
+    @staticmethod
+    def _store(result, cache_entry):
+        """Añade a la caché las salidas recién guardadas (renombrado atómico por archivo)
+
+        Solo se enlazan: si la caché está en otro sistema de archivos no se
+        duplican los resultados y la ejecución no se guarda.
+        """
+        cache_entry.mkdir(parents=True, exist_ok=True)
+        for key, path in result.items():
+            target = cache_entry / DEBLUR_OUTPUTS[key][0]
+            if target.exists():
+                continue
+            partial = cache_entry / f".partial-{target.name}"
+            partial.unlink(missing_ok=True)
+            try:
+                os.link(path, partial)
+            except OSError:
+                print("ℹ️  La caché está en otro sistema de archivos: resultados de Deblur no guardados en ella")
+                return
+            os.replace(partial, target)
+        evict_cache(keep=[cache_entry])
+
+    def _run_deblur_sharded(self, output_path, shards, params, save_stats=True):
+        """
+        Divide las muestras en grupos, ejecuta Deblur en paralelo sobre cada
+        grupo y fusiona tablas, secuencias representativas y, si
+        ``save_stats``, estadísticas (si no, se devuelven como None).
+
+        Nota: ``min_reads`` se aplica dentro de cada grupo, por lo que un ASV
+        raro repartido entre grupos puede filtrarse antes que en una ejecución
+        única.
+        """
+        sample_ids = self._sample_ids()
+        shards = min(shards, len(sample_ids))
+        groups = [sample_ids[i::shards] for i in range(shards)]
+
+        print(f"🧩 Dividiendo {len(sample_ids)} muestras en {shards} grupos")
+
+        with tempfile.TemporaryDirectory(dir=output_path) as tmpdir:
+            shard_paths = []
+            for i, group in enumerate(groups):
+                metadata = Metadata(pd.DataFrame(index=pd.Index(group, name='sample-id')))
+                shard = filter_samples(demux=self.demux_seqs, metadata=metadata).filtered_demux
+                shard_path = Path(tmpdir) / f"shard_{i}" / "demux.qza"
+                shard_path.parent.mkdir()
+                shard.save(str(shard_path))
+                shard_paths.append(shard_path)
+
+            # Cada proceso carga su propio artefacto: solo viajan rutas entre procesos
+            with ProcessPoolExecutor(max_workers=shards) as executor:
+                results = list(executor.map(_deblur_shard, shard_paths, [params] * shards,
+                                            [save_stats] * shards))
+
+            tables = [Artifact.load(str(r['table'])) for r in results]
+            seqs = [Artifact.load(str(r['rep_seqs'])) for r in results]
+
+            table = merge(tables=tables).merged_table
+            rep_seqs = merge_seqs(data=seqs).merged_data
+            stats = None
+            if save_stats:
+                stats = pd.concat([Artifact.load(str(r['stats'])).view(pd.DataFrame) for r in results])
+                stats = Artifact.import_data('DeblurStats', stats)
+
+        return table, rep_seqs, stats
+
+    def _sample_ids(self):
+        """Devuelve los IDs de muestra del artefacto demultiplexado"""
+        # Ver el artefacto en su propio formato no copia datos: solo se lee el MANIFEST
+        data = self.demux_seqs.view(self.demux_seqs.format)
+        manifest = pd.read_csv(Path(str(data)) / data.manifest.pathspec, comment='#')
+        return list(dict.fromkeys(manifest['sample-id']))
+
+
+def _deblur_shard(shard_path, params, save_stats=True):
+    """Ejecuta Deblur sobre un grupo de muestras (en un proceso independiente)"""
+    shard_dir = Path(shard_path).parent
+    result = denoise_16S(
+        demultiplexed_seqs=Artifact.load(str(shard_path)),
+        **dataclasses.asdict(params),
+        sample_stats=save_stats,
+    )
+
+    paths = {
+        'table': shard_dir / "table.qza",
+        'rep_seqs': shard_dir / "rep-seqs.qza",
+    }
+    result.table.save(str(paths['table']))
+    result.representative_sequences.save(str(paths['rep_seqs']))
+    if save_stats:
+        paths['stats'] = shard_dir / "stats.qza"
+        result.stats.save(str(paths['stats']))
+    return paths
@@ -1,72 +1,584 @@
 """
 Módulo para descarga de SRA con eliminación automática de archivos SRA
 """
+import asyncio
+import functools
+import os
 import pandas as pd
+import queue
+import shutil
+import sqlite3
 import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import sys
 
-
-def download_sra_from_csv(csv_file, output_dir="data/raw"):
-    """Descarga SRA desde archivo CSV"""
-
-    # Leer CSV
-    df = pd.read_csv(csv_file)
-
-    # Buscar columna de accessions
-    accession_col = None
-    for col in df.columns:
-        if any(x in col.lower() for x in ['accession', 'sra', 'run']):
-            accession_col = col
-            break
-
+from modules.io_utils import split_interleaved
+from modules.utils import available_cpus
+
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pv
+
+    PYARROW_AVAILABLE = True
+except ImportError:
+    PYARROW_AVAILABLE = False
+
+try:
+    import aiohttp
+
+    AIOHTTP_AVAILABLE = True
+except ImportError:
+    AIOHTTP_AVAILABLE = False
+
+ENA_FASTQ_URL = "https://ftp.sra.ebi.ac.uk/vol1/fastq"
+ENA_PROBE_TIMEOUT = 5
+# Sin límite total: un .fastq.gz grande puede tardar más de lo que aiohttp
+# permite por defecto (5 min); solo se limitan la conexión y cada lectura
+ENA_CONNECT_TIMEOUT = 30
+ENA_READ_TIMEOUT = 300
+STATE_DB = ".state.db"
+# fasterq-dump no escala más allá de ~6 hilos por proceso: es mejor repartir
+# los núcleos restantes entre más conversiones simultáneas
+MAX_DUMP_THREADS = 6
+# Segundos de espera por intento al encolar un .sra: entre intentos se
+# comprueba que sigan vivos los workers de conversión
+QUEUE_PUT_TIMEOUT = 1.0
+# Extensiones que se eliminan tras la conversión a FASTQ
+SRA_CLEANUP_SUFFIXES = {'.sra', '.csi', '.vdbcache'}
+
+
+class DownloadState:
+    """Registro SQLite de accessions completados, compartido entre hilos
+
+    Se guarda en ``<output_dir>/.state.db`` con el tamaño total y la fecha de
+    modificación más reciente de los FASTQ de cada accession, para poder
+    reanudar descargas interrumpidas sin repetir las que ya terminaron. No se
+    calcula ningún hash: releer gigabytes de FASTQ tras cada conversión
+    costaría tanto como escribirlos.
+    """
+
+    def __init__(self, output_dir):
+        Path(output_dir).mkdir(parents=True, exist_ok=True)
+        self.output_dir = output_dir
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(Path(output_dir) / STATE_DB), check_same_thread=False)
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS accessions ("
+                "accession TEXT PRIMARY KEY, status TEXT, bytes INTEGER, mtime_ns INTEGER)"
+            )
+            # Registros de versiones anteriores (con columna sha256 y sin mtime_ns)
+            columns = {row[1] for row in self._conn.execute("PRAGMA table_info(accessions)")}
+            if 'mtime_ns' not in columns:
+                self._conn.execute("ALTER TABLE accessions ADD COLUMN mtime_ns INTEGER")
+
+    def completed(self):
+        """Accessions marcados como completos cuyos FASTQ siguen en disco con el tamaño registrado"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT accession, bytes FROM accessions WHERE status = 'done'"
+            ).fetchall()
+        done = set()
+        for accession, size in rows:
+            files = _fastq_files(self.output_dir, accession)
+            if files and sum(f.stat().st_size for f in files) == size:
+                done.add(accession)
+        return done
+
+    def mark_done(self, accession):
+        """Registra un accession como completo con el tamaño y la fecha de sus FASTQ"""
+        stats = [f.stat() for f in _fastq_files(self.output_dir, accession)]
+        size = sum(stat.st_size for stat in stats)
+        mtime_ns = max((stat.st_mtime_ns for stat in stats), default=0)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO accessions (accession, status, bytes, mtime_ns) "
+                "VALUES (?, 'done', ?, ?)",
+                (accession, size, mtime_ns)
+            )
+
+    def close(self):
+        self._conn.close()
+
+
+def _fastq_files(output_dir, accession):
+    """FASTQ comprimidos de un accession, ordenados por nombre"""
+    return sorted((Path(output_dir) / accession).glob(f"{accession}*.fastq.gz"))
+
+
+def download_sra_from_csv(csv_file, output_dir="data/raw", prefetch_jobs=2, dump_jobs=0, threads=4,
+                          tmp_dir=None, source="auto", accession_col=None, chunk_size=16,
+                          resume=True, dry_run=False):
+    """Descarga SRA desde archivo CSV
+
+    Las descargas se organizan en dos etapas concurrentes: un pool de
+    ``prefetch`` alimenta, mediante una cola acotada, a un pool de
+    ``fasterq-dump``, de modo que la descarga de una muestra se solapa
+    con la conversión de otra.
+
+    Con ``source="auto"`` primero se intenta descargar el ``.fastq.gz`` ya
+    generado por ENA y solo los accessions que fallan pasan por SRA Toolkit.
+
+    Args:
+        csv_file: Ruta al archivo CSV con los accessions
+        output_dir: Directorio de salida para los FASTQ
+        prefetch_jobs: Número de descargas ``prefetch`` simultáneas
+        dump_jobs: Número de conversiones ``fasterq-dump`` simultáneas (0 = según
+            los núcleos disponibles y ``threads``)
+        threads: Hilos por proceso ``fasterq-dump`` (máximo ``MAX_DUMP_THREADS``)
+        tmp_dir: Directorio temporal de ``fasterq-dump`` (por defecto, la carpeta
+            de cada accession, en el mismo sistema de archivos que la salida)
+        source: Origen de los datos: 'auto' (ENA y luego SRA), 'ena' o 'sra'
+        accession_col: Columna con los accessions; si no existe en el CSV se
+            detecta automáticamente
+        chunk_size: Accessions por invocación de ``prefetch``
+        resume: Omitir los accessions completados en ejecuciones anteriores
+        dry_run: Solo mostrar qué accessions se descargarían
+    """
+    accession_col = find_accession_column(csv_file, accession_col)
     if not accession_col:
         print("❌ No se encontró columna de accessions")
         sys.exit(1)
 
-    accessions = df[accession_col].dropna().unique()
-    print(f"📥 Descargando {len(accessions)} muestras...")
+    accessions = read_accessions(csv_file, accession_col)
+    # Con una columna LibraryLayout (p. ej. SraRunInfo.csv) no hace falta
+    # inspeccionar cada .sra para saber si es paired-end
+    layouts = read_layouts(csv_file, accession_col)
 
-    # Descargar cada accession
-    for accession in accessions:
-        download_single_sra(accession.strip(), output_dir)
+    state = DownloadState(output_dir)
+    try:
+        if resume:
+            completed = state.completed()
+            pending = [acc for acc in accessions if acc not in completed]
+            if len(pending) < len(accessions):
+                print(f"⏭️  {len(accessions) - len(pending)} accessions ya completados, se omiten")
+            accessions = pending
+
+        if dry_run:
+            print(f"📝 Se descargarían {len(accessions)} muestras:")
+            for accession in accessions:
+                print(f"   • {accession}")
+            return
+
+        print(f"📥 Descargando {len(accessions)} muestras...")
+
+        if source in ('auto', 'ena'):
+            if AIOHTTP_AVAILABLE:
+                fetched = fetch_from_ena(accessions, output_dir)
+                for accession in fetched:
+                    state.mark_done(accession)
+                accessions = [acc for acc in accessions if acc not in fetched]
+            else:
+                print("⚠️  aiohttp no está instalado; no se puede descargar desde ENA")
+                print("   Instala con: pip install aiohttp")
+
+            if source == 'ena':
+                for accession in accessions:
+                    print(f"❌ {accession} no disponible en ENA")
+                print("✅ Descargas completadas")
+                return
+
+        if accessions:
+            threads = min(threads, MAX_DUMP_THREADS)
+            if not dump_jobs:
+                dump_jobs = max(1, min(available_cpus() // threads, len(accessions)))
+            print(f"⚡ fasterq-dump: {dump_jobs} x {threads} hilos")
+            _run_sra_pipeline(accessions, output_dir, prefetch_jobs, dump_jobs, threads, tmp_dir, chunk_size,
+                              state=state, layouts=layouts)
+    finally:
+        state.close()
 
     print("✅ Descargas completadas")
 
 
-def download_single_sra(accession, output_dir):
-    """Descarga un solo archivo SRA y detecta si es SE o PE"""
-    print(f"⬇️  Descargando {accession}...")
+def find_accession_column(csv_file, preferred=None):
+    """Devuelve la columna de accessions leyendo solo la cabecera del CSV"""
+    columns = pd.read_csv(csv_file, nrows=0).columns
+
+    if preferred in columns:
+        return preferred
+
+    for col in columns:
+        if any(x in col.lower() for x in ['accession', 'sra', 'run']):
+            return col
+
+    return None
+
+
+def read_accessions(csv_file, accession_col):
+    """Lee los accessions únicos (en orden de aparición) de una columna del CSV
+
+    Con pyarrow disponible se usa su lector CSV multihilo, materializando
+    solo la columna de accessions; si no, se recurre a pandas.
+    """
+    if PYARROW_AVAILABLE:
+        table = pv.read_csv(csv_file, convert_options=pv.ConvertOptions(
+            include_columns=[accession_col],
+            column_types={accession_col: pa.string()},
+        ))
+        values = (v.strip() for v in table.column(0).to_pylist() if v is not None)
+    else:
+        # dtype=str evita que pandas convierta accessions a números; el strip
+        # se aplica vectorizado sobre la columna
+        column = pd.read_csv(csv_file, usecols=[accession_col], dtype=str, skipinitialspace=True)[accession_col]
+        values = column.dropna().str.strip()
+
+    return list(dict.fromkeys(acc for acc in values if acc))
+
+
+def read_layouts(csv_file, accession_col):
+    """Lee la columna LibraryLayout del CSV (SINGLE/PAIRED) si existe
+
+    Returns:
+        dict: accession -> True (paired-end) o False (single-end); vacío si
+        el CSV no tiene columna de layout
+    """
+    columns = pd.read_csv(csv_file, nrows=0).columns
+    layout_col = next((col for col in columns if 'layout' in col.lower()), None)
+    if layout_col is None:
+        return {}
+
+    df = pd.read_csv(csv_file, usecols=[accession_col, layout_col], dtype=str,
+                     skipinitialspace=True).dropna()
+    layouts = df[layout_col].str.strip().str.upper()
+    known = layouts.isin(['PAIRED', 'SINGLE'])
+    return dict(zip(df[accession_col].str.strip()[known], layouts[known] == 'PAIRED'))
+
+
+def _run_sra_pipeline(accessions, output_dir, prefetch_jobs, dump_jobs, threads, tmp_dir, chunk_size=16,
+                      state=None, layouts=None):
+    """Descarga y convierte con prefetch -> fasterq-dump en dos pools conectados"""
+    # Agrupar accessions para amortizar el arranque de prefetch entre varias descargas
+    chunks = [accessions[i:i + chunk_size] for i in range(0, len(accessions), chunk_size)]
+
+    # La cola acotada evita que prefetch acumule demasiados .sra en disco
+    sra_queue = queue.Queue(maxsize=prefetch_jobs * chunk_size)
+
+    with ThreadPoolExecutor(max_workers=dump_jobs) as dump_pool:
+        dump_futures = [
+            dump_pool.submit(_dump_worker, sra_queue, output_dir, threads, tmp_dir, state, layouts or {})
+            for _ in range(dump_jobs)
+        ]
+
+        try:
+            with ThreadPoolExecutor(max_workers=prefetch_jobs) as prefetch_pool:
+                prefetch_futures = [
+                    prefetch_pool.submit(_prefetch_worker, chunk, output_dir, sra_queue, dump_futures)
+                    for chunk in chunks
+                ]
+            for chunk, future in zip(chunks, prefetch_futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    print(f"❌ Error en la descarga de {', '.join(chunk)}: {e}")
+        finally:
+            # Una señal de fin por cada worker de conversión (sin bloquear si ya no queda ninguno)
+            for _ in range(dump_jobs):
+                if not _queue_put(sra_queue, None, dump_futures):
+                    break
+
+        for future in dump_futures:
+            future.result()
+
+
+def _queue_put(sra_queue, item, dump_futures):
+    """Encola ``item`` esperando mientras quede algún worker de conversión vivo
+
+    Returns:
+        bool: False si todos los workers terminaron y el elemento no se encoló
+    """
+    while True:
+        try:
+            sra_queue.put(item, timeout=QUEUE_PUT_TIMEOUT)
+            return True
+        except queue.Full:
+            if all(future.done() for future in dump_futures):
+                return False
+
+
+def ena_fastq_url(accession, suffix=''):
+    """URL de un .fastq.gz de un accession en el FTP/HTTPS de ENA
+
+    ``suffix`` es '' para single-end y '_1' / '_2' para cada lectura paired-end.
+    """
+    # ENA agrupa por los 6 primeros caracteres y, a partir de 7 dígitos,
+    # por un subdirectorio con los dígitos sobrantes rellenados a 3
+    path = f"{ENA_FASTQ_URL}/{accession[:6]}"
+    if len(accession) > 9:
+        path += f"/{accession[9:].zfill(3)}"
+    return f"{path}/{accession}/{accession}{suffix}.fastq.gz"
+
+
+async def probe_ena(session, accession):
+    """Comprueba con peticiones HEAD qué archivos ofrece ENA para un accession
+
+    Returns:
+        list: Sufijos disponibles (['_1', '_2'] o ['']); vacía si no hay ninguno
+    """
+    timeout = aiohttp.ClientTimeout(total=ENA_PROBE_TIMEOUT)
+    # Preferir el par _1/_2: en paired-end ENA puede publicar además un
+    # .fastq.gz con las lecturas huérfanas
+    for suffixes in (['_1', '_2'], ['']):
+        try:
+            async with session.head(ena_fastq_url(accession, suffixes[0]), timeout=timeout) as response:
+                if response.status == 200:
+                    return suffixes
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            return []
+    return []
+
+
+async def fetch_file(session, url, output_file):
+    """Descarga ``url`` en ``output_file`` reanudando descargas parciales
+
+    Returns:
+        bool: True si el archivo se descargó completo
+    """
+    partial_file = output_file.with_name(output_file.name + '.part')
+
+    headers = {}
+    if partial_file.exists():
+        headers['Range'] = f"bytes={partial_file.stat().st_size}-"
+
+    async with session.get(url, headers=headers) as response:
+        if response.status == 416:
+            # Rango fuera del archivo: el .part ya está completo si su tamaño
+            # coincide con el total que indica Content-Range ("bytes */<total>")
+            total = response.headers.get('Content-Range', '').rpartition('/')[2]
+            if total.isdigit() and int(total) == partial_file.stat().st_size:
+                partial_file.rename(output_file)
+                return True
+            partial_file.unlink()
+            return False
+
+        if response.status not in (200, 206):
+            return False
+
+        # 206: el servidor aceptó el rango, continuar el archivo parcial
+        mode = 'ab' if response.status == 206 else 'wb'
+        with open(partial_file, mode) as f:
+            async for chunk in response.content.iter_chunked(1 << 20):
+                f.write(chunk)
+
+    partial_file.rename(output_file)
+    return True
+
+
+async def resolve_and_fetch(session, accession, output_dir):
+    """Descarga desde ENA los .fastq.gz (single o paired-end) de un accession
+
+    La carpeta del accession solo se crea si ENA tiene los archivos.
+
+    Returns:
+        bool: True si se descargaron; False si ENA no los tiene o falló
+    """
+    suffixes = await probe_ena(session, accession)
+    if not suffixes:
+        return False
+
+    accession_dir = Path(output_dir) / accession
+    accession_dir.mkdir(parents=True, exist_ok=True)
 
     try:
-        # Prefetch
-        subprocess.run([
-            'prefetch', accession, '-O', output_dir
-        ], check=True, capture_output=True)
+        for suffix in suffixes:
+            output_file = accession_dir / f"{accession}{suffix}.fastq.gz"
+            if not await fetch_file(session, ena_fastq_url(accession, suffix), output_file):
+                return False
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        print(f"⚠️  Error descargando {accession} desde ENA: {e}")
+        return False
 
-        # Detectar si es single-end o paired-end
-        sra_path = f"{output_dir}/{accession}/{accession}.sra"
-        is_paired = detect_paired_end(sra_path)
+    print(f"✅ {accession} descargado desde ENA")
+    return True
+
+
+async def _fetch_all_from_ena(accessions, output_dir):
+    connector = aiohttp.TCPConnector(limit=32)
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=ENA_CONNECT_TIMEOUT, sock_read=ENA_READ_TIMEOUT)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        results = await asyncio.gather(
+            *(resolve_and_fetch(session, acc, output_dir) for acc in accessions)
+        )
+    return {acc for acc, ok in zip(accessions, results) if ok}
+
+
+def fetch_from_ena(accessions, output_dir):
+    """Descarga concurrentemente desde ENA los accessions disponibles
+
+    Returns:
+        set: Accessions descargados correctamente
+    """
+    print(f"🌐 Buscando {len(accessions)} accessions en ENA...")
+    fetched = asyncio.run(_fetch_all_from_ena(accessions, output_dir))
+    print(f"🌐 {len(fetched)}/{len(accessions)} descargados desde ENA")
+    return fetched
+
+
+def run_with_retry(cmd, retries=3, backoff=2.0, **kwargs):
+    """Ejecuta un comando reintentando con espera exponencial ante fallos transitorios"""
+    for attempt in range(retries):
+        result = subprocess.run(cmd, check=False, capture_output=True, text=True, **kwargs)
+        if result.returncode == 0:
+            return result
+
+        if attempt < retries - 1:
+            wait = backoff ** attempt
+            print(f"⚠️  {cmd[0]} falló (intento {attempt + 1}/{retries}), reintentando en {wait:.0f}s...")
+            time.sleep(wait)
+
+    raise subprocess.CalledProcessError(result.returncode, cmd, result.stdout, result.stderr)
+
+
+PREFETCH_RETRIES = 5
+
+
+def sra_file_path(output_dir, accession):
+    """Ruta donde prefetch deja el .sra de un accession"""
+    return f"{output_dir}/{accession}/{accession}.sra"
+
+
+def prefetch_sra(accessions, output_dir):
+    """Descarga con una sola invocación de prefetch los .sra de uno o varios accessions
+
+    Returns:
+        list: Rutas a los archivos .sra
+    """
+    if isinstance(accessions, str):
+        accessions = [accessions]
+
+    print(f"⬇️  Descargando {', '.join(accessions)}...")
+
+    # --max-size u: sin límite de tamaño (por defecto prefetch corta en 20 GB)
+    # -r yes: reanudar descargas parciales; -C yes: verificar tras la descarga
+    # Con -r los .sra ya completos no se vuelven a bajar al reintentar el grupo
+    run_with_retry([
+        'prefetch', '--max-size', 'u', '-r', 'yes', '-C', 'yes', *accessions, '-O', output_dir
+    ], retries=PREFETCH_RETRIES)
+
+    return [sra_file_path(output_dir, acc) for acc in accessions]
 
-        print(f"🔍 {accession} detectado como {'Paired-End' if is_paired else 'Single-End'}")
 
-        # Convertir a FASTQ según el tipo
-        if is_paired:
-            convert_paired_end(sra_path, output_dir, accession)
+def _prefetch_worker(chunk, output_dir, sra_queue, dump_futures):
+    """Etapa 1: descarga un grupo de .sra y encola los obtenidos para su conversión
+
+    Los .sra que quedaron en disco de una ejecución anterior (p. ej. porque
+    falló la conversión) se convierten directamente sin volver a consultar
+    la red.
+    """
+    # Un .sra solo existe completo: prefetch descarga en un .tmp y lo renombra al terminar
+    missing = [acc for acc in chunk if not Path(sra_file_path(output_dir, acc)).exists()]
+    if len(missing) < len(chunk):
+        print(f"♻️  Reutilizando {len(chunk) - len(missing)} .sra ya descargados")
+
+    if missing:
+        try:
+            prefetch_sra(missing, output_dir)
+        except subprocess.CalledProcessError as e:
+            # prefetch falla si falla cualquiera del grupo: convertir los que sí llegaron
+            print(f"❌ Error en prefetch de {', '.join(missing)}: {e}")
+
+    for accession in chunk:
+        sra_path = sra_file_path(output_dir, accession)
+        if Path(sra_path).exists():
+            if not _queue_put(sra_queue, (accession, sra_path), dump_futures):
+                raise RuntimeError("no queda ningún worker de conversión activo")
         else:
-            convert_single_end(sra_path, output_dir, accession)
+            print(f"❌ Error con {accession}: no se descargó el archivo SRA")
+
 
-        # Eliminar archivos SRA después de la conversión
-        cleanup_sra_files(output_dir, accession)
+def _dump_worker(sra_queue, output_dir, threads, tmp_dir=None, state=None, layouts=None):
+    """Etapa 2: convierte a FASTQ los .sra encolados hasta recibir la señal de fin
+
+    ``layouts`` asocia accessions a ``True`` (paired-end) o ``False``
+    (single-end); los accessions ausentes se detectan sobre el .sra.
+    """
+    layouts = layouts or {}
+    while True:
+        item = sra_queue.get()
+        if item is None:
+            break
+
+        accession, sra_path = item
+        # Cualquier error se limita a su accession: si el worker terminara,
+        # prefetch no tendría quién vaciara la cola
+        try:
+            convert_sra(sra_path, output_dir, accession, threads, tmp_dir, is_paired=layouts.get(accession))
+            if state is not None:
+                state.mark_done(accession)
+        except Exception as e:
+            print(f"❌ Error con {accession}: {e}")
 
-        print(f"✅ {accession} descargado, convertido y limpiado")
 
+def download_single_sra(accession, output_dir, threads=4, tmp_dir=None, is_paired=None):
+    """Descarga un solo archivo SRA y detecta si es SE o PE (salvo que se indique ``is_paired``)"""
+    try:
+        sra_path, = prefetch_sra(accession, output_dir)
+        convert_sra(sra_path, output_dir, accession, threads, tmp_dir, is_paired)
     except subprocess.CalledProcessError as e:
         print(f"❌ Error con {accession}: {e}")
 
 
+def convert_sra(sra_path, output_dir, accession, threads=4, tmp_dir=None, is_paired=None):
+    """Convierte un .sra ya descargado a FASTQ y elimina los archivos SRA
+
+    Si ``is_paired`` es None (layout desconocido) se detecta sobre el .sra.
+    """
+    # Detectar si es single-end o paired-end
+    if is_paired is None:
+        is_paired = detect_paired_end(sra_path)
+
+    print(f"🔍 {accession} detectado como {'Paired-End' if is_paired else 'Single-End'}")
+
+    # Convertir a FASTQ según el tipo
+    if is_paired:
+        convert_paired_end(sra_path, output_dir, accession, threads, tmp_dir)
+    else:
+        convert_single_end(sra_path, output_dir, accession, threads, tmp_dir)
+
+    # Eliminar archivos SRA después de la conversión
+    cleanup_sra_files(output_dir, accession)
+
+    print(f"✅ {accession} descargado, convertido y limpiado")
+
+
+@functools.lru_cache(maxsize=None)
 def detect_paired_end(sra_file):
-    """Detecta si el archivo SRA es paired-end"""
+    """Detecta si el archivo SRA es paired-end
+
+    Lee con ``vdb-dump`` la longitud y el tipo de las lecturas del primer
+    spot y cuenta solo las biológicas no vacías: un single-end con un
+    barcode técnico (``READ_LEN: 8, 150``) no se confunde con paired-end.
+    Si ``vdb-dump`` no está disponible o falla se recurre a ``sra-stat``.
+    El resultado se memoriza por archivo para los reintentos.
+    """
+    try:
+        result = subprocess.run(['vdb-dump', sra_file, '-R', '1', '-C', 'READ_LEN,READ_TYPE'],
+                                capture_output=True, text=True)
+    except OSError:
+        result = None
+
+    if result is not None and result.returncode == 0:
+        # Salida "READ_LEN: 8, 150" / "READ_TYPE: SRA_READ_TYPE_TECHNICAL, SRA_READ_TYPE_BIOLOGICAL"
+        columns = {}
+        for line in result.stdout.splitlines():
+            name, _, values = line.partition(':')
+            columns.setdefault(name.strip(), [value.strip() for value in values.split(',')])
+        read_lens, read_types = columns.get('READ_LEN'), columns.get('READ_TYPE')
+        if read_lens and read_types and len(read_lens) == len(read_types):
+            biological = sum(
+                length.isdigit() and int(length) > 0 and 'TECHNICAL' not in read_type
+                for length, read_type in zip(read_lens, read_types)
+            )
+            return biological >= 2
+
+    return _detect_paired_end_sra_stat(sra_file)
+
+
+def _detect_paired_end_sra_stat(sra_file):
+    """Detección con ``sra-stat`` (más lenta: recorre las estadísticas del archivo)"""
     try:
         # Usar sra-stat para ver la estructura del archivo
         result = subprocess.run([
@@ -106,60 +618,143 @@ def detect_paired_end_alt(sra_file):
         return False
 
 
-def convert_single_end(sra_file, output_dir, accession):
-    """Convierte SRA single-end a FASTQ"""
-    subprocess.run([
+def gzip_command(threads=4):
+    """Comando de compresión a stdout: pigz si está disponible, gzip si no"""
+    if shutil.which('pigz'):
+        return ['pigz', '-p', str(threads), '-c']
+    return ['gzip', '-c']
+
+
+def stream_to_gzip(cmd, output_file, threads=4):
+    """Ejecuta ``cmd`` y comprime su stdout directamente en ``output_file``
+
+    El FASTQ sin comprimir nunca se escribe en disco: los bytes pasan por
+    un pipe desde el productor hasta el compresor.
+    """
+    with open(output_file, 'wb') as out:
+        producer = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+        compressor = subprocess.Popen(gzip_command(threads), stdin=producer.stdout, stdout=out)
+        # Cerrar nuestra copia para que el productor reciba SIGPIPE si el compresor termina
+        producer.stdout.close()
+        compressor.wait()
+        producer.wait()
+
+    if producer.returncode != 0 or compressor.returncode != 0:
+        Path(output_file).unlink(missing_ok=True)
+        failed = cmd if producer.returncode != 0 else gzip_command(threads)
+        raise subprocess.CalledProcessError(producer.returncode or compressor.returncode, failed)
+
+
+def convert_single_end(sra_file, output_dir, accession, threads=4, tmp_dir=None):
+    """Convierte SRA single-end a FASTQ comprimido (.fastq.gz) en streaming"""
+    accession_dir = f"{output_dir}/{accession}"
+    stream_to_gzip([
         'fasterq-dump',
         sra_file,
-        '--outdir', f"{output_dir}/{accession}",
+        '--stdout',
+        '--temp', tmp_dir or accession_dir,
         '--skip-technical',
-        '--threads', '2'
-    ], check=True)
-
-
-def convert_paired_end(sra_file, output_dir, accession):
-    """Convierte SRA paired-end a FASTQ"""
-    subprocess.run([
+        '--threads', str(threads)
+    ], f"{accession_dir}/{accession}.fastq.gz", threads)
+
+
+def stream_paired_to_gzip(cmd, forward_file, reverse_file, threads=4):
+    """Ejecuta ``cmd`` (FASTQ intercalado por stdout) y comprime cada lectura por separado
+
+    Equivale a ``fasterq-dump --split-files`` sin escribir los FASTQ sin
+    comprimir: el stdout se reparte por bloques entre dos compresores. Los
+    spots con un mate vacío se descartan (se informa cuántos) en lugar de
+    hacer fallar el accession.
+    """
+    compressor_threads = max(1, threads // 2)
+    outputs = [open(forward_file, 'wb'), open(reverse_file, 'wb')]
+    producer = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    compressors = [
+        subprocess.Popen(gzip_command(compressor_threads), stdin=subprocess.PIPE, stdout=out)
+        for out in outputs
+    ]
+
+    error = None
+    orphans = 0
+    try:
+        orphans = split_interleaved(producer.stdout, compressors[0].stdin, compressors[1].stdin)
+    except (ValueError, OSError) as e:
+        error = e
+        producer.kill()
+    finally:
+        producer.stdout.close()
+        for compressor in compressors:
+            compressor.stdin.close()
+        producer.wait()
+        for compressor in compressors:
+            compressor.wait()
+        for out in outputs:
+            out.close()
+
+    returncodes = [producer.returncode] + [c.returncode for c in compressors]
+    if error is not None or any(returncodes):
+        Path(forward_file).unlink(missing_ok=True)
+        Path(reverse_file).unlink(missing_ok=True)
+        if error is not None:
+            raise subprocess.CalledProcessError(1, cmd, stderr=str(error))
+        failed = cmd if producer.returncode != 0 else gzip_command(compressor_threads)
+        raise subprocess.CalledProcessError(next(rc for rc in returncodes if rc), failed)
+
+    if orphans:
+        print(f"⚠️  {orphans} lecturas sin pareja descartadas en {Path(forward_file).name}")
+
+
+def convert_paired_end(sra_file, output_dir, accession, threads=4, tmp_dir=None):
+    """Convierte SRA paired-end a FASTQ comprimidos (_1/_2.fastq.gz) en streaming"""
+    accession_dir = f"{output_dir}/{accession}"
+    # --split-spot con --stdout emite los dos mates de cada spot de forma consecutiva
+    stream_paired_to_gzip([
         'fasterq-dump',
         sra_file,
-        '--outdir', f"{output_dir}/{accession}",
-        '--split-files',
-        '--threads', '2'
-    ], check=True)
+        '--stdout',
+        '--split-spot',
+        '--temp', tmp_dir or accession_dir,
+        '--skip-technical',
+        '--threads', str(threads)
+    ], f"{accession_dir}/{accession}_1.fastq.gz", f"{accession_dir}/{accession}_2.fastq.gz", threads)
 
 
 def cleanup_sra_files(output_dir, accession):
-    """Elimina archivos SRA después de la conversión a FASTQ"""
-    accession_dir = Path(output_dir) / accession
-
-    # Buscar y eliminar archivos SRA
-    sra_files = list(accession_dir.glob("*.sra"))
-    for sra_file in sra_files:
-        try:
-            sra_file.unlink()
-            print(f"🗑️  Eliminado: {sra_file}")
-        except Exception as e:
-            print(f"⚠️  No se pudo eliminar {sra_file}: {e}")
-
-    # También eliminar archivos intermedios como .csi si existen
-    temp_files = list(accession_dir.glob("*.csi")) + list(accession_dir.glob("*.vdbcache"))
-    for temp_file in temp_files:
-        try:
-            temp_file.unlink()
-        except Exception:
-            pass  # Ignorar errores en archivos temporales
+    """Elimina archivos SRA después de la conversión a FASTQ
 
+    Los .sra y los intermedios (.csi, .vdbcache) se localizan con una única
+    lectura del directorio.
+    """
+    accession_dir = Path(output_dir) / accession
 
+    with os.scandir(accession_dir) as it:
+        for entry in it:
+            suffix = os.path.splitext(entry.name)[1]
+            if suffix not in SRA_CLEANUP_SUFFIXES or not entry.is_file():
+                continue
+            try:
+                os.unlink(entry.path)
+                if suffix == '.sra':
+                    print(f"🗑️  Eliminado: {entry.path}")
+            except OSError as e:
+                # Los errores en archivos intermedios se ignoran
+                if suffix == '.sra':
+                    print(f"⚠️  No se pudo eliminar {entry.path}: {e}")
+
+
+@functools.lru_cache(maxsize=1)
 def check_dependencies():
-    """Verifica que las herramientas necesarias estén instaladas"""
+    """Verifica que las herramientas necesarias estén instaladas
+
+    Solo busca los ejecutables en el PATH (sin lanzar procesos) y el
+    resultado se memoriza para el resto de la ejecución. ``vdb-dump`` es
+    opcional: sin él, :func:`detect_paired_end` recurre a ``sra-stat``.
+    """
     tools = ['prefetch', 'fasterq-dump', 'sra-stat']
-    missing = []
+    missing = [tool for tool in tools if shutil.which(tool) is None]
 
-    for tool in tools:
-        try:
-            subprocess.run([tool, '--version'], capture_output=True)
-        except FileNotFoundError:
-            missing.append(tool)
+    if shutil.which('vdb-dump') is None:
+        print("⚠️  vdb-dump no está instalado; el tipo de lectura se detectará con sra-stat")
 
     if missing:
         print(f"❌ Herramientas faltantes: {', '.join(missing)}")
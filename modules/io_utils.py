@@ -0,0 +1,83 @@
+"""
+Utilidades de E/S compartidas para archivos FASTQ
+"""
+try:
+    # ISA-L: (des)compresión gzip acelerada con SIMD, misma API que gzip
+    from isal import igzip as gzip_module
+
+    ISAL_AVAILABLE = True
+except ImportError:
+    import gzip as gzip_module
+
+    ISAL_AVAILABLE = False
+
+
+def open_fastq(fastq_path, mode='rb'):
+    """Abre un FASTQ, descomprimiendo con ISA-L (o gzip) si termina en .gz"""
+    if str(fastq_path).endswith('.gz'):
+        return gzip_module.open(fastq_path, mode)
+    return open(fastq_path, mode)
+
+
+# Bytes leídos por bloque al repartir un FASTQ intercalado
+SPLIT_BLOCK_SIZE = 1 << 22
+
+
+def _fastq_line_blocks(stream, block_size=SPLIT_BLOCK_SIZE):
+    """Lee un FASTQ por bloques y genera listas de líneas con registros completos
+
+    Cada lista contiene un múltiplo de 4 líneas (sin el salto de línea);
+    el resto se arrastra al bloque siguiente.
+    """
+    pending = b''
+    for block in iter(lambda: stream.read(block_size), b''):
+        lines = (pending + block).split(b'\n')
+        pending = lines.pop()
+        usable = len(lines) - len(lines) % 4
+        if usable < len(lines):
+            pending = b'\n'.join(lines[usable:] + [pending])
+            del lines[usable:]
+        if lines:
+            yield lines
+
+    if pending:
+        lines = pending.rstrip(b'\n').split(b'\n')
+        if len(lines) % 4:
+            raise ValueError(f"FASTQ truncado: {len(lines) % 4} líneas sobrantes al final")
+        yield lines
+
+
+def split_interleaved(stream, forward, reverse, block_size=SPLIT_BLOCK_SIZE):
+    """Reparte un FASTQ intercalado (R1, R2, R1, R2...) en dos flujos
+
+    Los dos registros de un par comparten el nombre del spot (primer campo
+    de la cabecera). Un registro sin pareja (spot con un mate vacío) no se
+    escribe: se descarta y se vuelve a sincronizar con el siguiente. La
+    entrada se procesa por bloques y cada bloque se escribe con una sola
+    llamada por salida.
+
+    Returns:
+        int: Número de registros descartados por no tener pareja
+    """
+    held_name = held_record = None
+    orphans = 0
+    for lines in _fastq_line_blocks(stream, block_size):
+        reads1, reads2 = [], []
+        for i in range(0, len(lines), 4):
+            name = lines[i].split(None, 1)[0]
+            record = b'\n'.join(lines[i:i + 4])
+            if held_name == name:
+                reads1.append(held_record)
+                reads2.append(record)
+                held_name = held_record = None
+            else:
+                if held_name is not None:
+                    orphans += 1
+                held_name, held_record = name, record
+        if reads1:
+            forward.write(b'\n'.join(reads1) + b'\n')
+            reverse.write(b'\n'.join(reads2) + b'\n')
+
+    if held_name is not None:
+        orphans += 1
+    return orphans
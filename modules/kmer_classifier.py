@@ -0,0 +1,180 @@
+# modules/kmer_classifier.py
+"""
+Clasificación taxonómica por vecinos más cercanos de k-mers en GPU (FAISS)
+
+Alternativa opcional a vsearch para bases de referencia grandes: las
+secuencias se convierten en vectores con los recuentos exactos de sus
+k-mers, se indexan con FAISS IVF en la GPU y cada consulta (en la hebra que
+mejor coincide, como ``vsearch --strand both``) recibe el consenso (LCA) de
+la taxonomía de sus vecinos más cercanos.
+"""
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix
+
+try:
+    import faiss
+
+    FAISS_AVAILABLE = True
+except ImportError:
+    FAISS_AVAILABLE = False
+
+# Un vector por secuencia con los 4^k k-mers posibles, sin colisiones; k=6
+# mantiene 4096 dimensiones (16 KiB por secuencia de referencia en la GPU)
+KMER_SIZE = 6
+N_FEATURES = 4 ** KMER_SIZE
+# Lotes densos de BATCH_SIZE x N_FEATURES float32 (128 MiB)
+BATCH_SIZE = 8192
+# Máximo de secuencias de referencia muestreadas al azar para entrenar el
+# cuantizador (~40 por lista invertida, como recomienda FAISS)
+TRAIN_SIZE = 50_000
+
+# Código 0-3 de cada base; 255 para las ambiguas (N, R, Y...)
+_BASE_CODES = np.full(256, 255, dtype=np.uint8)
+_BASE_CODES[np.frombuffer(b'ACGTacgt', dtype=np.uint8)] = [0, 1, 2, 3, 0, 1, 2, 3]
+_KMER_WEIGHTS = 4 ** np.arange(KMER_SIZE - 1, -1, -1)
+_COMPLEMENT = str.maketrans('ACGTacgt', 'TGCAtgca')
+
+
+def gpu_available():
+    """True si FAISS está instalado y detecta al menos una GPU"""
+    return FAISS_AVAILABLE and faiss.get_num_gpus() > 0
+
+
+def reverse_complement(sequence):
+    """Secuencia complementaria inversa (las bases ambiguas se mantienen)"""
+    return sequence.translate(_COMPLEMENT)[::-1]
+
+
+def kmer_counts(sequences):
+    """Matriz dispersa (secuencias x 4^k) con los recuentos exactos de k-mers
+
+    Las ventanas con bases ambiguas se omiten.
+    """
+    rows, cols = [], []
+    for i, sequence in enumerate(sequences):
+        codes = _BASE_CODES[np.frombuffer(sequence.encode(), dtype=np.uint8)]
+        if len(codes) < KMER_SIZE:
+            continue
+        windows = np.lib.stride_tricks.sliding_window_view(codes, KMER_SIZE)
+        kmers = windows[(windows != 255).all(axis=1)].astype(np.int64) @ _KMER_WEIGHTS
+        rows.append(np.full(len(kmers), i))
+        cols.append(kmers)
+    rows = np.concatenate(rows) if rows else np.empty(0, dtype=np.int64)
+    cols = np.concatenate(cols) if cols else np.empty(0, dtype=np.int64)
+    # Los pares (fila, k-mer) repetidos se suman al construir la matriz
+    return csr_matrix((np.ones(len(rows), dtype=np.float32), (rows, cols)),
+                      shape=(len(sequences), N_FEATURES))
+
+
+def _embed(sequences):
+    """Vectores densos float32 de k-mers L2-normalizados, calculados por lotes
+
+    Con vectores normalizados el producto interno equivale a la similitud coseno.
+    """
+    for start in range(0, len(sequences), BATCH_SIZE):
+        batch = kmer_counts(sequences[start:start + BATCH_SIZE]).toarray()
+        norms = np.linalg.norm(batch, axis=1, keepdims=True)
+        yield batch / np.maximum(norms, 1e-12)
+
+
+def build_index(reference_seqs, nlist=None, seed=0):
+    """Construye un índice IVF en la GPU con las secuencias de referencia
+
+    El cuantizador se entrena con una muestra aleatoria de ~40 secuencias
+    por lista (como máximo ``TRAIN_SIZE``) de toda la referencia, no con las
+    primeras, que suelen estar ordenadas por taxonomía.
+
+    Args:
+        reference_seqs: Lista de secuencias (str)
+        nlist: Número de listas invertidas (por defecto ~4·sqrt(N), como
+            máximo N: FAISS necesita al menos un punto de entrenamiento por lista)
+        seed: Semilla del muestreo de entrenamiento
+
+    Returns:
+        Índice FAISS en GPU
+    """
+    nlist = min(nlist or max(1, int(4 * np.sqrt(len(reference_seqs)))), len(reference_seqs))
+
+    quantizer = faiss.IndexFlatIP(N_FEATURES)
+    index = faiss.IndexIVFFlat(quantizer, N_FEATURES, nlist, faiss.METRIC_INNER_PRODUCT)
+    resources = faiss.StandardGpuResources()
+    gpu_index = faiss.index_cpu_to_gpu(resources, 0, index)
+    # Los recursos de GPU deben vivir tanto como el índice
+    gpu_index.referenced_objects = [resources]
+
+    rng = np.random.default_rng(seed)
+    sample = rng.choice(len(reference_seqs), size=min(40 * nlist, TRAIN_SIZE, len(reference_seqs)), replace=False)
+    gpu_index.train(np.concatenate(list(_embed([reference_seqs[i] for i in sample]))))
+    for batch in _embed(reference_seqs):
+        gpu_index.add(batch)
+
+    gpu_index.nprobe = min(nlist, 16)
+    return gpu_index
+
+
+def consensus_taxon(taxa, min_consensus=0.51):
+    """Consenso por rangos (LCA) de las taxonomías de los vecinos
+
+    Se desciende rango a rango mientras la etiqueta más frecuente alcance
+    ``min_consensus`` del total de vecinos (no solo de los que coincidieron
+    en el rango anterior), como el consenso de vsearch.
+
+    Returns:
+        tuple: (taxonomía de consenso, fracción de acuerdo en el último rango)
+    """
+    ranks = [[rank.strip() for rank in taxon.split(';')] for taxon in taxa]
+    if not ranks:
+        # Ningún vecino válido
+        return 'Unassigned', 0.0
+
+    n_hits = len(ranks)
+    lineage, agreement = [], 1.0
+    for level in range(max(len(r) for r in ranks)):
+        labels = Counter(r[level] for r in ranks if len(r) > level)
+        if not labels:
+            break
+        label, count = labels.most_common(1)[0]
+        if count / n_hits < min_consensus:
+            break
+        lineage.append(label)
+        agreement = count / n_hits
+        ranks = [r for r in ranks if len(r) > level and r[level] == label]
+
+    return (';'.join(lineage) or 'Unassigned'), agreement
+
+
+def classify_gpu(query, reference_seqs, reference_taxonomy, k=10, min_consensus=0.51):
+    """Clasifica secuencias por consenso de sus ``k`` vecinos de referencia más cercanos
+
+    Cada consulta se busca en ambas hebras y se usan los vecinos de la hebra
+    cuyo mejor vecino es más similar.
+
+    Args:
+        query: Diccionario {feature_id: secuencia}
+        reference_seqs: pandas.Series {id de referencia: secuencia}
+        reference_taxonomy: pandas.Series {id de referencia: taxonomía}
+        k: Número de vecinos
+        min_consensus: Fracción mínima de vecinos que deben coincidir en cada rango
+
+    Returns:
+        DataFrame: Columnas 'Taxon' y 'Consensus' indexadas por 'Feature ID'
+    """
+    reference_taxa = reference_taxonomy.reindex(reference_seqs.index).fillna('Unassigned').to_numpy()
+    index = build_index(reference_seqs.tolist())
+
+    feature_ids = list(query)
+    sequences = [query[f] for f in feature_ids]
+    rows = []
+    for forward, reverse in zip(_embed(sequences), _embed([reverse_complement(s) for s in sequences])):
+        scores, neighbors = index.search(forward, k)
+        rc_scores, rc_neighbors = index.search(reverse, k)
+        neighbors = np.where((rc_scores[:, :1] > scores[:, :1]), rc_neighbors, neighbors)
+        for hits in neighbors:
+            rows.append(consensus_taxon(reference_taxa[hits[hits >= 0]], min_consensus))
+
+    taxonomy = pd.DataFrame(rows, index=pd.Index(feature_ids, name='Feature ID'),
+                            columns=['Taxon', 'Consensus'])
+    return taxonomy
@@ -1,33 +1,150 @@
 # modules/phylogeny.py
+import hashlib
 import os
+import shutil
+import subprocess
+import tempfile
 from qiime2 import Artifact
-from qiime2.plugins.phylogeny.pipelines import align_to_tree_mafft_fasttree
+from modules.artifact_cache import (cache_subdir, cached_file_digest, evict_cache, link_or_copy, load_artifact,
+                                    touch_entry)
+from modules.utils import available_cpus, is_path
+from qiime2.plugins.alignment.methods import mafft, mask
+from qiime2.plugins.phylogeny.methods import fasttree, midpoint_root
 
+PHYLOGENY_OUTPUTS = ("unrooted_tree.qza", "rooted_tree.qza")
 
-def make_phylogeny(rep_seqs, output_folder):
+
+def _phylogeny_cache_key(rep_seqs_path, **settings):
+    """Clave de caché: SHA-256 de las secuencias y de los parámetros que afectan al árbol
+
+    El hash de las secuencias se recuerda por ruta, tamaño y fecha.
+    """
+    params_digest = hashlib.sha256(repr(sorted(settings.items())).encode()).hexdigest()
+    return f"{cached_file_digest(rep_seqs_path)}-{params_digest}"
+
+
+def resolve_tree_tool(tree_tool='fasttree'):
+    """Devuelve 'veryfasttree' o 'fasttree' según la opción y lo instalado"""
+    if tree_tool == 'auto':
+        return 'veryfasttree' if shutil.which('VeryFastTree') else 'fasttree'
+    return tree_tool
+
+
+def veryfasttree(masked_alignment, threads='auto', fastest=False):
+    """Infiere el árbol sin raíz con VeryFastTree (SIMD + OpenMP)
+
+    Usa el mismo modelo que el FastTree de q2-phylogeny (JC+CAT, el de
+    FastTree por defecto), de modo que el árbol y las métricas UniFrac/Faith
+    PD no dependen de la herramienta instalada. Se usa doble precisión para
+    evitar particiones erróneas en conjuntos grandes. Con ``fastest`` se
+    añade ``-fastest``, que acelera la búsqueda inicial en alineamientos muy
+    grandes a costa de algo de precisión.
+
+    Returns:
+        Artefacto Phylogeny[Unrooted]
+    """
+    n_threads = available_cpus() if threads == 'auto' else threads
+    # Ver el artefacto en su propio formato no copia datos
+    alignment_fp = os.path.join(str(masked_alignment.view(masked_alignment.format)), 'aligned-dna-sequences.fasta')
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tree_fp = os.path.join(tmpdir, 'unrooted.nwk')
+        with open(tree_fp, 'w') as out:
+            subprocess.run([
+                'VeryFastTree', '-nt', '-double-precision',
+                *(['-fastest'] if fastest else []),
+                '-threads', str(n_threads), alignment_fp
+            ], stdout=out, check=True)
+        return Artifact.import_data('Phylogeny[Unrooted]', tree_fp)
+
+
+def make_phylogeny(rep_seqs, output_folder, threads='auto', parttree=False, tree_tool='fasttree', fastest=False):
     """Generar árbol filogenético a partir de secuencias representativas
 
+    Ejecuta por separado MAFFT, el enmascarado del alineamiento, FastTree (o
+    VeryFastTree) y el enraizamiento en el punto medio, para controlar los
+    hilos y la herramienta de cada paso.
+
+    Con una ruta a las secuencias, los árboles se reutilizan desde la caché
+    (mediante enlaces duros) si ya se calcularon para el mismo contenido y
+    los mismos parámetros; el número de hilos no forma parte de la clave.
+    La caché se desactiva con ``--no-cache`` / ``MICROBIOME_NO_CACHE``.
+
     Args:
         rep_seqs: Ruta al artefacto QIIME2 de secuencias representativas o el artefacto mismo
         output_folder: Directorio donde guardar los resultados
+        threads: Hilos para MAFFT y FastTree ('auto' usa las CPUs disponibles para el proceso)
+        parttree: Usar el algoritmo PartTree de MAFFT (más rápido en conjuntos muy grandes)
+        tree_tool: 'fasttree', 'veryfasttree' o 'auto' (VeryFastTree si está instalado)
+        fastest: Usar el modo ``-fastest`` de VeryFastTree
 
     Returns:
         tuple: Rutas a los árboles sin raíz y con raíz
     """
     os.makedirs(output_folder, exist_ok=True)
+    tree_tool = resolve_tree_tool(tree_tool)
+    print(f"🌳 Herramienta de inferencia del árbol: {tree_tool}")
+    output_paths = [os.path.join(output_folder, name) for name in PHYLOGENY_OUTPUTS]
+
+    cache_entry = None
+    cache_dir = cache_subdir('phylogeny')
+    if is_path(rep_seqs):
+        if cache_dir is not None:
+            cache_entry = cache_dir / _phylogeny_cache_key(
+                rep_seqs, parttree=parttree, tree_tool=tree_tool, fastest=fastest,
+                model='jc-cat'
+            )
+        if cache_entry is not None and all((cache_entry / name).exists() for name in PHYLOGENY_OUTPUTS):
+            print(f"♻️  Árboles reutilizados de la caché: {cache_entry}")
+            touch_entry(cache_entry)
+            for name, path in zip(PHYLOGENY_OUTPUTS, output_paths):
+                # Un archivo previo puede ser un enlace a la caché: no sobrescribirlo en sitio
+                if os.path.exists(path):
+                    os.unlink(path)
+                link_or_copy(cache_entry / name, path)
+            return tuple(output_paths)
 
-    # Cargar artefacto si se pasa como string
-    if isinstance(rep_seqs, str):
-        rep_seqs = Artifact.load(rep_seqs)
+        rep_seqs = load_artifact(rep_seqs)
+
+    # Pasar un número explícito: el modo automático de MAFFT es conservador
+    if threads == 'auto':
+        threads = available_cpus()
 
     # Generar filogenia
-    phylo = align_to_tree_mafft_fasttree(sequences=rep_seqs, n_threads='auto')
+    alignment = mafft(sequences=rep_seqs, n_threads=threads, parttree=parttree).alignment
+    masked_alignment = mask(alignment=alignment).masked_alignment
+    if tree_tool == 'veryfasttree':
+        unrooted_tree = veryfasttree(masked_alignment, threads, fastest=fastest)
+    else:
+        unrooted_tree = fasttree(alignment=masked_alignment, n_threads=threads).tree
+    rooted_tree = midpoint_root(tree=unrooted_tree).rooted_tree
 
     # Guardar árboles
-    unrooted_tree = phylo.tree
-    rooted_tree = phylo.rooted_tree
+    for tree, path in zip((unrooted_tree, rooted_tree), output_paths):
+        if os.path.exists(path):
+            os.unlink(path)
+        tree.save(path)
+
+    if cache_entry is not None:
+        _store_trees(output_paths, cache_entry)
+
+    return tuple(output_paths)
 
-    unrooted_tree.save(f"{output_folder}/unrooted_tree.qza")
-    rooted_tree.save(f"{output_folder}/rooted_tree.qza")
 
-    return f"{output_folder}/unrooted_tree.qza", f"{output_folder}/rooted_tree.qza"
\ No newline at end of file
+def _store_trees(output_paths, cache_entry):
+    """Enlaza los árboles en la caché (renombrado atómico por archivo)
+
+    Solo se enlazan: si la caché está en otro sistema de archivos los árboles
+    no se duplican y no se guardan en ella.
+    """
+    cache_entry.mkdir(parents=True, exist_ok=True)
+    for name, path in zip(PHYLOGENY_OUTPUTS, output_paths):
+        partial = cache_entry / f".partial-{name}"
+        partial.unlink(missing_ok=True)
+        try:
+            os.link(path, partial)
+        except OSError:
+            print("ℹ️  La caché está en otro sistema de archivos: árboles no guardados en ella")
+            return
+        os.replace(partial, cache_entry / name)
+    evict_cache(keep=[cache_entry])
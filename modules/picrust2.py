@@ -1,32 +1,70 @@
 # modules/picrust2.py
+import collections
+import functools
 import os
 import subprocess
-import tempfile
 import pathlib
 import shutil
 from qiime2 import Artifact
+import numpy as np
 import pandas as pd
 import biom
-from qiime2.plugins.feature_table.methods import filter_features
 import click
+from modules.artifact_cache import unzip_qza_cached, load_artifact
+from modules.utils import is_path
 
+try:
+    import pyarrow
 
+    PYARROW_AVAILABLE = True
+except ImportError:
+    PYARROW_AVAILABLE = False
+
+
+# Líneas finales de la salida de PICRUSt2 incluidas en los mensajes de error
+LOG_TAIL_LINES = 200
+
+# Tamaño del búfer de escritura del TSV de rutas
+TSV_WRITE_BUFFER = 1 << 20
+
+
+@functools.lru_cache(maxsize=1)
 def check_picrust2_installation():
-    """Verifica si PICRUSt2 está instalado correctamente."""
-    try:
-        result = subprocess.run(['picrust2_pipeline.py', '--version'],
-                                capture_output=True, text=True, check=True)
-        return True
-    except (subprocess.CalledProcessError, FileNotFoundError):
-        return False
+    """Verifica si PICRUSt2 está instalado correctamente.
+
+    Basta con encontrar ``picrust2_pipeline.py`` en el PATH, sin lanzar el
+    script; el resultado se memoriza para el resto del proceso.
+    """
+    return shutil.which('picrust2_pipeline.py') is not None
+
+
+def remove_tree(path):
+    """Elimina un directorio completo
+
+    En POSIX se delega en ``rm -rf``, que recorre el árbol en C: las salidas
+    intermedias de PICRUSt2 tienen decenas de miles de archivos pequeños y
+    ``shutil.rmtree`` los elimina uno a uno desde Python.
+    """
+    if os.name == 'posix':
+        subprocess.run(['rm', '-rf', '--', str(path)], check=True)
+    else:
+        shutil.rmtree(path)
+
+
+def _artifact_data_dir(artifact):
+    """Directorio con los archivos de datos de un artefacto (ruta .qza o artefacto)"""
+    if is_path(artifact):
+        return next(unzip_qza_cached(artifact).glob('*/data'))
+    # Ver el artefacto en su propio formato no copia datos
+    return pathlib.Path(str(artifact.view(artifact.format)))
 
 
 def run_picrust2(table, rep_seqs, output_dir, threads=1):
     """Ejecuta PICRUSt2 para inferir rutas metabólicas.
 
     Args:
-        table: Ruta al artefacto QIIME2 de la tabla de características (.qza).
-        rep_seqs: Ruta al artefacto QIIME2 de secuencias representativas (.qza).
+        table: Ruta al artefacto QIIME2 de la tabla de características (.qza) o el artefacto mismo.
+        rep_seqs: Ruta al artefacto QIIME2 de secuencias representativas (.qza) o el artefacto mismo.
         output_dir: Directorio de salida para los resultados.
         threads: Número de hilos a usar.
 
@@ -36,7 +74,7 @@ def run_picrust2(table, rep_seqs, output_dir, threads=1):
     # Si el directorio de salida existe, eliminarlo
     if os.path.exists(output_dir):
         click.echo(f"🗑️  Eliminando directorio existente: {output_dir}")
-        shutil.rmtree(output_dir)
+        remove_tree(output_dir)
 
     os.makedirs(output_dir, exist_ok=True)
 
@@ -47,66 +85,46 @@ def run_picrust2(table, rep_seqs, output_dir, threads=1):
             "Instálalo con: conda install -c bioconda picrust2"
         )
 
-    # Cargar artefactos
-    table_artifact = Artifact.load(table)
-    rep_seqs_artifact = Artifact.load(rep_seqs)
-
-    # Exportar a archivos temporales
-    with tempfile.TemporaryDirectory() as tmpdir:
-        # Exportar tabla a formato BIOM
-        table_export_dir = os.path.join(tmpdir, 'table_export')
-        table_artifact.export_data(table_export_dir)
-
-        # Encontrar el archivo BIOM (puede tener diferentes nombres)
-        biom_files = list(pathlib.Path(table_export_dir).glob('*.biom'))
-        if not biom_files:
-            raise FileNotFoundError(f"No se encontró archivo BIOM en {table_export_dir}")
-        table_biom_path = str(biom_files[0])
-
-        # Exportar secuencias a FASTA
-        seqs_export_dir = os.path.join(tmpdir, 'seqs_export')
-        rep_seqs_artifact.export_data(seqs_export_dir)
-
-        # Encontrar el archivo FASTA (puede tener diferentes nombres)
-        fasta_files = list(pathlib.Path(seqs_export_dir).glob('*.fasta'))
-        if not fasta_files:
-            # Intentar con extensión .fna
-            fasta_files = list(pathlib.Path(seqs_export_dir).glob('*.fna'))
-        if not fasta_files:
-            raise FileNotFoundError(f"No se encontró archivo FASTA en {seqs_export_dir}")
-        rep_seqs_fasta_path = str(fasta_files[0])
-
-        # Verificar que los archivos se crearon correctamente
-        if not os.path.exists(table_biom_path):
-            raise FileNotFoundError(f"No se pudo exportar la tabla a: {table_biom_path}")
-        if not os.path.exists(rep_seqs_fasta_path):
-            raise FileNotFoundError(f"No se pudo exportar las secuencias a: {rep_seqs_fasta_path}")
-
-        click.echo(f"📁 Archivo BIOM: {table_biom_path}")
-        click.echo(f"📁 Archivo FASTA: {rep_seqs_fasta_path}")
-
-        # Ejecutar PICRUSt2
-        cmd = [
-            'picrust2_pipeline.py',
-            '-s', rep_seqs_fasta_path,
-            '-i', table_biom_path,
-            '-o', output_dir,
-            '--processes', str(threads),
-            '--verbose'  # Añadir verbose para más información
-        ]
-
-        try:
-            click.echo("🚀 Ejecutando PICRUSt2...")
-            result = subprocess.run(cmd, check=True, capture_output=True, text=True)
-            if result.stdout:
-                click.echo(f"📝 PICRUSt2 stdout: {result.stdout}")
-        except subprocess.CalledProcessError as e:
-            error_msg = f"PICRUSt2 failed with exit code {e.returncode}:\n"
-            if e.stdout:
-                error_msg += f"STDOUT: {e.stdout}\n"
-            if e.stderr:
-                error_msg += f"STDERR: {e.stderr}"
-            raise RuntimeError(error_msg)
+    # Los datos del artefacto se leen en su sitio: con una ruta desde la caché
+    # de .qza descomprimidos (compartida con alpha/beta-diversity) y con un
+    # artefacto desde su propio formato, sin exportarlo a un directorio temporal
+    table_dir = _artifact_data_dir(table)
+    biom_files = list(table_dir.glob('*.biom'))
+    if not biom_files:
+        raise FileNotFoundError(f"No se encontró archivo BIOM en {table_dir}")
+    table_biom_path = str(biom_files[0])
+
+    # Encontrar el archivo FASTA (puede tener diferentes nombres)
+    seqs_dir = _artifact_data_dir(rep_seqs)
+    fasta_files = list(seqs_dir.glob('*.fasta')) or list(seqs_dir.glob('*.fna'))
+    if not fasta_files:
+        raise FileNotFoundError(f"No se encontró archivo FASTA en {seqs_dir}")
+    rep_seqs_fasta_path = str(fasta_files[0])
+
+    click.echo(f"📁 Archivo BIOM: {table_biom_path}")
+    click.echo(f"📁 Archivo FASTA: {rep_seqs_fasta_path}")
+
+    # Ejecutar PICRUSt2
+    cmd = [
+        'picrust2_pipeline.py',
+        '-s', rep_seqs_fasta_path,
+        '-i', table_biom_path,
+        '-o', output_dir,
+        '--processes', str(threads),
+        '--verbose'  # Añadir verbose para más información
+    ]
+
+    # La salida se muestra a medida que llega y solo se retienen las
+    # últimas líneas para el mensaje de error
+    click.echo("🚀 Ejecutando PICRUSt2...")
+    tail = collections.deque(maxlen=LOG_TAIL_LINES)
+    with subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True,
+                          bufsize=1) as proc:
+        for line in proc.stdout:
+            click.echo(f"📝 {line}", nl=False)
+            tail.append(line)
+    if proc.returncode != 0:
+        raise RuntimeError(f"PICRUSt2 failed with exit code {proc.returncode}:\n{''.join(tail)}")
 
     # Verificar que los archivos de salida se crearon
     pathway_abundance_biom = os.path.join(output_dir, 'pathway_abundance.biom')
@@ -123,10 +141,12 @@ def run_picrust2(table, rep_seqs, output_dir, threads=1):
                 f"Archivos encontrados: {all_files}"
             )
 
-    # Convertir el archivo BIOM de rutas a artefacto QIIME2
+    # El BIOM de rutas se parsea una sola vez: artefacto QIIME2 y TSV se
+    # generan desde la misma tabla en memoria
     pathway_abundance_qza = os.path.join(output_dir, 'pathway_abundance.qza')
     try:
-        pathway_abundance = Artifact.import_data('FeatureTable[Frequency]', pathway_abundance_biom)
+        table_biom = biom.load_table(pathway_abundance_biom)
+        pathway_abundance = Artifact.import_data('FeatureTable[Frequency]', table_biom)
         pathway_abundance.save(pathway_abundance_qza)
     except Exception as e:
         raise RuntimeError(f"Error importing BIOM to QIIME2: {str(e)}")
@@ -134,8 +154,9 @@ def run_picrust2(table, rep_seqs, output_dir, threads=1):
     # También generar el archivo TSV
     pathway_abundance_tsv = os.path.join(output_dir, 'pathway_abundance.tsv')
     try:
-        table_biom = biom.load_table(pathway_abundance_biom)
-        with open(pathway_abundance_tsv, 'w') as f:
+        # to_tsv escribe línea a línea: un búfer grande agrupa las escrituras
+        # en pocas llamadas al sistema sin retener todo el TSV en memoria
+        with open(pathway_abundance_tsv, 'w', buffering=TSV_WRITE_BUFFER) as f:
             table_biom.to_tsv(header_key='KEGG_Pathways', header_value='KEGG_Pathways', direct_io=f)
     except Exception as e:
         print(f"Warning: Could not create TSV file: {str(e)}")
@@ -143,7 +164,8 @@ def run_picrust2(table, rep_seqs, output_dir, threads=1):
     return {
         'pathway_abundance_biom': pathway_abundance_biom,
         'pathway_abundance_tsv': pathway_abundance_tsv,
-        'pathway_abundance_qza': pathway_abundance_qza
+        'pathway_abundance_qza': pathway_abundance_qza,
+        'pathway_abundance_table': table_biom
     }
 
 
@@ -157,16 +179,60 @@ def filter_low_abundance_pathways(pathway_table, min_abundance=0.001):
     Returns:
         Artefacto QIIME2 filtrado.
     """
-    if isinstance(pathway_table, str):
-        pathway_table = Artifact.load(pathway_table)
+    if is_path(pathway_table):
+        pathway_table = load_artifact(pathway_table)
+
+    # Filtrar rutas cuya frecuencia total no alcanza el mínimo (mismo criterio
+    # que filter_features) con una máscara NumPy sobre la tabla BIOM
+    table = pathway_table.view(biom.Table)
+    totals = table.sum(axis='observation')
+    keep = table.ids(axis='observation')[totals >= min_abundance]
+    filtered_table = table.filter(keep, axis='observation', inplace=False)
 
-    # Filtrar características con baja abundancia
-    filtered_table = filter_features(
-        table=pathway_table,
-        min_frequency=min_abundance
-    )
+    return Artifact.import_data('FeatureTable[Frequency]', filtered_table)
 
-    return filtered_table.filtered_table
+
+def filter_and_normalize(pathway_table, min_abundance=0.001, filtered_output=None):
+    """Filtra rutas de baja abundancia y normaliza a porcentajes en una sola pasada.
+
+    Una ruta se conserva si su abundancia relativa media entre muestras es al
+    menos ``min_abundance``. Los porcentajes se calculan sobre las rutas
+    conservadas, igual que normalizar la tabla filtrada.
+
+    Args:
+        pathway_table: biom.Table o ruta al archivo BIOM de rutas metabólicas.
+        min_abundance: Abundancia relativa media mínima (0-1) para mantener una ruta.
+        filtered_output: Ruta .qza donde guardar la tabla filtrada (opcional).
+
+    Returns:
+        DataFrame normalizado (rutas x muestras).
+    """
+    if is_path(pathway_table):
+        pathway_table = biom.load_table(str(pathway_table))
+
+    # Se trabaja en CSR: las tablas de rutas son muy dispersas y solo la
+    # tabla final (ya filtrada) se densifica
+    counts = pathway_table.matrix_data.tocsr()
+    keep = np.asarray(counts.multiply(_inverse(counts.sum(axis=0))).mean(axis=1)).ravel() >= min_abundance
+
+    filtered = counts[keep]
+    pathway_ids = pathway_table.ids(axis='observation')[keep]
+    sample_ids = pathway_table.ids(axis='sample')
+
+    if filtered_output:
+        Artifact.import_data(
+            'FeatureTable[Frequency]', biom.Table(filtered, pathway_ids, sample_ids)
+        ).save(filtered_output)
+
+    normalized = filtered.multiply(_inverse(filtered.sum(axis=0)) * 100)
+
+    return pd.DataFrame(normalized.toarray(), index=pathway_ids, columns=sample_ids)
+
+
+def _inverse(totals):
+    """Inverso de los totales por muestra (0 donde el total es 0), como fila 1 x n"""
+    totals = np.asarray(totals, dtype=float).ravel()
+    return np.divide(1.0, totals, out=np.zeros_like(totals), where=totals > 0)[np.newaxis, :]
 
 
 def normalize_pathway_abundance(pathway_table):
@@ -176,25 +242,15 @@ def normalize_pathway_abundance(pathway_table):
         pathway_table: Ruta al artefacto QIIME2 de rutas metabólicas.
 
     Returns:
-        DataFrame normalizado.
+        DataFrame normalizado (denso).
     """
-    if isinstance(pathway_table, str):
-        pathway_table = Artifact.load(pathway_table)
-
-    # Exportar a DataFrame temporal
-    with tempfile.TemporaryDirectory() as tmpdir:
-        pathway_table.export_data(tmpdir)
-        data_dir_fp = pathlib.Path(tmpdir)
-        csv_files = list(data_dir_fp.glob('*.tsv'))
-        if not csv_files:
-            csv_files = list(data_dir_fp.glob('*.csv'))
-        if not csv_files:
-            raise FileNotFoundError(f"No se encontraron archivos TSV o CSV en {tmpdir}")
-
-        csv_file = csv_files[0]
-        df = pd.read_csv(csv_file, sep='\t', index_col=0)
-
-    # Normalizar a porcentajes por muestra
-    df_normalized = df.div(df.sum(axis=0), axis=1) * 100
-
-    return df_normalized
\ No newline at end of file
+    if is_path(pathway_table):
+        pathway_table = load_artifact(pathway_table)
+
+    # Normalizar a porcentajes por muestra sobre la matriz CSR, sin exportar
+    # a TSV; solo el resultado se densifica
+    table = pathway_table.view(biom.Table)
+    counts = table.matrix_data.tocsr()
+    normalized = counts.multiply(_inverse(counts.sum(axis=0)) * 100)
+
+    return pd.DataFrame(normalized.toarray(), index=table.ids(axis='observation'), columns=table.ids(axis='sample'))
@@ -1,32 +1,77 @@
 """
 Utilidades para QIIME2
 """
+import csv
+import functools
+import mmap
+import os
+import re
 import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from qiime2 import Artifact
+from modules.io_utils import open_fastq
 
+READ_BLOCK_SIZE = 1 << 20
+MANIFEST_COLUMNS = ('sample-id', 'absolute-filepath', 'direction')
 
-def create_fasta_manifest(input_dir, output_file="fasta_manifest.csv"):
+# Marcadores comunes de lectura forward/reverse (_1, _R1_, .1., _forward, _F...):
+# el número debe ir seguido de '_' o '.' para no confundirlo con el ID de muestra
+FORWARD_READ = re.compile(r'[_.]R?1(?=[_.])|_forward|_F(?=[_.])')
+REVERSE_READ = re.compile(r'[_.]R?2(?=[_.])|_reverse|_R(?=[_.])')
+
+
+def create_fasta_manifest(input_dir, output_file="fasta_manifest.csv", validate_pairs=False):
     """
     Crea un archivo de manifiesto para QIIME2 a partir de archivos FASTQ
+
+    Las filas son tuplas ``MANIFEST_COLUMNS`` que se escriben de una vez con
+    ``csv.writer``, sin construir un DataFrame intermedio. Con ``validate_pairs=True`` se cuentan los reads de
+    cada par forward/reverse y se excluyen las muestras cuyo número de reads
+    no coincide.
     """
     input_path = Path(input_dir)
-    manifest_data = []
 
     print(f"🔍 Buscando archivos FASTQ en {input_dir}...")
 
     # Buscar todas las carpetas de muestras
-    sample_dirs = [d for d in input_path.iterdir() if d.is_dir()]
+    with os.scandir(input_path) as it:
+        sample_dirs = [Path(entry.path) for entry in it if entry.is_dir()]
 
     if not sample_dirs:
         print("❌ No se encontraron carpetas de muestras")
         return None
 
-    for sample_dir in sample_dirs:
-        sample_id = sample_dir.name
+    # Listar las carpetas en paralelo: en sistemas de archivos de red la
+    # latencia de metadatos domina y las llamadas se pueden solapar
+    with ThreadPoolExecutor(max_workers=32) as executor:
+        scanned = list(executor.map(_scan_fastq_files, sample_dirs))
+
+    manifest_rows = list(_manifest_rows(sample_dirs, scanned))
+    if validate_pairs:
+        manifest_rows = _drop_unmatched_pairs(manifest_rows)
+
+    if not manifest_rows:
+        print("❌ No se encontraron datos válidos para el manifiesto")
+        return None
 
-        # Buscar archivos FASTQ en la carpeta de la muestra
-        fastq_files = list(sample_dir.glob("*.fastq")) + list(sample_dir.glob("*.fastq.gz"))
+    with open(output_file, 'w', newline='', buffering=1 << 20) as f:
+        writer = csv.writer(f)
+        writer.writerow(MANIFEST_COLUMNS)
+        writer.writerows(manifest_rows)
+
+    samples = {sample_id for sample_id, _, _ in manifest_rows}
+    print(f"✅ Manifest file creado: {output_file}")
+    print(f"   • Muestras procesadas: {len(samples)}")
+    print(f"   • Entradas en el manifest: {len(manifest_rows)}")
+
+    return output_file
+
+
+def _manifest_rows(sample_dirs, scanned):
+    """Genera las filas (sample-id, absolute-filepath, direction) de cada carpeta de muestra"""
+    for sample_dir, fastq_files in zip(sample_dirs, scanned):
+        sample_id = sample_dir.name
 
         if not fastq_files:
             print(f"⚠️  No se encontraron archivos FASTQ en {sample_dir}")
@@ -35,11 +80,7 @@ def create_fasta_manifest(input_dir, output_file="fasta_manifest.csv"):
         # Determinar si es single-end o paired-end
         if len(fastq_files) == 1:
             # Single-end
-            manifest_data.append({
-                'sample-id': sample_id,
-                'absolute-filepath': str(fastq_files[0].resolve()),
-                'direction': 'forward'
-            })
+            yield sample_id, str(fastq_files[0].resolve()), 'forward'
             print(f"📄 {sample_id}: Single-end -> {fastq_files[0].name}")
 
         elif len(fastq_files) == 2:
@@ -47,56 +88,79 @@ def create_fasta_manifest(input_dir, output_file="fasta_manifest.csv"):
             forward, reverse = identify_reads(fastq_files, sample_id)
 
             if forward and reverse:
-                manifest_data.append({
-                    'sample-id': sample_id,
-                    'absolute-filepath': str(forward.resolve()),
-                    'direction': 'forward'
-                })
-                manifest_data.append({
-                    'sample-id': sample_id,
-                    'absolute-filepath': str(reverse.resolve()),
-                    'direction': 'reverse'
-                })
+                yield sample_id, str(forward.resolve()), 'forward'
+                yield sample_id, str(reverse.resolve()), 'reverse'
                 print(f"📄 {sample_id}: Paired-end -> {forward.name}, {reverse.name}")
             else:
                 print(f"⚠️  No se pudieron identificar reads forward/reverse para {sample_id}")
         else:
             print(f"⚠️  Número inesperado de archivos FASTQ en {sample_dir}: {len(fastq_files)}")
 
-    if not manifest_data:
-        print("❌ No se encontraron datos válidos para el manifiesto")
-        return None
 
-    # Crear DataFrame y guardar en formato CSV
-    df = pd.DataFrame(manifest_data)
-    df.to_csv(output_file, index=False)
+def _scan_fastq_files(sample_dir):
+    """Devuelve los archivos FASTQ (.fastq / .fastq.gz) de una carpeta de muestra"""
+    with os.scandir(sample_dir) as it:
+        return [
+            Path(entry.path) for entry in it
+            if entry.name.endswith(('.fastq', '.fastq.gz')) and entry.is_file()
+        ]
 
-    print(f"✅ Manifest file creado: {output_file}")
-    print(f"   • Muestras procesadas: {len(set([d['sample-id'] for d in manifest_data]))}")
-    print(f"   • Entradas en el manifest: {len(manifest_data)}")
 
-    return output_file
+def count_fastq_reads(fastq_path):
+    """Cuenta los reads de un FASTQ (.fastq o .fastq.gz) contando saltos de línea
+
+    ``bytes.count`` delega en ``memchr``, muy superior a iterar línea a línea
+    en Python. Los archivos sin comprimir se recorren mediante ``mmap``.
+    """
+    fastq_path = Path(fastq_path)
+    newlines = 0
+
+    if fastq_path.suffix == '.gz':
+        with open_fastq(fastq_path) as f:
+            for block in iter(lambda: f.read(READ_BLOCK_SIZE), b''):
+                newlines += block.count(b'\n')
+    elif fastq_path.stat().st_size > 0:
+        with open(fastq_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            for start in range(0, len(m), READ_BLOCK_SIZE):
+                newlines += m[start:start + READ_BLOCK_SIZE].count(b'\n')
+
+    # Tolerar que el último registro no termine en salto de línea
+    return (newlines + 3) // 4
+
+
+def _drop_unmatched_pairs(manifest_data):
+    """Excluye del manifiesto las muestras paired-end con distinto número de reads"""
+    paths = [path for _, path, _ in manifest_data]
+    with ThreadPoolExecutor(max_workers=max(1, min(32, len(paths)))) as executor:
+        counts = dict(zip(paths, executor.map(count_fastq_reads, paths)))
+
+    reads_by_sample = {}
+    for sample_id, path, direction in manifest_data:
+        reads_by_sample.setdefault(sample_id, {})[direction] = counts[path]
+
+    unmatched = set()
+    for sample_id, reads in reads_by_sample.items():
+        if 'reverse' in reads and reads['forward'] != reads['reverse']:
+            print(f"⚠️  {sample_id}: reads forward ({reads['forward']}) y reverse ({reads['reverse']}) "
+                  f"no coinciden, se excluye del manifiesto")
+            unmatched.add(sample_id)
+
+    return [row for row in manifest_data if row[0] not in unmatched]
 
 
 def identify_reads(fastq_files, sample_id):
     """
     Identifica qué archivo es forward y cuál es reverse
     """
-    # Patrones comunes para identificar forward/reverse
-    forward_patterns = ['_1', '_R1', '_R1_', '.1.', '_forward', '_F', 'R1']
-    reverse_patterns = ['_2', '_R2', '_R2_', '.2.', '_reverse', '_R', 'R2']
-
     forward_candidates = []
     reverse_candidates = []
 
     for fq_file in fastq_files:
         filename = fq_file.name
 
-        # Verificar patrones forward
-        if any(pattern in filename for pattern in forward_patterns):
+        if FORWARD_READ.search(filename):
             forward_candidates.append(fq_file)
-        # Verificar patrones reverse
-        elif any(pattern in filename for pattern in reverse_patterns):
+        elif REVERSE_READ.search(filename):
             reverse_candidates.append(fq_file)
 
     # Si encontramos exactamente uno de cada, perfecto
@@ -164,8 +228,9 @@ def import_to_qiime2(manifest_file, output_dir="data/qiime2"):
         return None
 
 
+@functools.lru_cache(maxsize=1)
 def check_qiime2_installation():
-    """Verifica que QIIME2 esté instalado y disponible"""
+    """Verifica que QIIME2 esté instalado y disponible (resultado memorizado)"""
     try:
         # Solo verificamos que podemos importar Artifact
         from qiime2 import Artifact
@@ -1,10 +1,19 @@
 """
 Módulo para control de calidad - Gráficos y filtrado
 """
+import matplotlib
+
+# Backend no interactivo: evita la negociación de backend y solo rasteriza al guardar
+matplotlib.use('Agg')
 import matplotlib.pyplot as plt
+import numpy as np
 from pathlib import Path
 from qiime2 import Artifact
 from qiime2.plugins.demux.visualizers import summarize
+from qiime2.plugins.quality_filter.methods import q_score
+from modules.artifact_cache import load_artifact
+from modules.io_utils import open_fastq
+from modules.utils import is_path
 
 try:
     import dokdo
@@ -15,6 +24,118 @@ except ImportError:
     print("⚠️  dokdo no está instalado. Los gráficos de calidad no estarán disponibles.")
     print("   Instala con: pip install dokdo")
 
+READ_BLOCK_SIZE = 1 << 20
+PHRED_OFFSET = 33
+# Resolución de los gráficos PNG (las figuras de líneas no necesitan más)
+PNG_DPI = 150
+
+
+def _save_figure(fig, output_file):
+    """Guarda una figura; en SVG (por defecto) no hay rasterizado con Agg
+
+    Para PNG se rasteriza a ``PNG_DPI`` y sin ``bbox_inches='tight'``, que
+    obliga a dibujar la figura dos veces: el margen lo ajusta
+    ``tight_layout`` antes de guardar.
+    """
+    if Path(output_file).suffix.lower() == '.png':
+        fig.savefig(output_file, dpi=PNG_DPI)
+    else:
+        fig.savefig(output_file)
+
+
+def _read_blocks(f):
+    """Lee bloques binarios garantizando que el último termine en salto de línea"""
+    last = b'\n'
+    for block in iter(lambda: f.read(READ_BLOCK_SIZE), b''):
+        last = block[-1:]
+        yield block
+    if last != b'\n':
+        yield b'\n'
+
+
+def iter_fastq_qualities(fastq_path):
+    """Itera las líneas de calidad (bytes) de un FASTQ (.fastq o .fastq.gz)
+
+    Aprovecha que la línea de calidad mide lo mismo que la secuencia: tras
+    localizar el fin de la secuencia solo se busca el fin de la línea '+',
+    y la calidad se toma avanzando ``len(seq)`` bytes y validando el
+    terminador, sin volver a buscar saltos de línea sobre ella.
+    """
+    with open_fastq(fastq_path) as f:
+        buf = b''
+        for block in _read_blocks(f):
+            buf += block
+            pos = 0
+            while True:
+                header_end = buf.find(b'\n', pos)
+                if header_end < 0:
+                    break
+                seq_end = buf.find(b'\n', header_end + 1)
+                if seq_end < 0:
+                    break
+                plus_end = buf.find(b'\n', seq_end + 1)
+                if plus_end < 0:
+                    break
+
+                qual_start = plus_end + 1
+                qual_end = qual_start + (seq_end - header_end - 1)
+                if qual_end >= len(buf):
+                    break
+
+                if buf[pos] != ord('@') or buf[seq_end + 1] != ord('+') or buf[qual_end] != ord('\n'):
+                    raise ValueError(f"Registro FASTQ malformado en {fastq_path}")
+
+                yield buf[qual_start:qual_end]
+                pos = qual_end + 1
+
+            buf = buf[pos:]
+
+
+def quality_profile(fastq_files):
+    """Calcula la calidad Phred media por posición sobre todos los reads
+
+    Args:
+        fastq_files: Lista de archivos FASTQ de una misma dirección
+
+    Returns:
+        numpy.ndarray: Calidad media en cada posición del read
+    """
+    sums = np.zeros(0, dtype=np.int64)
+    counts = np.zeros(0, dtype=np.int64)
+    for fastq_file in fastq_files:
+        for qual in iter_fastq_qualities(fastq_file):
+            # Sin copia: los bytes ASCII se interpretan directamente como uint8
+            q = np.frombuffer(qual, dtype=np.uint8)
+            if q.size > sums.size:
+                sums = np.pad(sums, (0, q.size - sums.size))
+                counts = np.pad(counts, (0, q.size - counts.size))
+            sums[:q.size] += q
+            counts[:q.size] += 1
+
+    # El offset Phred se resta una sola vez al final en lugar de por base
+    return (sums - PHRED_OFFSET * counts) / counts
+
+
+def quality_bands(fastq_files, percentiles=(25, 50, 75)):
+    """Calcula percentiles por posición de la calidad media de cada muestra
+
+    Args:
+        fastq_files: Lista de archivos FASTQ (uno por muestra) de una misma dirección
+        percentiles: Percentiles a calcular
+
+    Returns:
+        numpy.ndarray: Matriz (len(percentiles), longitud máxima del read)
+    """
+    profiles = [quality_profile([fastq_file]) for fastq_file in fastq_files]
+    max_len = max(profile.size for profile in profiles)
+
+    # Rellenar con NaN las muestras con reads más cortos
+    matrix = np.full((len(profiles), max_len), np.nan)
+    for i, profile in enumerate(profiles):
+        matrix[i, :profile.size] = profile
+
+    return np.nanpercentile(matrix, percentiles, axis=0)
+
 
 class QualityControl:
     """Clase para control de calidad completo"""
@@ -24,8 +145,8 @@ class QualityControl:
         Args:
             demux_artifact: Path al archivo .qza o objeto Artifact de QIIME2
         """
-        if isinstance(demux_artifact, (str, Path)):
-            self.demux_seqs = Artifact.load(str(demux_artifact))
+        if is_path(demux_artifact):
+            self.demux_seqs = load_artifact(demux_artifact)
         else:
             self.demux_seqs = demux_artifact
 
@@ -54,7 +175,7 @@ class QualityControl:
 
         # Paso 2: Gráficos de calidad
         print("📈 Paso 2/3: Creando gráficos de perfil de calidad...")
-        plot_path = self.plot_quality_profile(output_path / "quality_profile.png")
+        plot_path = self.plot_quality_profile(output_path / "quality_profile.svg")
 
         # Paso 3: Filtrado de calidad
         print("🔧 Paso 3/3: Aplicando filtrado de calidad...")
@@ -87,11 +208,11 @@ class QualityControl:
 
         return viz_path
 
-    def plot_quality_profile(self, output_file="quality_profile.png", figsize=(15, 6)):
+    def plot_quality_profile(self, output_file="quality_profile.svg", figsize=(15, 6)):
         """Genera gráficos de perfil de calidad usando dokdo"""
         if not DOKDO_AVAILABLE:
-            print("❌ dokdo no está disponible para generar gráficos")
-            return None
+            print("ℹ️  dokdo no está disponible, calculando el perfil de calidad desde los FASTQ")
+            return self.plot_fastq_quality_profile(output_file, figsize)
 
         if self.quality_visualization is None:
             self.create_quality_visualization()
@@ -118,8 +239,55 @@ class QualityControl:
             ax.set_xlabel('Posición en el read', fontsize=11)
             ax.set_ylabel('Score de Calidad', fontsize=11)
 
-        plt.tight_layout()
-        plt.savefig(output_file, dpi=300, bbox_inches='tight')
+        fig.tight_layout()
+        _save_figure(fig, output_file)
+        plt.close(fig)
+        print(f"✅ Gráfico de calidad guardado: {output_file}")
+
+        return output_file
+
+    def plot_fastq_quality_profile(self, output_file="quality_profile.svg", figsize=(15, 6)):
+        """Genera gráficos de perfil de calidad leyendo directamente los FASTQ del artefacto
+
+        Detecta si los datos son single-end o paired-end por los nombres
+        Casava (``_R1_`` / ``_R2_``) y dibuja un panel por dirección con la
+        mediana entre muestras y la banda del rango intercuartílico. Si
+        ningún archivo sigue ese patrón, todos los ``.fastq.gz`` se tratan
+        como lecturas forward.
+
+        Raises:
+            ValueError: Si el artefacto no contiene archivos FASTQ
+        """
+        print(f"📊 Generando gráfico de calidad...")
+
+        # Ver el artefacto en su propio formato no copia datos: los FASTQ se
+        # leen en su sitio en lugar de exportarlos a un directorio temporal
+        fastq_dir = Path(str(self.demux_seqs.view(self.demux_seqs.format)))
+        strands = {
+            'forward': sorted(fastq_dir.glob('*_R1_*.fastq.gz')),
+            'reverse': sorted(fastq_dir.glob('*_R2_*.fastq.gz')),
+        }
+        if not any(strands.values()):
+            strands = {'forward': sorted(fastq_dir.glob('*.fastq.gz'))}
+        if not strands['forward'] and not strands.get('reverse'):
+            raise ValueError(f"No se encontraron archivos FASTQ en el artefacto ({fastq_dir})")
+        bands = {strand: quality_bands(files) for strand, files in strands.items() if files}
+
+        fig, axes = plt.subplots(1, len(bands), figsize=figsize, squeeze=False)
+
+        for ax, (strand, (q25, median, q75)) in zip(axes[0], bands.items()):
+            positions = np.arange(1, median.size + 1)
+            # Un único artista por banda en lugar de uno por posición
+            ax.fill_between(positions, q25, q75, alpha=0.3, linewidth=0, rasterized=True)
+            ax.plot(positions, median)
+            ax.set_title(f'Read {strand.capitalize()} - Calidad', fontsize=12, fontweight='bold')
+            ax.tick_params(axis='both', which='major', labelsize=10)
+            ax.set_xlabel('Posición en el read', fontsize=11)
+            ax.set_ylabel('Score de Calidad', fontsize=11)
+
+        fig.tight_layout()
+        _save_figure(fig, output_file)
+        plt.close(fig)
         print(f"✅ Gráfico de calidad guardado: {output_file}")
 
         return output_file
@@ -132,8 +300,6 @@ class QualityControl:
             output_dir: Directorio de salida
             min_quality: Calidad mínima promedio
         """
-        from qiime2.plugins.quality_filter.methods import q_score
-
         output_path = Path(output_dir)
         output_path.mkdir(parents=True, exist_ok=True)
 
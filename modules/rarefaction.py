@@ -0,0 +1,91 @@
+# modules/rarefaction.py
+"""
+Rarefacción múltiple: promedia métricas sobre varios submuestreos de la tabla
+en lugar de depender de un único sorteo
+"""
+import numpy as np
+
+try:
+    from joblib import Parallel, delayed
+
+    JOBLIB_AVAILABLE = True
+except ImportError:
+    JOBLIB_AVAILABLE = False
+
+
+def rarefy(counts, depth, seed):
+    """Submuestrea sin reemplazo cada fila de ``counts`` a ``depth`` lecturas
+
+    Args:
+        counts: Matriz entera muestras x features (todas las filas con al menos ``depth``)
+        depth: Profundidad de rarefacción
+        seed: Semilla del generador
+
+    Returns:
+        numpy.ndarray: Matriz rarefactada de la misma forma
+    """
+    rng = np.random.default_rng(seed)
+    return np.stack([rng.multivariate_hypergeometric(row, depth) for row in counts])
+
+
+def samples_at_depth(counts, depth):
+    """Máscara de las muestras con al menos ``depth`` lecturas"""
+    return counts.sum(axis=1) >= depth
+
+
+def _one_draw(counts, depth, seed, compute):
+    return compute(rarefy(counts, depth, seed))
+
+
+def rarefied_mean(counts, depth, n_iterations, compute, n_jobs=-1):
+    """Promedia ``compute`` sobre ``n_iterations`` rarefacciones independientes
+
+    Los sorteos se reparten entre procesos con joblib si está disponible.
+
+    Args:
+        counts: Matriz entera muestras x features
+        depth: Profundidad de rarefacción
+        n_iterations: Número de sorteos
+        compute: Función (a nivel de módulo) que recibe la matriz rarefactada y
+            devuelve un diccionario {nombre: numpy.ndarray}
+        n_jobs: Procesos de joblib (-1 = todos)
+
+    Returns:
+        dict: {nombre: media de los arrays de cada sorteo}
+    """
+    counts = np.rint(counts).astype(np.int64)
+    seeds = range(n_iterations)
+
+    if JOBLIB_AVAILABLE:
+        draws = Parallel(n_jobs=n_jobs)(delayed(_one_draw)(counts, depth, seed, compute) for seed in seeds)
+    else:
+        draws = [_one_draw(counts, depth, seed, compute) for seed in seeds]
+
+    return {key: np.mean([draw[key] for draw in draws], axis=0) for key in draws[0]}
+
+
+def rarefied_table(table, depth, seed=0):
+    """Artefacto FeatureTable[Frequency] rarefactado con un único sorteo
+
+    Para las métricas delegadas en QIIME2 o en UniFrac, que no se pueden
+    promediar sobre varios sorteos sin repetir todo el cálculo. Se descartan
+    las mismas muestras que en :func:`rarefied_mean` (menos de ``depth``
+    lecturas), de modo que todas las métricas cubren las mismas muestras.
+
+    Args:
+        table: Ruta al .qza de la tabla de frecuencias o el artefacto mismo
+        depth: Profundidad de rarefacción
+        seed: Semilla del sorteo
+
+    Returns:
+        Artefacto FeatureTable[Frequency]
+    """
+    import biom
+    from qiime2 import Artifact
+    from modules.artifact_cache import table_counts
+
+    sample_ids, feature_ids, counts = table_counts(table)
+    keep = samples_at_depth(counts, depth)
+    counts = rarefy(np.rint(counts[keep]).astype(np.int64), depth, seed)
+    return Artifact.import_data('FeatureTable[Frequency]',
+                                biom.Table(counts.T, list(feature_ids), list(sample_ids[keep])))
@@ -1,12 +1,26 @@
 # modules/taxa.py
+import numpy as np
 import pandas as pd
 import tempfile
 import pathlib
 import os
+import hashlib
+import json
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from qiime2 import Artifact, Metadata
+from modules.artifact_cache import cache_enabled, unzip_qza_cached, load_artifact
+from modules.kmer_classifier import gpu_available, classify_gpu
+from modules.utils import is_path
 from qiime2.plugins.feature_classifier.pipelines import classify_consensus_vsearch
 from qiime2.plugins.taxa.visualizers import barplot
 
+try:
+    import pyarrow
+
+    PYARROW_AVAILABLE = True
+except ImportError:
+    PYARROW_AVAILABLE = False
+
 
 def import_database_to_qiime2(filename_seqs, filename_taxa, output_dir):
     """Importar base de datos de referencia a Qiime2"""
@@ -23,75 +37,352 @@ def import_database_to_qiime2(filename_seqs, filename_taxa, output_dir):
 
 def load_reference_DB_artifact(filename_seqs_artifact, filename_taxa_artifact):
     """Cargar artefactos de base de datos de referencia"""
-    seq = Artifact.load(filename_seqs_artifact)
-    taxa = Artifact.load(filename_taxa_artifact)
+    seq = load_artifact(filename_seqs_artifact)
+    taxa = load_artifact(filename_taxa_artifact)
     return seq, taxa
 
 
 def normalized_df(dataframe):
-    """Normalizar dataframe a porcentajes"""
-    columns = dataframe.columns
-    for column in columns:
-        dataframe[column] = (dataframe[column] / dataframe[column].sum()) * 100
-    return dataframe
+    """Normalizar dataframe a porcentajes
 
+    Todas las columnas se normalizan con una única operación vectorizada
+    sobre la matriz; las columnas sin lecturas quedan a 0. Los porcentajes
+    se calculan en float32 (suficiente para gráficos y exportación), lo que
+    reduce a la mitad la memoria recorrida; los totales se acumulan en float64.
+    """
+    percentages = dataframe.to_numpy(dtype=np.float32)
+    totals = percentages.sum(axis=0, dtype=np.float64)
+    scale = np.divide(100.0, totals, out=np.zeros_like(totals), where=totals > 0)
+    percentages *= scale.astype(np.float32)
+    return pd.DataFrame(percentages, index=dataframe.index, columns=dataframe.columns)
 
-def taxa_assigner(table, rep_seqs, seqs_ref, taxa_ref, metadata_filename, cpus, output_folder):
-    """Asignar taxonomía y generar archivos CSV por nivel taxonómico"""
-    os.makedirs(output_folder, exist_ok=True)
 
-    # Cargar artefactos si se pasan como paths
-    if isinstance(table, str):
-        table = Artifact.load(table)
-    if isinstance(rep_seqs, str):
-        rep_seqs = Artifact.load(rep_seqs)
-    if isinstance(seqs_ref, str):
-        seqs_ref = Artifact.load(seqs_ref)
-    if isinstance(taxa_ref, str):
-        taxa_ref = Artifact.load(taxa_ref)
-
-    # Clasificación taxonómica
-    taxonomy = classify_consensus_vsearch(
-        query=rep_seqs,
+def split_fasta(fasta_path, shards, output_dir):
+    """Reparte los registros de un FASTA en ``shards`` archivos de tamaño similar"""
+    handles = [open(pathlib.Path(output_dir) / f"shard_{i}.fasta", 'w') for i in range(shards)]
+    try:
+        record = -1
+        with open(fasta_path) as f:
+            for line in f:
+                if line.startswith('>'):
+                    record += 1
+                handles[record % shards].write(line)
+    finally:
+        for handle in handles:
+            handle.close()
+    # Descartar shards vacíos (menos secuencias que shards)
+    return [handle.name for handle in handles if os.path.getsize(handle.name) > 0]
+
+
+def rep_seqs_fasta(rep_seqs):
+    """Ruta al FASTA de un artefacto de secuencias representativas
+
+    Si ``rep_seqs`` es una ruta, el FASTA se lee de la caché de artefactos
+    descomprimidos sin cargar el artefacto completo.
+    """
+    if is_path(rep_seqs):
+        return next(unzip_qza_cached(rep_seqs).glob('*/data/dna-sequences.fasta'))
+    # Ver el artefacto en su propio formato no copia datos
+    return pathlib.Path(str(rep_seqs.view(rep_seqs.format))) / "dna-sequences.fasta"
+
+
+def read_fasta(fasta_path):
+    """Itera los registros (id, secuencia) de un FASTA"""
+    feature_id, chunks = None, []
+    with open(fasta_path) as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith('>'):
+                if feature_id is not None:
+                    yield feature_id, ''.join(chunks)
+                feature_id, chunks = line[1:].split()[0], []
+            elif line:
+                chunks.append(line)
+    if feature_id is not None:
+        yield feature_id, ''.join(chunks)
+
+
+def _classify_vsearch(fasta_path, seqs_ref, taxa_ref, threads):
+    """Clasifica un FASTA con el consenso de vsearch (artefactos o rutas .qza de referencia)"""
+    if is_path(seqs_ref):
+        seqs_ref, taxa_ref = Artifact.load(str(seqs_ref)), Artifact.load(str(taxa_ref))
+    query = Artifact.import_data('FeatureData[Sequence]', str(fasta_path))
+    result = classify_consensus_vsearch(
+        query=query,
         reference_reads=seqs_ref,
         reference_taxonomy=taxa_ref,
-        threads=cpus
+        threads=threads
+    )
+    return result.classification.view(pd.DataFrame)
+
+
+def classify_sharded(fasta_path, seqs_ref, taxa_ref, cpus, shards=1):
+    """Clasifica un FASTA en ``shards`` particiones en paralelo
+
+    Las acciones de QIIME2 no son seguras entre hilos de un mismo proceso
+    (provenance, directorios temporales), así que cada partición se
+    clasifica en su propio proceso con ``cpus // shards`` hilos de vsearch.
+    Entre procesos solo viajan rutas: las referencias se guardan una vez en
+    el directorio temporal.
+
+    Returns:
+        DataFrame: Taxonomía indexada por 'Feature ID'
+    """
+    if shards <= 1:
+        return _classify_vsearch(fasta_path, seqs_ref, taxa_ref, cpus)
+
+    threads = max(1, cpus // shards)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        shard_files = split_fasta(fasta_path, shards, tmpdir)
+        seqs_ref_path = os.path.join(tmpdir, "ref-seqs.qza")
+        taxa_ref_path = os.path.join(tmpdir, "ref-taxa.qza")
+        seqs_ref.save(seqs_ref_path)
+        taxa_ref.save(taxa_ref_path)
+
+        with ProcessPoolExecutor(max_workers=len(shard_files)) as executor:
+            classifications = list(executor.map(
+                _classify_vsearch, shard_files, [seqs_ref_path] * len(shard_files),
+                [taxa_ref_path] * len(shard_files), [threads] * len(shard_files)
+            ))
+
+    return pd.concat(classifications)
+
+
+def classify_reference_gpu(fasta_path, seqs_ref, taxa_ref):
+    """Clasifica un FASTA por consenso de vecinos k-mer con FAISS en la GPU
+
+    Returns:
+        DataFrame: Taxonomía indexada por 'Feature ID'
+    """
+    reference_seqs = seqs_ref.view(pd.Series).astype(str)
+    reference_taxonomy = taxa_ref.view(pd.DataFrame)['Taxon']
+    return classify_gpu(dict(read_fasta(fasta_path)), reference_seqs, reference_taxonomy)
+
+
+# Caché de clasificaciones por defecto, dentro del directorio de salida
+CLASSIFICATION_CACHE_NAME = "classification_cache.json"
+
+
+def classify_unique(rep_seqs, seqs_ref, taxa_ref, cpus, shards=1, input_cache=None, output_cache=None,
+                    backend='vsearch'):
+    """Clasifica solo las secuencias distintas y aún no clasificadas
+
+    Las secuencias se identifican por su hash BLAKE2b: las repetidas se
+    clasifican una vez y el resultado se replica a todos sus IDs. Con
+    ``input_cache`` / ``output_cache`` (JSON) se reutilizan clasificaciones
+    de ejecuciones anteriores con la misma base de referencia y backend.
+
+    Con ``backend='faiss-gpu'`` se usa el clasificador k-mer en GPU; si FAISS
+    no está instalado o no hay GPU se recurre a vsearch.
+
+    Returns:
+        Artefacto FeatureData[Taxonomy]
+    """
+    if backend == 'faiss-gpu' and not gpu_available():
+        print("⚠️  FAISS o la GPU no están disponibles, se usa vsearch")
+        backend = 'vsearch'
+
+    # Las clasificaciones dependen de la base de referencia y del backend
+    reference = [str(seqs_ref.uuid), str(taxa_ref.uuid), backend]
+
+    cache = {}
+    if input_cache and os.path.exists(input_cache):
+        try:
+            with open(input_cache) as f:
+                saved = json.load(f)
+        except ValueError:
+            # Cachés en otro formato (p. ej. las antiguas en pickle) no se cargan
+            print(f"⚠️  La caché {input_cache} no es un JSON válido, se ignora")
+            saved = {}
+        if saved.get('reference') == reference:
+            cache = saved['classifications']
+        elif saved:
+            print(f"⚠️  La caché {input_cache} corresponde a otra base de referencia, se ignora")
+
+    digests = {}
+    # Primer ID de cada secuencia distinta sin clasificar
+    pending = {}
+    for feature_id, sequence in read_fasta(rep_seqs_fasta(rep_seqs)):
+        digest = hashlib.blake2b(sequence.upper().encode(), digest_size=16).hexdigest()
+        digests[feature_id] = digest
+        if digest not in cache and digest not in pending:
+            pending[digest] = feature_id
+
+    print(f"🔁 {len(digests)} secuencias, {len(pending)} por clasificar "
+          f"({len(set(digests.values())) - len(pending)} reutilizadas o repetidas)")
+
+    if pending:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            query_fasta = pathlib.Path(tmpdir) / "query.fasta"
+            query_ids = set(pending.values())
+            with open(query_fasta, 'w') as out:
+                for feature_id, sequence in read_fasta(rep_seqs_fasta(rep_seqs)):
+                    if feature_id in query_ids:
+                        out.write(f">{feature_id}\n{sequence}\n")
+            if backend == 'faiss-gpu':
+                classified = classify_reference_gpu(query_fasta, seqs_ref, taxa_ref)
+            else:
+                classified = classify_sharded(query_fasta, seqs_ref, taxa_ref, cpus, shards)
+
+        for digest, feature_id in pending.items():
+            cache[digest] = classified.loc[feature_id].to_dict()
+
+    # Si no hay clasificaciones nuevas, la caché leída no se reescribe
+    if output_cache and (pending or output_cache != input_cache or not os.path.exists(output_cache)):
+        # Escritura atómica: una ejecución interrumpida no deja la caché a medias
+        partial = f"{output_cache}.partial"
+        with open(partial, 'w') as f:
+            # default=float: los valores de consenso pueden ser flotantes de NumPy
+            json.dump({'reference': reference, 'classifications': cache}, f, default=float)
+        os.replace(partial, output_cache)
+
+    taxonomy = pd.DataFrame.from_dict(
+        {feature_id: cache[digest] for feature_id, digest in digests.items()}, orient='index'
     )
+    taxonomy.index.name = 'Feature ID'
+    return Artifact.import_data('FeatureData[Taxonomy]', taxonomy)
+
+
+# Formato de los porcentajes en los CSV por nivel
+PERCENT_FORMAT = '%.6g'
+
+# Nivel de rango (1 = reino) de cada CSV; -1 es el nivel más profundo disponible
+LEVELS = {
+    2: "phylum",
+    3: "class",
+    4: "order",
+    5: "family",
+    6: "genus",
+    -1: "species"  # Último nivel para especies
+}
+
+
+def collapse_levels(table, classification, levels=LEVELS):
+    """Suma las abundancias de la tabla por linaje en cada nivel taxonómico
+
+    La matriz se densifica una sola vez con las features ordenadas por
+    linaje completo; así cada linaje truncado ocupa filas contiguas y cada
+    nivel se obtiene con un único ``np.add.reduceat``.
+
+    Args:
+        table: Artefacto FeatureTable[Frequency]
+        classification: Artefacto FeatureData[Taxonomy]
+        levels: Diccionario {nivel: nombre}
+
+    Returns:
+        dict: {nombre: DataFrame con taxones como filas y muestras como columnas}
+    """
+    import biom
+
+    biom_table = table.view(biom.Table)
+    taxonomy = classification.view(pd.DataFrame)['Taxon']
+    feature_ids = biom_table.ids(axis='observation')
+    lineages = taxonomy.reindex(feature_ids).fillna('Unassigned')
+
+    ranks = [tuple(rank.strip() for rank in lineage.split(';')) for lineage in lineages]
+    depth = max(len(r) for r in ranks)
+    # Rellenar los rangos faltantes como lo hace el collapse de QIIME2
+    ranks = [r + ('__',) * (depth - len(r)) for r in ranks]
+
+    order = sorted(range(len(ranks)), key=ranks.__getitem__)
+    ranks = [ranks[i] for i in order]
+    # Reordenar las filas en la matriz dispersa: una sola copia densa, ya
+    # con taxones como filas y muestras como columnas (sin transponer)
+    counts = biom_table.matrix_data.tocsr()[order].toarray()
+    sample_ids = biom_table.ids(axis='sample')
+
+    collapsed = {}
+    for level, level_name in levels.items():
+        level = depth if level == -1 else min(level, depth)
+        labels = np.array([';'.join(r[:level]) for r in ranks], dtype=object)
+        starts = np.flatnonzero(np.r_[True, labels[1:] != labels[:-1]])
+        collapsed[level_name] = pd.DataFrame(
+            np.add.reduceat(counts, starts, axis=0),
+            index=labels[starts],
+            columns=sample_ids
+        )
+
+    return collapsed
+
+
+def _csv_field(value):
+    """Entrecomilla un campo CSV si contiene separadores o comillas"""
+    if any(char in value for char in ',"\n'):
+        return '"' + value.replace('"', '""') + '"'
+    return value
+
+
+def _ensure_artifact(artifact):
+    """Carga el artefacto si se pasa como ruta"""
+    return load_artifact(artifact) if is_path(artifact) else artifact
+
+
+def _export_level(df_level, output_stem, write_csv=True):
+    """Normaliza un nivel taxonómico a porcentajes y lo guarda como Parquet y/o CSV
+
+    Con pyarrow disponible se escribe ``<nivel>.parquet`` (zstd), mucho más
+    rápido de releer. El CSV formatea la matriz float32 fila a fila con una
+    única cadena de formato (como ``np.savetxt``), sin el formateo celda a
+    celda de ``DataFrame.to_csv``.
+    """
+    percentages = normalized_df(df_level)
+    if PYARROW_AVAILABLE:
+        percentages.to_parquet(f"{output_stem}.parquet", engine='pyarrow', compression='zstd')
+    if not write_csv:
+        return
+
+    row_format = ','.join([PERCENT_FORMAT] * percentages.shape[1])
+    with open(f"{output_stem}.csv", 'w', buffering=1 << 20) as f:
+        f.write(','.join(['', *(_csv_field(str(column)) for column in percentages.columns)]) + '\n')
+        for label, row in zip(percentages.index, percentages.to_numpy().tolist()):
+            f.write(f"{_csv_field(str(label))},{row_format % tuple(row)}\n")
+
+
+def taxa_assigner(table, rep_seqs, seqs_ref, taxa_ref, metadata_filename, cpus, output_folder, shards=1,
+                  input_cache=None, output_cache=None, backend='vsearch', write_csv=True):
+    """Asignar taxonomía y generar archivos CSV por nivel taxonómico
+
+    Solo se clasifican las secuencias distintas no presentes en la caché
+    (``input_cache``). Con ``shards > 1`` se clasifican en particiones
+    paralelas y las taxonomías resultantes se concatenan. ``backend`` elige
+    entre vsearch y el clasificador k-mer en GPU ('faiss-gpu').
+
+    Cada nivel se guarda como Parquet (si pyarrow está instalado) y, salvo
+    ``write_csv=False``, también como CSV. Si no se indica ninguna caché,
+    se usa ``CLASSIFICATION_CACHE_NAME`` dentro de ``output_folder`` (salvo
+    con la caché desactivada).
+    """
+    os.makedirs(output_folder, exist_ok=True)
+    if input_cache is None and output_cache is None and cache_enabled():
+        input_cache = output_cache = os.path.join(output_folder, CLASSIFICATION_CACHE_NAME)
+
+    # Clasificación taxonómica. La tabla se carga después y no en un hilo en
+    # paralelo: QIIME2 no es seguro entre hilos de un mismo proceso
+    classification = classify_unique(rep_seqs, _ensure_artifact(seqs_ref), _ensure_artifact(taxa_ref), cpus,
+                                     shards, input_cache=input_cache, output_cache=output_cache,
+                                     backend=backend)
+    table = _ensure_artifact(table)
 
     # Crear barplot de taxonomía
     taxa_barplot = barplot(
         table=table,
-        taxonomy=taxonomy.classification,
+        taxonomy=classification,
         metadata=Metadata.load(metadata_filename)
     )
     taxa_barplot = taxa_barplot.visualization
     taxa_barplot.save(f"{output_folder}/taxa_barplot.qzv")
 
-    # Exportar datos y generar archivos CSV por nivel taxonómico
-    csvs_barplot = []
-    with tempfile.TemporaryDirectory() as tmpdir:
-        taxa_barplot.export_data(tmpdir)
-        data_dir_fp = pathlib.Path(tmpdir)
-        csv_fps = sorted(data_dir_fp.glob('level-*csv'))
-
-        for csv_fp in csv_fps:
-            df_barplot = pd.read_csv(csv_fp, index_col='index')
-            csvs_barplot.append(df_barplot)
-
-    # Generar archivos CSV para cada nivel taxonómico
-    levels = {
-        1: "phylum",
-        2: "class",
-        3: "order",
-        4: "family",
-        5: "genus",
-        -1: "species"  # Último nivel para especies
-    }
-
-    for level_idx, level_name in levels.items():
-        df_level = csvs_barplot[level_idx].T
-        df_level.drop(df_level.index[-1], inplace=True)  # Eliminar fila "Unknown"
-        df_level = normalized_df(df_level)
-        df_level.to_csv(f"{output_folder}/{level_name}.csv")
+    # Generar archivos CSV para cada nivel taxonómico directamente desde la
+    # tabla BIOM, sin exportar y releer los CSV del barplot. Los niveles son
+    # independientes y se normalizan y escriben en paralelo
+    if not (write_csv or PYARROW_AVAILABLE):
+        print("⚠️  pyarrow no está instalado; los niveles se guardan en CSV")
+        write_csv = True
+    collapsed = collapse_levels(table, classification)
+    with ThreadPoolExecutor(max_workers=max(1, min(len(collapsed), cpus))) as executor:
+        list(executor.map(_export_level, collapsed.values(),
+                          [f"{output_folder}/{level_name}" for level_name in collapsed],
+                          [write_csv] * len(collapsed)))
 
     return f"Archivos taxonómicos generados en: {output_folder}"
\ No newline at end of file
@@ -0,0 +1,20 @@
+"""
+Utilidades generales del pipeline
+"""
+import os
+
+
+def available_cpus():
+    """Número de CPUs que este proceso puede usar
+
+    Respeta la afinidad de CPU (taskset, cgroups de Slurm/contenedores), a
+    diferencia de ``os.cpu_count()``, que devuelve todos los núcleos del nodo.
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def is_path(obj):
+    """True si ``obj`` es una ruta (str o cualquier ``os.PathLike``) y no un objeto ya cargado"""
+    return isinstance(obj, (str, os.PathLike))
@@ -0,0 +1,49 @@
+import io
+import unittest
+
+from modules.io_utils import split_interleaved
+
+
+def record(name, mate, seq='ACGT'):
+    return f"@{name} {mate} length={len(seq)}\n{seq}\n+{name} {mate} length={len(seq)}\n{'I' * len(seq)}\n".encode()
+
+
+class SplitInterleavedTest(unittest.TestCase):
+
+    def split(self, data, block_size=1 << 22):
+        forward, reverse = io.BytesIO(), io.BytesIO()
+        orphans = split_interleaved(io.BytesIO(data), forward, reverse, block_size=block_size)
+        return forward.getvalue(), reverse.getvalue(), orphans
+
+    def test_pairs_are_split(self):
+        data = record('SRR1.1', 1) + record('SRR1.1', 2) + record('SRR1.2', 1) + record('SRR1.2', 2)
+        forward, reverse, orphans = self.split(data)
+        self.assertEqual(forward, record('SRR1.1', 1) + record('SRR1.2', 1))
+        self.assertEqual(reverse, record('SRR1.1', 2) + record('SRR1.2', 2))
+        self.assertEqual(orphans, 0)
+
+    def test_spot_without_mate_is_dropped_and_pairs_resync(self):
+        data = (record('SRR1.1', 1) + record('SRR1.1', 2)
+                + record('SRR1.2', 1)
+                + record('SRR1.3', 1) + record('SRR1.3', 2))
+        # Bloques pequeños: los registros quedan partidos entre lecturas
+        for block_size in (7, 64, 1 << 22):
+            forward, reverse, orphans = self.split(data, block_size)
+            self.assertEqual(forward, record('SRR1.1', 1) + record('SRR1.3', 1))
+            self.assertEqual(reverse, record('SRR1.1', 2) + record('SRR1.3', 2))
+            self.assertEqual(orphans, 1)
+
+    def test_trailing_orphan_is_counted(self):
+        data = record('SRR1.1', 1) + record('SRR1.1', 2) + record('SRR1.2', 1)
+        forward, reverse, orphans = self.split(data)
+        self.assertEqual(forward, record('SRR1.1', 1))
+        self.assertEqual(orphans, 1)
+
+    def test_truncated_input_raises(self):
+        data = record('SRR1.1', 1) + b"@SRR1.1 2\nACGT\n"
+        with self.assertRaises(ValueError):
+            self.split(data)
+
+
+if __name__ == '__main__':
+    unittest.main()